@@ -0,0 +1,299 @@
+import json
+import os
+import shutil
+import threading
+import time
+import zlib
+from contextlib import ExitStack, contextmanager
+import storage
+from locks import FileLock
+from storage import DatabaseError
+
+# Folder holding one sub-folder per snapshot
+SNAPSHOTS_DIR = 'snapshots'
+MANIFEST = 'manifest.json'
+# Locked while snapshots are created or pruned (see _locked)
+LOCK_FILE = '.lock'
+# Bytes read per copy step
+COPY_SIZE = 1024 * 1024
+
+
+# A snapshot is a folder with a manifest and the table data it added. A log
+# table is saved as its log up to a position where it was consistent, as a
+# list of segments: the ones of the previous snapshot of the database if the
+# log has only grown since, plus one with the bytes appended after. A hash
+# table is saved whole, as its slots at that point followed by its records up
+# to there, and reused from the previous snapshot when unchanged. Positions
+# are taken for all tables at once and the data is copied after, without
+# holding any lock, so writers are not held up. A snapshot needs the ones
+# its segments come from, which are listed in its manifest; pruning old
+# snapshots moves the files newer ones still need into the oldest kept.
+def snapshot_path(name, filename=''):
+    return os.path.join(SNAPSHOTS_DIR, name, filename)
+
+
+def load_manifest(name):
+    if not name or os.sep in name or name.startswith('.'):
+        raise DatabaseError(f"Error: Invalid snapshot name '{name}'.")
+    try:
+        with open(snapshot_path(name, MANIFEST), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise DatabaseError(f"Error: Snapshot '{name}' does not exist.")
+
+
+# Manifests of the snapshots of a database (of all when db_name is None), oldest first
+def list_snapshots(db_name=None):
+    if not os.path.exists(SNAPSHOTS_DIR):
+        return []
+    manifests = []
+    for name in os.listdir(SNAPSHOTS_DIR):
+        # Snapshots being written are in '.tmp' folders until complete
+        if name.endswith('.tmp') or not os.path.exists(snapshot_path(name, MANIFEST)):
+            continue
+        manifest = load_manifest(name)
+        if db_name is None or manifest['db'] == db_name:
+            manifests.append(manifest)
+    return sorted(manifests, key=lambda manifest: (manifest['created'], manifest['name']))
+
+
+# Held while snapshots are created or pruned, so a new snapshot never reuses
+# files that pruning is moving. The file lock covers other processes (server
+# workers, db_cli); the thread lock the other threads of this one, which
+# would otherwise share its flock.
+_lock = threading.Lock()
+
+
+@contextmanager
+def _locked():
+    os.makedirs(SNAPSHOTS_DIR, exist_ok=True)
+    with _lock:
+        file_lock = FileLock(os.path.join(SNAPSHOTS_DIR, LOCK_FILE))
+        try:
+            with file_lock.hold(exclusive=True):
+                yield
+        finally:
+            file_lock.close()
+
+
+def _new_name(db_name):
+    base = f"{db_name}-{time.strftime('%Y%m%d-%H%M%S')}"
+    name = base
+    n = 1
+    while os.path.exists(snapshot_path(name)):
+        n += 1
+        name = f"{base}-{n}"
+    return name
+
+
+# Read length bytes of f from start, writing them to out if given; returns
+# their CRC32 continuing from crc
+def _copy(f, start, length, out=None, crc=0):
+    f.seek(start)
+    while length:
+        chunk = f.read(min(COPY_SIZE, length))
+        if not chunk:
+            raise DatabaseError(f"Error: '{f.name}' is shorter than expected.")
+        crc = zlib.crc32(chunk, crc)
+        if out is not None:
+            out.write(chunk)
+        length -= len(chunk)
+    return crc
+
+
+def _write_file(path, write):
+    with open(path, 'wb') as f:
+        result = write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    return result
+
+
+# Where every table of a database stands at one moment: all their read locks
+# are taken, in name order as transactions take them, then each table's
+# position is noted and the locks are released. Fills captured with each
+# table's format and open file, the length to copy and its metadata (log
+# tables) or slots (hash tables).
+def _capture(db_name, captured):
+    with ExitStack() as stack:
+        tables = [(table_name, stack.enter_context(storage.open_table(db_name, table_name)))
+                  for table_name in storage.list_tables(db_name)]
+        for table_name, table in tables:
+            if isinstance(table, storage.HashTable):
+                slots, f, length = table.open_file()
+                captured[table_name] = {'format': storage.HASH_FORMAT, 'file': f, 'length': length, 'slots': slots}
+            else:
+                f, length = table.open_log()
+                captured[table_name] = {'format': table.codec.name, 'file': f, 'length': length,
+                                        'meta': json.loads(json.dumps(table.meta))}
+
+
+# Save one captured table into folder; returns its manifest entry and the bytes copied
+def _snapshot_table(table_name, table, name, folder, previous):
+    if table['format'] == storage.HASH_FORMAT:
+        return _snapshot_hash(table_name, table, name, folder, previous)
+    log, length = table['file'], table['length']
+    segments = []
+    crc = start = 0
+    # Reuse the previous segments if they are still the start of this log
+    # (not if it was compacted or converted since)
+    if previous is not None and 'segments' in previous and previous['length'] <= length \
+            and _copy(log, 0, previous['length']) == previous['crc']:
+        segments = list(previous['segments'])
+        start = previous['length']
+        crc = previous['crc']
+    if length > start:
+        filename = f"{table_name}.{len(segments)}.seg"
+        crc = _write_file(os.path.join(folder, filename),
+                          lambda out: _copy(log, start, length - start, out, crc))
+        segments.append([name, filename])
+    return {'format': table['format'], 'segments': segments, 'length': length, 'crc': crc,
+            'meta': table['meta']}, length - start
+
+
+def _snapshot_hash(table_name, table, name, folder, previous):
+    filename = table_name + storage.HASH_EXT
+    copy_path = os.path.join(folder, filename)
+    slots, f, length = table['slots'], table['file'], table['length']
+
+    def write(out):
+        out.write(slots)
+        return _copy(f, len(slots), length - len(slots), out, zlib.crc32(slots))
+
+    # Reading is cheaper than copying, so check first whether the previous copy still matches
+    if previous is not None and previous['format'] == storage.HASH_FORMAT and previous['length'] == length:
+        crc = _copy(f, len(slots), length - len(slots), None, zlib.crc32(slots))
+        if previous['crc'] == crc:
+            return previous, 0
+    crc = _write_file(copy_path, write)
+    return {'format': storage.HASH_FORMAT, 'file': [name, filename], 'length': length, 'crc': crc}, length
+
+
+# Snapshot every table of a database, incrementally from its last snapshot.
+# All tables are saved as of the same moment, so a transaction or a change
+# made meanwhile is either wholly in the snapshot or not at all. Returns the
+# manifest and the number of bytes copied.
+def create_snapshot(db_name):
+    if not os.path.isdir(os.path.join(storage.DATABASES_DIR, db_name)):
+        raise DatabaseError(f"Database '{db_name}' does not exist.")
+    with _locked():
+        return _create_snapshot(db_name)
+
+
+def _create_snapshot(db_name):
+    previous = list_snapshots(db_name)
+    base = previous[-1] if previous else None
+    name = _new_name(db_name)
+    folder = snapshot_path(name).rstrip(os.sep) + f".{os.getpid()}.tmp"
+    os.makedirs(folder)
+    captured = {}
+    try:
+        _capture(db_name, captured)
+        tables = {}
+        copied = 0
+        for table_name, table in captured.items():
+            previous_entry = base['tables'].get(table_name) if base is not None else None
+            tables[table_name], size = _snapshot_table(table_name, table, name, folder, previous_entry)
+            copied += size
+        manifest = {'name': name, 'db': db_name, 'created': time.time(),
+                    'base': base['name'] if base is not None else None, 'tables': tables}
+        _write_file(os.path.join(folder, MANIFEST), lambda f: f.write(json.dumps(manifest).encode('utf-8')))
+        os.rename(folder, snapshot_path(name).rstrip(os.sep))
+        storage.fsync_dir(snapshot_path(name).rstrip(os.sep))
+    except BaseException:
+        shutil.rmtree(folder, ignore_errors=True)
+        raise
+    finally:
+        for table in captured.values():
+            table['file'].close()
+    return manifest, copied
+
+
+def _files(entry):
+    return entry['segments'] if 'segments' in entry else [entry['file']]
+
+
+# Delete all but the newest keep snapshots of a database. Files of deleted
+# snapshots that kept ones still need are first linked into the oldest kept
+# snapshot and the manifests pointed at them there, so that snapshot becomes
+# the start of the chain. Returns the names of the deleted snapshots.
+def prune_snapshots(db_name, keep):
+    if keep < 1:
+        raise DatabaseError("Error: At least one snapshot must be kept.")
+    with _locked():
+        manifests = list_snapshots(db_name)
+        dropped, kept = manifests[:-keep], manifests[-keep:]
+        if not dropped:
+            return []
+        dropped_names = {manifest['name'] for manifest in dropped}
+        oldest = kept[0]['name']
+        moved = {}
+        for manifest in kept:
+            changed = manifest['base'] in dropped_names
+            if changed:
+                manifest['base'] = None
+            for entry in manifest['tables'].values():
+                files = [_moved_file(name, filename, oldest, moved) if name in dropped_names else [name, filename]
+                         for name, filename in _files(entry)]
+                if files != _files(entry):
+                    changed = True
+                    if 'segments' in entry:
+                        entry['segments'] = files
+                    else:
+                        entry['file'] = files[0]
+            if changed:
+                storage.atomic_write(snapshot_path(manifest['name'], MANIFEST),
+                                     lambda f: f.write(json.dumps(manifest).encode('utf-8')), 'wb')
+        # Only once no kept manifest refers to them
+        for name in dropped_names:
+            shutil.rmtree(snapshot_path(name).rstrip(os.sep))
+        return [manifest['name'] for manifest in dropped]
+
+
+# Link a file of a snapshot being pruned into the snapshot named into, once
+# per file; returns its new [name, filename]
+def _moved_file(name, filename, into, moved):
+    if (name, filename) not in moved:
+        new_filename = f"{name}.{filename}"
+        target = snapshot_path(into, new_filename)
+        if not os.path.exists(target):
+            os.link(snapshot_path(name, filename), target)
+        moved[(name, filename)] = [into, new_filename]
+    return moved[(name, filename)]
+
+
+# Write a table's files at path (as made by storage.table_path) from its
+# manifest entry, checking the data against the saved CRC32
+def _restore_table(path, entry):
+    def write(f):
+        crc = 0
+        for name, filename in _files(entry):
+            with open(snapshot_path(name, filename), 'rb') as part:
+                crc = _copy(part, 0, os.fstat(part.fileno()).st_size, f, crc)
+        if crc != entry['crc']:
+            raise DatabaseError(f"Error: The saved data of '{os.path.basename(path)}' is corrupt.")
+
+    if entry['format'] == storage.HASH_FORMAT:
+        storage.atomic_write(path + storage.HASH_EXT, write, 'wb')
+        return
+    storage.atomic_write(path + storage.LOG_EXT, write, 'wb')
+    if entry['meta']['indexes']:
+        storage.atomic_write(path + storage.META_EXT, lambda f: json.dump(entry['meta'], f))
+
+
+# Make a database (created if needed) hold exactly the tables of a snapshot,
+# which may come from another database. Each table is replaced under its
+# lock; tables are not all replaced at the same instant. Returns the manifest.
+def restore_snapshot(db_name, name):
+    manifest = load_manifest(name)
+    for entry in manifest['tables'].values():
+        for source, filename in _files(entry):
+            if not os.path.exists(snapshot_path(source, filename)):
+                raise DatabaseError(f"Error: Snapshot '{name}' needs '{source}', which has been removed.")
+    os.makedirs(os.path.join(storage.DATABASES_DIR, db_name), exist_ok=True)
+    for table_name in storage.list_tables(db_name):
+        if table_name not in manifest['tables']:
+            storage.drop_table(db_name, table_name)
+    for table_name, entry in manifest['tables'].items():
+        storage.replace_table(db_name, table_name, lambda path: _restore_table(path, entry))
+    return manifest
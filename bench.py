@@ -0,0 +1,378 @@
+import argparse
+import json
+import os
+import random
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from itertools import count
+import storage
+
+# YCSB core workloads as operation mixes. Reads and updates pick keys by the
+# request distribution; d reads recently inserted keys; e scans short ranges;
+# f does read-modify-write.
+WORKLOADS = {
+    'a': {'read': 0.5, 'update': 0.5},
+    'b': {'read': 0.95, 'update': 0.05},
+    'c': {'read': 1.0},
+    'd': {'read': 0.95, 'insert': 0.05},
+    'e': {'scan': 0.95, 'insert': 0.05},
+    'f': {'read': 0.5, 'rmw': 0.5},
+}
+DISTRIBUTIONS = ('uniform', 'zipfian', 'latest')
+TARGETS = ('server', 'storage', 'cli')
+
+BENCH_DB = 'bench'
+LOAD_BATCH = 1000
+ZIPFIAN_THETA = 0.99
+PERCENTILES = (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))
+SERVER_START_TIMEOUT = 10.0
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class BenchError(Exception):
+    pass
+
+
+# Zipfian ranks in [0, n) with rank 0 the most popular, as in YCSB's
+# ZipfianGenerator (Gray et al., "Quickly Generating Billion-Record Databases")
+class Zipfian:
+    def __init__(self, n, theta=ZIPFIAN_THETA):
+        self.n = n
+        self.theta = theta
+        self.alpha = 1 / (1 - theta)
+        self.zetan = sum(1 / i ** theta for i in range(1, n + 1))
+        self.half_pow_theta = 0.5 ** theta
+        self.eta = (1 - (2 / n) ** (1 - theta)) / (1 - (1 + self.half_pow_theta) / self.zetan)
+
+    def next(self, rng):
+        u = rng.random()
+        uz = u * self.zetan
+        if uz < 1:
+            return 0
+        if uz < 1 + self.half_pow_theta:
+            return 1
+        return min(int(self.n * (self.eta * u - self.eta + 1) ** self.alpha), self.n - 1)
+
+
+# Key numbers for reads and updates. Zipfian ranks are scattered over the
+# key space so the hot keys are not all neighbours; 'latest' favours the
+# most recently inserted keys.
+class KeyChooser:
+    def __init__(self, distribution, records, inserted):
+        self.distribution = distribution
+        self.records = records
+        self.inserted = inserted
+        self.zipfian = Zipfian(records) if distribution != 'uniform' else None
+
+    def next(self, rng):
+        limit = self.inserted()
+        if self.distribution == 'uniform':
+            return rng.randrange(limit)
+        rank = self.zipfian.next(rng)
+        if self.distribution == 'latest':
+            return max(limit - 1 - rank, 0)
+        return (rank * 2654435761) % limit
+
+
+def make_key(number, key_size):
+    return 'user' + str(number).zfill(max(key_size - 4, 1))
+
+
+def make_value(rng, value_size):
+    return ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=value_size))
+
+
+# Sends commands through the client protocol to a running server
+class ServerBackend:
+    def __init__(self, host, port, connections, shards=None):
+        from db_client import Client, ServerError, ShardedClient
+        self.client = ShardedClient(shards, connections) if shards else Client(host, port, connections)
+        self.errors = (ServerError,)
+
+    def execute(self, *args):
+        return self.client.execute(*args)
+
+    def create_table(self, table, fmt):
+        self.execute('create-table', table, fmt)
+
+    def use_db(self, name):
+        self.client.switch_db(name)
+
+    def close(self):
+        self.client.close()
+
+
+# Calls the server's Database class in this process, with no networking
+class StorageBackend:
+    def __init__(self, fsync):
+        import db_server
+        self.db_server = db_server
+        storage.cache = storage.TableCache(fsync=fsync)
+        storage.cache.start_flusher()
+        self.session = db_server.Session()
+        self.errors = (storage.DatabaseError,)
+
+    def execute(self, *args):
+        return self.db_server.execute_command(self.session, list(args))
+
+    def create_table(self, table, fmt):
+        self.execute('create-table', table, fmt)
+
+    def use_db(self, name):
+        self.execute('switch-db', name)
+
+    def close(self):
+        storage.close_all()
+
+
+# Runs db_cli.py once per command, the way shell scripts use it. db_cli
+# opens tables in shared mode, so concurrent runs (--threads) are safe.
+class CliBackend:
+    def __init__(self):
+        self.errors = (BenchError,)
+
+    def execute(self, *args):
+        if args[0] == 'scan':
+            # db_cli takes the server's option=value scan options as flags
+            flags = []
+            for arg in args[2:]:
+                name, _, value = arg.partition('=')
+                flags += ['--' + name, value]
+            args = list(args[:2]) + flags
+        result = subprocess.run([sys.executable, os.path.join(HERE, 'db_cli.py')] + list(args),
+                                capture_output=True, text=True)
+        if result.returncode != 0 or 'Error' in result.stdout or 'does not exist' in result.stdout:
+            raise BenchError(result.stdout.strip() or result.stderr.strip())
+        return result.stdout
+
+    def create_table(self, table, fmt):
+        self.execute('create-table', table, '--format', fmt)
+
+    def use_db(self, name):
+        self.execute('switch-db', name)
+
+    def close(self):
+        pass
+
+
+# Start db_server.py in workdir on a free port; returns the process and port
+def start_server(workdir, server_args):
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    process = subprocess.Popen([sys.executable, os.path.join(HERE, 'db_server.py'), '--host', '127.0.0.1',
+                                '--port', str(port)] + server_args,
+                               cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+    process.kill()
+    raise BenchError("The server did not start")
+
+
+# Latency summary in milliseconds; nearest-rank percentiles
+def summarize(latencies, seconds):
+    latencies.sort()
+    summary = {'operations': len(latencies),
+               'throughput': round(len(latencies) / seconds, 1) if seconds else None}
+    if latencies:
+        ms = {name: round(latencies[min(int(p * len(latencies)), len(latencies) - 1)] * 1000, 3)
+              for name, p in PERCENTILES}
+        ms['mean'] = round(sum(latencies) / len(latencies) * 1000, 3)
+        ms['max'] = round(latencies[-1] * 1000, 3)
+        summary['latency_ms'] = ms
+    return summary
+
+
+# Create the table and insert records keys in batches
+def load(backend, table, args):
+    rng = random.Random(args.seed)
+    try:
+        backend.execute('create-db', BENCH_DB)
+    except backend.errors:
+        pass
+    backend.use_db(BENCH_DB)
+    backend.create_table(table, args.format)
+    started = time.perf_counter()
+    for first in range(0, args.records, LOAD_BATCH):
+        command = ['mset', table]
+        for number in range(first, min(first + LOAD_BATCH, args.records)):
+            command += [make_key(number, args.key_size), make_value(rng, args.value_size)]
+        backend.execute(*command)
+    seconds = time.perf_counter() - started
+    return {'records': args.records, 'seconds': round(seconds, 3),
+            'throughput': round(args.records / seconds, 1) if seconds else None}
+
+
+# Run one workload from args.threads threads and summarize it overall and per operation
+def run_workload(backend, table, name, args, inserted_count):
+    mix = list(WORKLOADS[name].items())
+    operations = [op for op, _ in mix]
+    weights = [weight for _, weight in mix]
+    lock = threading.Lock()
+    inserted = [args.records + inserted_count]
+    next_insert = count(inserted[0])
+    latencies = {op: [] for op in operations}
+    errors = [0]
+    per_thread = [args.operations // args.threads + (i < args.operations % args.threads)
+                  for i in range(args.threads)]
+    chooser = KeyChooser(args.distribution, args.records, lambda: inserted[0])
+
+    def worker(index):
+        rng = random.Random(args.seed + 1000 + index)
+        value = make_value(rng, args.value_size)
+        local = {op: [] for op in operations}
+        failed = 0
+        for op in rng.choices(operations, weights, k=per_thread[index]):
+            started = time.perf_counter()
+            try:
+                if op == 'insert':
+                    number = next(next_insert)
+                    backend.execute('insert-data', table, make_key(number, args.key_size), value)
+                    with lock:
+                        inserted[0] = max(inserted[0], number + 1)
+                else:
+                    key = make_key(chooser.next(rng), args.key_size)
+                    if op == 'read':
+                        backend.execute('get', table, key)
+                    elif op == 'update':
+                        backend.execute('update-data', table, key, value)
+                    elif op == 'scan':
+                        backend.execute('scan', table, f"start={key}", f"limit={rng.randint(1, args.scan_length)}")
+                    else:
+                        backend.execute('get', table, key)
+                        backend.execute('update-data', table, key, value)
+            except backend.errors:
+                failed += 1
+                continue
+            local[op].append(time.perf_counter() - started)
+        with lock:
+            for op in operations:
+                latencies[op].extend(local[op])
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+    result = summarize([latency for op in operations for latency in latencies[op]], seconds)
+    result.update({'workload': name, 'seconds': round(seconds, 3), 'errors': errors[0],
+                   'by_operation': {op: summarize(latencies[op], seconds) for op in operations}})
+    return result, inserted[0] - args.records
+
+
+def run(args):
+    workdir = args.dir or tempfile.mkdtemp(prefix='kvbench-')
+    os.makedirs(workdir, exist_ok=True)
+    processes = []
+    previous_dir = os.getcwd()
+    # The storage and cli targets use the 'databases' folder of the working directory
+    os.chdir(workdir)
+    try:
+        if args.target == 'server':
+            host, port = args.host, args.port
+            # Shards are servers on consecutive ports, or ones started in a folder each
+            shards = [f"{host}:{port + i}" for i in range(args.shards)]
+            if args.start_server:
+                shards = []
+                for i in range(args.shards):
+                    shard_dir = os.path.join(workdir, f'shard{i}') if args.shards > 1 else workdir
+                    os.makedirs(shard_dir, exist_ok=True)
+                    process, port = start_server(shard_dir, shlex.split(args.server_args))
+                    processes.append(process)
+                    shards.append(f"127.0.0.1:{port}")
+                host = '127.0.0.1'
+            backend = ServerBackend(host, port, args.connections, shards if args.shards > 1 else None)
+        elif args.target == 'storage':
+            backend = StorageBackend(args.fsync)
+        else:
+            backend = CliBackend()
+        table = f"usertable_{int(time.time())}_{os.getpid()}"
+        try:
+            report = {'target': args.target, 'table': table, 'load': load(backend, table, args), 'runs': []}
+            inserted = 0
+            for name in args.workload.split(','):
+                result, inserted = run_workload(backend, table, name, args, inserted)
+                report['runs'].append(result)
+                print(f"workload {name}: {result['throughput']} ops/s, "
+                      f"p99 {result.get('latency_ms', {}).get('p99')} ms, {result['errors']} errors",
+                      file=sys.stderr)
+        finally:
+            backend.close()
+    finally:
+        os.chdir(previous_dir)
+        for process in processes:
+            process.terminate()
+            process.wait()
+        if args.dir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report['config'] = {name: value for name, value in vars(args).items() if name != 'output'}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the database through the server, the storage layer or the CLI")
+    parser.add_argument('--target', choices=TARGETS, default='server',
+                        help="server: client protocol; storage: the Database class in-process; cli: one db_cli.py per command")
+    parser.add_argument('--workload', default='a',
+                        help=f"Comma-separated YCSB workloads to run in order ({', '.join(WORKLOADS)})")
+    parser.add_argument('--records', type=int, default=10000, help="Keys loaded before the workloads run")
+    parser.add_argument('--operations', type=int, default=10000, help="Operations per workload")
+    parser.add_argument('--threads', type=int, default=4, help="Concurrent clients issuing operations")
+    parser.add_argument('--connections', type=int, default=4, help="Pooled connections to the server")
+    parser.add_argument('--key-size', type=int, default=16, help="Key length in characters")
+    parser.add_argument('--value-size', type=int, default=100, help="Value length in characters")
+    parser.add_argument('--scan-length', type=int, default=100, help="Longest scan, in entries")
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='zipfian', help="Which keys are requested")
+    parser.add_argument('--format', choices=storage.TABLE_FORMATS, default=storage.DEFAULT_FORMAT,
+                        help="Storage format of the benchmark table")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed, for repeatable runs")
+    parser.add_argument('--host', default='localhost', help="Server address (server target)")
+    parser.add_argument('--port', type=int, default=5555, help="Server port (server target)")
+    parser.add_argument('--start-server', action='store_true',
+                        help="Start a db_server.py of this checkout in the working directory for the run")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="Split keys over this many servers (server target), on consecutive ports from --port")
+    parser.add_argument('--server-args', default='', help="Extra db_server.py arguments with --start-server")
+    parser.add_argument('--fsync', choices=storage.FSYNC_POLICIES, default=storage.DEFAULT_FSYNC,
+                        help="Fsync policy (storage target)")
+    parser.add_argument('--dir', help="Working directory (default: a temporary one, removed afterwards)")
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    for name in args.workload.split(','):
+        if name not in WORKLOADS:
+            parser.error(f"Unknown workload '{name}'")
+    if args.threads < 1 or args.records < 1 or args.shards < 1:
+        parser.error("--threads, --records and --shards must be at least 1")
+
+    try:
+        report = run(args)
+    except BenchError as e:
+        sys.exit(f"Error: {e}")
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,39 @@
-import argparse
-import os
 import json
+import os
+import shlex
+import sys
+import time
+from types import SimpleNamespace
+import storage
 
-# Global variable to store the currently selected database
-current_db = None
+# argparse and importer are imported only when needed: most single commands
+# are parsed by fast_parse, and interpreter startup dominates their run time
+
+# File remembering the selected database between commands
 CURRENT_DB_FILE = 'current_db.txt'
 
+# Positional arguments of the commands fast_parse handles without argparse
+FAST_COMMANDS = {
+    'create-db': ('name',),
+    'list-db': (),
+    'switch-db': ('name',),
+    'create-table': ('name',),
+    'list-tables': (),
+    'insert-data': ('table', 'key', 'value'),
+    'update-data': ('table', 'key', 'value'),
+    'delete-data': ('table', 'key'),
+    'get': ('table', 'key'),
+    'get-versioned': ('table', 'key'),
+    'cas': ('table', 'key', 'expected_version', 'value'),
+    'create-index': ('table', 'field'),
+    'find': ('table', 'condition'),
+    'list-entries': ('table',),
+    'snapshot': ('db',),
+    'restore': ('db', 'snapshot'),
+}
+
+SHELL_PROMPT = 'db> '
+
 class Database:
     def __init__(self, name):
         self.name = name
@@ -33,211 +61,471 @@ class Database:
         else:
             print("The 'databases' folder does not exist.")
 
-    @staticmethod
-    def switch_db(db_name):
-        global current_db
-
+    # Returns the database to work in from now on
+    def switch_db(self, db_name):
         # Check if the database exists
-        if os.path.exists(f"databases/{db_name}"):
-            current_db = db_name
-            with open(CURRENT_DB_FILE, 'w') as f:
-                f.write(current_db)  # Save the selected database to the file
-            print(f"Switched to database: {current_db}")
-        else:
+        if not os.path.exists(f"databases/{db_name}"):
             print(f"Database '{db_name}' does not exist.")
+            return self.name
 
-    @staticmethod
-    def create_table(table_name):
-        global current_db
+        # Save the selected database to the file, so the next command starts in it
+        if db_name != self.name:
+            with open(CURRENT_DB_FILE, 'w') as f:
+                f.write(db_name)
+        print(f"Switched to database: {db_name}")
+        return db_name
 
-        if current_db is None:
+    def create_table(self, table_name, fmt=storage.DEFAULT_FORMAT):
+        if self.name is None:
             print("No database selected. Please switch to a database first.")
             return
 
         # Check if table already exists
-        table_path = f"databases/{current_db}/{table_name}.json"
-        if os.path.exists(table_path):
-            print(f"Table '{table_name}' already exists in the '{current_db}' database.")
+        if storage.table_exists(self.name, table_name):
+            print(f"Table '{table_name}' already exists in the '{self.name}' database.")
             return
 
-        # Create a new empty table (JSON file)
-        with open(table_path, 'w') as table_file:
-            json.dump({}, table_file)  # Initialize with an empty dictionary (key-value store)
-        
-        print(f"Table '{table_name}' created successfully in the '{current_db}' database.")
+        # Create a new empty table (empty mutation log)
+        storage.create_table(self.name, table_name, fmt)
 
-    @staticmethod
-    def list_tables():
-        global current_db
+        print(f"Table '{table_name}' created successfully in the '{self.name}' database.")
 
-        if current_db is None:
+    def convert_table(self, table_name, fmt):
+        if self.name is None:
+            print("No database selected. Please switch to a database first.")
+            return
+
+        # Check if the table exists
+        if not storage.table_exists(self.name, table_name):
+            print(f"Table '{table_name}' does not exist.")
+            return
+
+        # Rewrite the whole table in the new format (legacy JSON tables are migrated first)
+        try:
+            converted = storage.convert_table(self.name, table_name, fmt)
+        except storage.DatabaseError as e:
+            print(e)
+            return
+        if not converted:
+            print(f"Table '{table_name}' is already stored as {fmt}.")
+            return
+
+        print(f"Converted table '{table_name}' to {fmt}.")
+
+    def list_tables(self):
+        if self.name is None:
             print("No database selected. Please switch to a database first.")
             return
 
         # Path to the database folder
-        db_path = f"databases/{current_db}"
+        db_path = f"databases/{self.name}"
 
         # Check if the database folder exists
         if not os.path.exists(db_path):
-            print(f"Database '{current_db}' does not exist.")
+            print(f"Database '{self.name}' does not exist.")
             return
 
-        # List all files in the current database folder
-        tables = [f for f in os.listdir(db_path) if f.endswith('.json')]
+        # List all tables in the current database folder
+        tables = storage.list_tables(self.name)
 
         # If no tables are found
         if not tables:
-            print(f"No tables found in database '{current_db}'.")
+            print(f"No tables found in database '{self.name}'.")
         else:
-            print(f"Tables in '{current_db}' database:")
+            print(f"Tables in '{self.name}' database:")
             for table in tables:
-                # Remove the .json extension to display the table name
-                print(f"- {table[:-5]}")  # Removing the ".json" extension
-
-    @staticmethod
-    def insert_data(table_name, key, value):
-        global current_db
+                print(f"- {table}")
 
-        if current_db is None:
+    # With ttl (seconds) the key is deleted once that time has passed
+    def insert_data(self, table_name, key, value, ttl=None):
+        if self.name is None:
             print("No database selected. Please switch to a database first.")
             return
 
-        table_path = f"databases/{current_db}/{table_name}.json"
-
         # Check if the table exists
-        if not os.path.exists(table_path):
+        if not storage.table_exists(self.name, table_name):
             print(f"Table '{table_name}' does not exist.")
             return
 
-        # Load the table data
-        with open(table_path, 'r') as table_file:
-            data = json.load(table_file)
+        expires_at = None if ttl is None else time.time() + ttl
+
+        # Open the table (replays its log into memory)
+        with storage.open_table(self.name, table_name, write=True) as table:
+            # Check if the key already exists
+            if key in table:
+                print(f"Error: Key '{key}' already exists in table '{table_name}'.")
+                return
+
+            # Insert the new data (appends one record to the log)
+            try:
+                table.set(key, value, expires_at)
+            except storage.DatabaseError as e:
+                print(e)
+                return
+
+        print(f"Inserted key '{key}' into table '{table_name}'.")
+
+    # Replaces the key's TTL: the new ttl, or none without one
+    def update_data(self, table_name, key, value, ttl=None):
+        if self.name is None:
+            print("No database selected. Please switch to a database first.")
+            return
 
-        # Check if the key already exists
-        if key in data:
-            print(f"Error: Key '{key}' already exists in table '{table_name}'.")
+        # Check if the table exists
+        if not storage.table_exists(self.name, table_name):
+            print(f"Table '{table_name}' does not exist.")
             return
 
-        # Insert the new data
-        data[key] = value
+        expires_at = None if ttl is None else time.time() + ttl
 
-        # Save the updated table data
-        with open(table_path, 'w') as table_file:
-            json.dump(data, table_file)
+        # Open the table (replays its log into memory)
+        with storage.open_table(self.name, table_name, write=True) as table:
+            # Check if the key exists
+            if key not in table:
+                print(f"Error: Key '{key}' does not exist in table '{table_name}'.")
+                return
 
-        print(f"Inserted key '{key}' into table '{table_name}'.")
+            # Update the entry
+            try:
+                table.set(key, value, expires_at)
+            except storage.DatabaseError as e:
+                print(e)
+                return
 
-    @staticmethod
-    def update_data(table_name, key, value):
-        global current_db
+        print(f"Updated key '{key}' in table '{table_name}'.")
 
-        if current_db is None:
+    def delete_data(self, table_name, key):
+        if self.name is None:
             print("No database selected. Please switch to a database first.")
             return
 
-        table_path = f"databases/{current_db}/{table_name}.json"
+        # Check if the table exists
+        if not storage.table_exists(self.name, table_name):
+            print(f"Table '{table_name}' does not exist.")
+            return
+
+        # Open the table (replays its log into memory)
+        with storage.open_table(self.name, table_name, write=True) as table:
+            # Check if the key exists
+            if key not in table:
+                print(f"Error: Key '{key}' does not exist in table '{table_name}'.")
+                return
+
+            # Delete the entry
+            table.delete(key)
+
+        print(f"Deleted key '{key}' from table '{table_name}'.")
+
+    def get_data(self, table_name, key):
+        if self.name is None:
+            print("No database selected. Please switch to a database first.")
+            return
 
         # Check if the table exists
-        if not os.path.exists(table_path):
+        if not storage.table_exists(self.name, table_name):
             print(f"Table '{table_name}' does not exist.")
             return
 
-        # Load the table data
-        with open(table_path, 'r') as table_file:
-            data = json.load(table_file)
+        # Look the key up (tables stored as hash read only that key from disk)
+        with storage.open_table(self.name, table_name) as table:
+            value = table.get(key)
 
-        # Check if the key exists
-        if key not in data:
+        if value is None:
             print(f"Error: Key '{key}' does not exist in table '{table_name}'.")
             return
+        print(value)
 
-        # Update the entry
-        data[key] = value
+    # Print a key's value and version as JSON [value, version]; [null, 0] if it is absent
+    def get_versioned(self, table_name, key):
+        if self.name is None:
+            print("No database selected. Please switch to a database first.")
+            return
 
-        # Save the updated table data
-        with open(table_path, 'w') as table_file:
-            json.dump(data, table_file)
+        # Check if the table exists
+        if not storage.table_exists(self.name, table_name):
+            print(f"Table '{table_name}' does not exist.")
+            return
 
-        print(f"Updated key '{key}' in table '{table_name}'.")
+        with storage.open_table(self.name, table_name) as table:
+            try:
+                version = table.version(key)
+            except storage.DatabaseError as e:
+                print(e)
+                return
+            value = table.get(key) if version else None
+        print(json.dumps([value, version]))
+
+    # Set key only if it is still at expected_version (0: only if it is
+    # absent). The key keeps its TTL.
+    def cas(self, table_name, key, expected_version, value):
+        if self.name is None:
+            print("No database selected. Please switch to a database first.")
+            return
 
-    @staticmethod
-    def delete_data(table_name, key):
-        global current_db
+        # Check if the table exists
+        if not storage.table_exists(self.name, table_name):
+            print(f"Table '{table_name}' does not exist.")
+            return
 
-        if current_db is None:
+        if not expected_version.isdigit():
+            print("Error: version must be a whole number (0 for an absent key).")
+            return
+        expected = int(expected_version)
+
+        with storage.open_table(self.name, table_name, write=True) as table:
+            try:
+                version = table.version(key)
+            except storage.DatabaseError as e:
+                print(e)
+                return
+            if version != expected:
+                print(f"Error: Conflict: Key '{key}' in table '{table_name}' is at version {version}, not {expected}.")
+                return
+            table.set(key, value, table.expiry(key) if version else None)
+            print(table.version(key))
+
+    def mset(self, table_name, pairs):
+        if self.name is None:
             print("No database selected. Please switch to a database first.")
             return
 
-        table_path = f"databases/{current_db}/{table_name}.json"
+        # Check if the table exists
+        if not storage.table_exists(self.name, table_name):
+            print(f"Table '{table_name}' does not exist.")
+            return
+
+        # Insert or update every pair as one log record
+        with storage.open_table(self.name, table_name, write=True) as table:
+            table.apply_batch([['set', key, value] for key, value in pairs])
+
+        print(f"Set {len(pairs)} keys in table '{table_name}'.")
+
+    def mdel(self, table_name, keys):
+        if self.name is None:
+            print("No database selected. Please switch to a database first.")
+            return
 
         # Check if the table exists
-        if not os.path.exists(table_path):
+        if not storage.table_exists(self.name, table_name):
             print(f"Table '{table_name}' does not exist.")
             return
 
-        # Load the table data
-        with open(table_path, 'r') as table_file:
-            data = json.load(table_file)
+        with storage.open_table(self.name, table_name, write=True) as table:
+            # Check that every key exists, so either all or none are deleted
+            for key in keys:
+                if key not in table:
+                    print(f"Error: Key '{key}' does not exist in table '{table_name}'.")
+                    return
 
-        # Check if the key exists
-        if key not in data:
-            print(f"Error: Key '{key}' does not exist in table '{table_name}'.")
+            # Delete every key as one log record
+            table.apply_batch([['del', key] for key in dict.fromkeys(keys)])
+
+        print(f"Deleted {len(keys)} keys from table '{table_name}'.")
+
+    def import_file(self, table_name, path, fmt, chunk_size):
+        if self.name is None:
+            print("No database selected. Please switch to a database first.")
             return
 
-        # Delete the entry
-        del data[key]
+        # Check if the table exists
+        if not storage.table_exists(self.name, table_name):
+            print(f"Table '{table_name}' does not exist.")
+            return
 
-        # Save the updated table data
-        with open(table_path, 'w') as table_file:
-            json.dump(data, table_file)
+        import importer
 
-        print(f"Deleted key '{key}' from table '{table_name}'.")
+        # Stream the file in chunks, writing one log record per chunk
+        count = 0
+        with storage.open_table(self.name, table_name, write=True) as table:
+            try:
+                for chunk in importer.read_chunks(path, fmt, chunk_size):
+                    table.apply_batch([['set', key, value] for key, value in chunk])
+                    count += len(chunk)
+            except (OSError, ValueError) as e:
+                print(f"Import stopped after {count} rows: {e}")
+                return
 
-    @staticmethod
-    def list_entries(table_name):
-        global current_db
+        print(f"Imported {count} rows into table '{table_name}'.")
 
-        if current_db is None:
+    def create_index(self, table_name, field):
+        if self.name is None:
             print("No database selected. Please switch to a database first.")
             return
 
-        table_path = f"databases/{current_db}/{table_name}.json"
+        # Check if the table exists
+        if not storage.table_exists(self.name, table_name):
+            print(f"Table '{table_name}' does not exist.")
+            return
+
+        # Build the index; it is kept up to date on every later write
+        with storage.open_table(self.name, table_name, write=True) as table:
+            try:
+                created = table.create_index(field)
+            except storage.DatabaseError as e:
+                print(e)
+                return
+            if not created:
+                print(f"Error: Field '{field}' is already indexed in table '{table_name}'.")
+                return
+
+        print(f"Created index on field '{field}' in table '{table_name}'.")
+
+    def find(self, table_name, condition):
+        if self.name is None:
+            print("No database selected. Please switch to a database first.")
+            return
 
         # Check if the table exists
-        if not os.path.exists(table_path):
+        if not storage.table_exists(self.name, table_name):
             print(f"Table '{table_name}' does not exist.")
             return
 
-        # Load the table data
-        with open(table_path, 'r') as table_file:
-            data = json.load(table_file)
+        field, sep, value = condition.partition('=')
+        if not sep:
+            print("Error: The condition must look like field=value.")
+            return
+
+        # Look the value up in the field's index
+        with storage.open_table(self.name, table_name) as table:
+            try:
+                entries = table.find(field, value)
+            except storage.DatabaseError as e:
+                print(e)
+                return
+
+        if not entries:
+            print(f"No entries match '{condition}' in table '{table_name}'.")
+        for key, value in entries:
+            print(f"- {key}: {value}")
+
+    def list_entries(self, table_name):
+        if self.name is None:
+            print("No database selected. Please switch to a database first.")
+            return
+
+        # Check if the table exists
+        if not storage.table_exists(self.name, table_name):
+            print(f"Table '{table_name}' does not exist.")
+            return
+
+        # Load the table data in key order
+        with storage.open_table(self.name, table_name) as table:
+            data = table.scan()
 
         # Print all entries in the table
         print(f"Entries in table '{table_name}':")
-        for key, value in data.items():
+        for key, value in data:
             print(f"- {key}: {value}")
 
+    # Entries in key order, only those starting with prefix and from start
+    # up to (not including) end when given, at most limit of them
+    def scan(self, table_name, prefix=None, start=None, end=None, limit=None):
+        if self.name is None:
+            print("No database selected. Please switch to a database first.")
+            return
+
+        # Check if the table exists
+        if not storage.table_exists(self.name, table_name):
+            print(f"Table '{table_name}' does not exist.")
+            return
+
+        with storage.open_table(self.name, table_name) as table:
+            entries = table.scan(prefix or '', start, end, limit=limit)
+
+        if not entries:
+            print(f"No entries found in table '{table_name}'.")
+        for key, value in entries:
+            print(f"- {key}: {value}")
+
+# Functions to save and restore whole databases (see backup.py)
+def snapshot_db(db_name):
+    import backup
+    try:
+        manifest, copied = backup.create_snapshot(db_name)
+    except storage.DatabaseError as e:
+        print(e)
+        return
+    based = f" (incremental from '{manifest['base']}')" if manifest['base'] is not None else ""
+    print(f"Created snapshot '{manifest['name']}' of database '{db_name}': "
+          f"{len(manifest['tables'])} tables, {copied} bytes copied{based}.")
+
+def restore_db(db_name, snapshot):
+    import backup
+    try:
+        manifest = backup.restore_snapshot(db_name, snapshot)
+    except storage.DatabaseError as e:
+        print(e)
+        return
+    print(f"Restored snapshot '{snapshot}' into database '{db_name}' ({len(manifest['tables'])} tables).")
+
+def list_snapshots(db_name):
+    import backup
+    manifests = backup.list_snapshots(db_name)
+    if not manifests:
+        print("No snapshots found.")
+        return
+    print("Snapshots:")
+    for manifest in manifests:
+        based = f", based on '{manifest['base']}'" if manifest['base'] is not None else ""
+        print(f"- {manifest['name']} (database '{manifest['db']}', {len(manifest['tables'])} tables{based})")
+
+def prune_snapshots(db_name, keep):
+    import backup
+    try:
+        deleted = backup.prune_snapshots(db_name, keep)
+    except storage.DatabaseError as e:
+        print(e)
+        return
+    if not deleted:
+        print(f"No snapshots of database '{db_name}' to delete.")
+        return
+    print(f"Deleted {len(deleted)} snapshots of database '{db_name}': {', '.join(deleted)}.")
+
 # Function to load the currently selected database from the file
 def load_current_db():
-    global current_db
     if os.path.exists(CURRENT_DB_FILE):
         with open(CURRENT_DB_FILE, 'r') as f:
-            current_db = f.read().strip()  # Load the current database name
+            current_db = f.read().strip() or None  # Load the current database name
             print(f"current_db is: {current_db}")
-    else:
-        current_db = None
-
-def main():
-    global current_db
-
-    # Load the current database when the program starts
-    load_current_db()
+            return current_db
+    return None
+
+# argparse type for --ttl
+def positive_seconds(text):
+    import argparse
+    try:
+        seconds = float(text)
+    except ValueError:
+        seconds = None
+    if seconds is None or not 0 < seconds < float('inf'):
+        raise argparse.ArgumentTypeError(f"'{text}' is not a positive number of seconds")
+    return seconds
+
+# Parse a plain single command (fixed positional arguments, no options)
+# without argparse; anything else returns None and goes through the full parser
+def fast_parse(argv):
+    if not argv or argv[0] not in FAST_COMMANDS:
+        return None
+    names = FAST_COMMANDS[argv[0]]
+    values = argv[1:]
+    if len(values) != len(names) or any(value.startswith('-') for value in values):
+        return None
+    return SimpleNamespace(command=argv[0], script=None, **dict(zip(names, values)))
+
+def build_parser():
+    import argparse
+    import importer
 
     parser = argparse.ArgumentParser(description="Key-Value Database CLI")
+    parser.add_argument('--script', metavar='FILE',
+                        help="Run the commands in FILE, one per line, in a single process ('-' for stdin)")
 
     # Add subparsers to handle different commands
     subparsers = parser.add_subparsers(dest="command")
 
+    # Command: shell
+    subparsers.add_parser('shell', help="Run commands interactively, keeping tables loaded between them")
+
     # Command: create-db
     create_db_parser = subparsers.add_parser('create-db', help="Create a new database")
     create_db_parser.add_argument('name', type=str, help="Name of the database to create")
@@ -252,6 +540,13 @@ def main():
     # Command: create-table
     create_table_parser = subparsers.add_parser('create-table', help="Create a new table in the current database")
     create_table_parser.add_argument('name', type=str, help="Name of the table to create")
+    create_table_parser.add_argument('--format', choices=storage.TABLE_FORMATS, default=storage.DEFAULT_FORMAT,
+                                     help="Storage format of the table's log")
+
+    # Command: convert-table
+    convert_table_parser = subparsers.add_parser('convert-table', help="Rewrite a table in another storage format")
+    convert_table_parser.add_argument('table', type=str, help="Table name")
+    convert_table_parser.add_argument('format', choices=storage.TABLE_FORMATS, help="New storage format")
 
     # Command: list-tables
     subparsers.add_parser('list-tables', help="List all tables in the current database")
@@ -261,45 +556,236 @@ def main():
     insert_data_parser.add_argument('table', type=str, help="Table name")
     insert_data_parser.add_argument('key', type=str, help="Key of the entry")
     insert_data_parser.add_argument('value', type=str, help="Value of the entry")
+    insert_data_parser.add_argument('--ttl', type=positive_seconds, metavar='SECONDS',
+                                    help="Delete the entry after this many seconds")
 
     # Command: update-data
     update_data_parser = subparsers.add_parser('update-data', help="Update an entry in a table")
     update_data_parser.add_argument('table', type=str, help="Table name")
     update_data_parser.add_argument('key', type=str, help="Key of the entry")
     update_data_parser.add_argument('value', type=str, help="New value of the entry")
+    update_data_parser.add_argument('--ttl', type=positive_seconds, metavar='SECONDS',
+                                    help="Delete the entry after this many seconds (without it, it never expires)")
 
     # Command: delete-data
     delete_data_parser = subparsers.add_parser('delete-data', help="Delete an entry from a table")
     delete_data_parser.add_argument('table', type=str, help="Table name")
     delete_data_parser.add_argument('key', type=str, help="Key of the entry")
 
+    # Command: get
+    get_parser = subparsers.add_parser('get', help="Print the value of one key")
+    get_parser.add_argument('table', type=str, help="Table name")
+    get_parser.add_argument('key', type=str, help="Key of the entry")
+
+    # Command: get-versioned
+    get_versioned_parser = subparsers.add_parser('get-versioned', help="Print the value and version of one key")
+    get_versioned_parser.add_argument('table', type=str, help="Table name")
+    get_versioned_parser.add_argument('key', type=str, help="Key of the entry")
+
+    # Command: cas
+    cas_parser = subparsers.add_parser('cas', help="Set a key only if it is still at the given version")
+    cas_parser.add_argument('table', type=str, help="Table name")
+    cas_parser.add_argument('key', type=str, help="Key of the entry")
+    cas_parser.add_argument('expected_version', type=str, help="Version the key must be at (0: absent)")
+    cas_parser.add_argument('value', type=str, help="New value of the entry")
+
+    # Command: mset
+    mset_parser = subparsers.add_parser('mset', help="Insert or update many entries at once")
+    mset_parser.add_argument('table', type=str, help="Table name")
+    mset_parser.add_argument('pairs', type=str, nargs='+', help="Keys and values: key1 value1 key2 value2 ...")
+
+    # Command: mdel
+    mdel_parser = subparsers.add_parser('mdel', help="Delete many entries at once")
+    mdel_parser.add_argument('table', type=str, help="Table name")
+    mdel_parser.add_argument('keys', type=str, nargs='+', help="Keys of the entries")
+
+    # Command: import
+    import_parser = subparsers.add_parser('import', help="Load a JSONL or CSV file into a table")
+    import_parser.add_argument('table', type=str, help="Table name")
+    import_parser.add_argument('file', type=str, help="File to import")
+    import_parser.add_argument('--format', choices=importer.FORMATS, help="File format (default: from the extension)")
+    import_parser.add_argument('--chunk-size', type=int, default=importer.DEFAULT_CHUNK_SIZE,
+                               help="Rows written per log record")
+
+    # Command: create-index
+    create_index_parser = subparsers.add_parser('create-index', help="Index a field of JSON document values")
+    create_index_parser.add_argument('table', type=str, help="Table name")
+    create_index_parser.add_argument('field', type=str, help="Field to index (use dots for nested fields)")
+
+    # Command: find
+    find_parser = subparsers.add_parser('find', help="Find documents by an indexed field")
+    find_parser.add_argument('table', type=str, help="Table name")
+    find_parser.add_argument('condition', type=str, help="field=value")
+
+    # Command: scan
+    scan_parser = subparsers.add_parser('scan', help="List entries in key order, optionally by prefix or range")
+    scan_parser.add_argument('table', type=str, help="Table name")
+    scan_parser.add_argument('--prefix', help="Only keys starting with this")
+    scan_parser.add_argument('--start', help="Only keys from this one on")
+    scan_parser.add_argument('--end', help="Only keys before this one")
+    scan_parser.add_argument('--limit', type=int, help="Stop after this many entries")
+
     # Command: list-entries
     list_entries_parser = subparsers.add_parser('list-entries', help="List all entries in a table")
     list_entries_parser.add_argument('table', type=str, help="Table name")
 
-    # Parse the arguments
-    args = parser.parse_args()
+    # Command: snapshot
+    snapshot_parser = subparsers.add_parser('snapshot', help="Save a consistent copy of a database, "
+                                                             "incremental from its last snapshot")
+    snapshot_parser.add_argument('db', type=str, help="Database to save")
+
+    # Command: restore
+    restore_parser = subparsers.add_parser('restore', help="Replace a database's tables with a snapshot's")
+    restore_parser.add_argument('db', type=str, help="Database to restore into (created if missing)")
+    restore_parser.add_argument('snapshot', type=str, help="Snapshot name")
+
+    # Command: list-snapshots
+    list_snapshots_parser = subparsers.add_parser('list-snapshots', help="List saved snapshots")
+    list_snapshots_parser.add_argument('db', type=str, nargs='?', help="Only the snapshots of this database")
+
+    # Command: prune-snapshots
+    prune_snapshots_parser = subparsers.add_parser('prune-snapshots',
+                                                   help="Delete all but the newest snapshots of a database")
+    prune_snapshots_parser.add_argument('db', type=str, help="Database whose snapshots to prune")
+    prune_snapshots_parser.add_argument('keep', type=int, help="Number of snapshots to keep")
 
-    # Handle commands
+    return parser
+
+# Run one parsed command; returns the database to work in from now on
+def run_command(args, current_db, parser):
     if args.command == 'create-db':
         db = Database(args.name)
         db.create()
     elif args.command == 'list-db':
         Database.list_all()
     elif args.command == 'switch-db':
-        Database.switch_db(args.name)
+        current_db = Database(current_db).switch_db(args.name)
     elif args.command == 'create-table':
-        Database.create_table(args.name)
+        Database(current_db).create_table(args.name, getattr(args, 'format', storage.DEFAULT_FORMAT))
+    elif args.command == 'convert-table':
+        Database(current_db).convert_table(args.table, args.format)
     elif args.command == 'list-tables':
-        Database.list_tables()
+        Database(current_db).list_tables()
     elif args.command == 'insert-data':
-        Database.insert_data(args.table, args.key, args.value)
+        Database(current_db).insert_data(args.table, args.key, args.value, getattr(args, 'ttl', None))
     elif args.command == 'update-data':
-        Database.update_data(args.table, args.key, args.value)
+        Database(current_db).update_data(args.table, args.key, args.value, getattr(args, 'ttl', None))
     elif args.command == 'delete-data':
-        Database.delete_data(args.table, args.key)
+        Database(current_db).delete_data(args.table, args.key)
+    elif args.command == 'get':
+        Database(current_db).get_data(args.table, args.key)
+    elif args.command == 'get-versioned':
+        Database(current_db).get_versioned(args.table, args.key)
+    elif args.command == 'cas':
+        Database(current_db).cas(args.table, args.key, args.expected_version, args.value)
+    elif args.command == 'mset':
+        if len(args.pairs) % 2:
+            parser.error("mset needs a value for every key")
+        Database(current_db).mset(args.table, list(zip(args.pairs[::2], args.pairs[1::2])))
+    elif args.command == 'mdel':
+        Database(current_db).mdel(args.table, args.keys)
+    elif args.command == 'import':
+        Database(current_db).import_file(args.table, args.file, args.format, args.chunk_size)
+    elif args.command == 'create-index':
+        Database(current_db).create_index(args.table, args.field)
+    elif args.command == 'find':
+        Database(current_db).find(args.table, args.condition)
+    elif args.command == 'scan':
+        Database(current_db).scan(args.table, args.prefix, args.start, args.end, args.limit)
     elif args.command == 'list-entries':
-        Database.list_entries(args.table)
+        Database(current_db).list_entries(args.table)
+    elif args.command == 'snapshot':
+        snapshot_db(args.db)
+    elif args.command == 'restore':
+        restore_db(args.db, args.snapshot)
+    elif args.command == 'list-snapshots':
+        list_snapshots(args.db)
+    elif args.command == 'prune-snapshots':
+        prune_snapshots(args.db, args.keep)
+    return current_db
+
+# Run many commands in this process, so tables stay loaded between them.
+# Lines come from the prompt (interactive) or a script file; blank lines
+# and lines starting with # are skipped. A bad command is reported and the
+# rest still run.
+def run_lines(lines, current_db, parser, interactive=False):
+    storage.cache.start_flusher()
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if interactive and line in ('exit', 'quit'):
+            break
+        try:
+            argv = shlex.split(line)
+        except ValueError as e:
+            print(f"Line {number}: {e}")
+            continue
+        if argv[0] in ('shell', '--script'):
+            print(f"Line {number}: '{argv[0]}' cannot be nested.")
+            continue
+        # argparse exits on errors and --help; that only ends this command,
+        # as does a failing command, so later lines and pending writes survive
+        try:
+            current_db = run_command(parser.parse_args(argv), current_db, parser)
+        except SystemExit:
+            pass
+        except storage.DatabaseError as e:
+            print(f"Line {number}: {e}")
+    return current_db
+
+def prompt_lines():
+    try:
+        import readline  # gives input() line editing and history
+    except ImportError:
+        pass
+    while True:
+        try:
+            yield input(SHELL_PROMPT)
+        except EOFError:
+            print()
+            return
+        except KeyboardInterrupt:
+            print()
+
+def main():
+    # Load the current database when the program starts
+    current_db = load_current_db()
+
+    argv = sys.argv[1:]
+    args = fast_parse(argv)
+    parser = None
+    if args is None:
+        parser = build_parser()
+        args = parser.parse_args(argv)
+
+    # Tables are opened in shared mode, so this sees the writes of a server
+    # running with --workers (and of other db_cli runs) and they see its own
+    storage.cache = storage.TableCache(shared=True)
+    try:
+        storage.claim_databases(shared=True)
+    except storage.DatabaseError as e:
+        print(e)
+        sys.exit(1)
+
+    try:
+        if args.script is not None:
+            if args.command is not None:
+                parser.error("--script cannot be combined with a command")
+            try:
+                script = sys.stdin if args.script == '-' else open(args.script, 'r', encoding='utf-8')
+            except OSError as e:
+                parser.error(f"Cannot read script: {e}")
+            with script:
+                current_db = run_lines(script, current_db, parser)
+        elif args.command == 'shell':
+            current_db = run_lines(prompt_lines(), current_db, parser, interactive=True)
+        else:
+            current_db = run_command(args, current_db, parser)
+    finally:
+        # Wait for any background compaction and write out and close table
+        # logs, even after an error, so acknowledged writes are not lost
+        storage.close_all()
 
     # Show the current database (if any)
     if current_db:
@@ -309,4 +795,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
@@ -1,13 +1,730 @@
 import socket
 import argparse
+import hashlib
+import heapq
+import json
+import os
+import threading
+import time
+from bisect import bisect
+from concurrent.futures import ThreadPoolExecutor
+import importer
+import protocol
+
+HOST = 'localhost'
+PORT = 5555
+
+# Database the command-line client last switched to; sent on every new connection
+CLIENT_DB_FILE = '.client_db'
+
+# Seconds before a subscription whose connection broke is resumed
+RESUBSCRIBE_DELAY = 1.0
+
+# A connection to the server speaking the framed protocol. Requests are
+# tagged with an id, so many can be in flight at once (pipelining) and
+# responses are matched back to them whatever order they arrive in.
+# The database is selected per connection; passing db selects it up front.
+# db is the one it is on, kept up to date by every switch-db sent on it.
+class Connection:
+    def __init__(self, host=HOST, port=PORT, db=None):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = protocol.FrameReader()
+        self.next_id = 0
+        self.db = None
+        if db is not None:
+            self._handshake(db)
+
+    def _handshake(self, db):
+        status, text = self.request(["switch-db", db])
+        if status == protocol.STATUS_ERROR:
+            self.close()
+            raise ServerError(text)
+
+    def _new_id(self):
+        self.next_id = self.next_id % (2**32 - 1) + 1
+        return self.next_id
+
+    def _receive(self):
+        frame = protocol.recv_frame(self.sock, self.reader)
+        if frame is None:
+            raise ConnectionError("Server closed the connection")
+        request_id, status, payload = frame
+        if request_id == protocol.CONNECTION_ID:
+            raise ConnectionError(payload.decode('utf-8'))
+        return request_id, status, payload.decode('utf-8')
+
+    # Send one command (a list of arguments) and wait for its (status, text)
+    def request(self, args):
+        return self.pipeline([args])[0]
+
+    # Send all commands in one write, then collect the responses in command order
+    def pipeline(self, commands):
+        ids = []
+        frames = []
+        for args in commands:
+            request_id = self._new_id()
+            ids.append(request_id)
+            frames.append(protocol.encode_request(request_id, args))
+        self.sock.sendall(b''.join(frames))
+        responses = {}
+        chunks = {}
+        while len(responses) < len(ids):
+            request_id, status, text = self._receive()
+            if status == protocol.STATUS_PARTIAL:
+                chunks.setdefault(request_id, []).append(text)
+            else:
+                responses[request_id] = (status, ''.join(chunks.pop(request_id, [])) + text)
+        for args, request_id in zip(commands, ids):
+            if args[:1] == ["switch-db"] and len(args) == 2 and responses[request_id][0] == protocol.STATUS_OK:
+                self.db = args[1]
+        return [responses[request_id] for request_id in ids]
+
+    # Send one command and yield (status, text) for each frame of its response as it arrives
+    def stream(self, args):
+        request_id = self._new_id()
+        self.sock.sendall(protocol.encode_request(request_id, args))
+        while True:
+            response_id, status, text = self._receive()
+            yield status, text
+            if status != protocol.STATUS_PARTIAL:
+                return
+
+    def close(self):
+        self.sock.close()
+
+class ServerError(Exception):
+    pass
+
+# A cas or commit lost to a concurrent write; read again and retry
+class ConflictError(ServerError):
+    pass
+
+def _server_error(text):
+    return ConflictError(text) if text.startswith(protocol.CONFLICT_ERROR) else ServerError(text)
+
+# Thread-safe pool of long-lived connections. At most 'size' connections are
+# open at once; callers block until one is free. Every pooled connection is
+# on the pool's db: one handed back on another database is closed.
+class ConnectionPool:
+    def __init__(self, host=HOST, port=PORT, size=8, db=None):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.idle = []
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+
+    # Returns (connection, reused); reused connections may have gone stale
+    def acquire(self):
+        self.slots.acquire()
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        try:
+            return Connection(self.host, self.port, self.db), False
+        except OSError:
+            self.slots.release()
+            raise
+
+    def release(self, connection, broken=False):
+        with self.lock:
+            if not broken and connection.db == self.db:
+                self.idle.append(connection)
+                connection = None
+        if connection is not None:
+            connection.close()
+        self.slots.release()
+
+    # New and idle connections use db from now on; ones in use are closed
+    # when released (see release)
+    def switch_db(self, db):
+        with self.lock:
+            self.db = db
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+    # Run fn(connection), replacing a stale pooled connection once if it fails
+    def run(self, fn):
+        while True:
+            connection, reused = self.acquire()
+            try:
+                result = fn(connection)
+            except OSError:
+                self.release(connection, broken=True)
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                self.release(connection, broken=True)
+                raise
+            self.release(connection)
+            return result
+
+    def close(self):
+        with self.lock:
+            for connection in self.idle:
+                connection.close()
+            self.idle = []
+
+# Extra arguments of insert-data and update-data for an optional ttl
+def _ttl_args(ttl):
+    return () if ttl is None else (repr(float(ttl)),)
+
+# Python API for the database server
+class Client:
+    def __init__(self, host=HOST, port=PORT, pool_size=8, db=None):
+        self.pool = ConnectionPool(host, port, pool_size, db)
+
+    # Run any server command, returning its text or raising ServerError
+    def execute(self, *args):
+        if args[:1] == ("switch-db",) and len(args) == 2:
+            return self.switch_db(args[1])
+        status, text = self.pool.run(lambda connection: connection.request(list(args)))
+        if status == protocol.STATUS_ERROR:
+            raise _server_error(text)
+        return text
+
+    # Run many commands on one connection in a single round trip; returns (status, text) pairs
+    def pipeline(self, commands):
+        return self.pool.run(lambda connection: connection.pipeline(commands))
+
+    # Use another database for all later commands from this client
+    def switch_db(self, name):
+        status, text = self.pool.run(lambda connection: connection.request(["switch-db", name]))
+        if status == protocol.STATUS_ERROR:
+            raise _server_error(text)
+        self.pool.switch_db(name)
+        return text
+
+    def get(self, table, key):
+        return self.execute("get", table, key)
+
+    # With ttl (seconds) the key is deleted once that time has passed
+    def put(self, table, key, value, ttl=None):
+        self.execute("insert-data", table, key, value, *_ttl_args(ttl))
+
+    # Replaces the key's TTL with ttl; without one, the key no longer expires
+    def update(self, table, key, value, ttl=None):
+        self.execute("update-data", table, key, value, *_ttl_args(ttl))
+
+    def delete(self, table, key):
+        self.execute("delete-data", table, key)
+
+    # (value, version) of a key; (None, 0) if it is absent
+    def get_versioned(self, table, key):
+        value, version = json.loads(self.execute("get-versioned", table, key))
+        return value, version
+
+    # Set key only if it is still at expected_version (0: only if it is
+    # absent); returns the new version or raises ConflictError. The key
+    # keeps its TTL.
+    def cas(self, table, key, expected_version, value):
+        return int(self.execute("cas", table, key, str(expected_version), value))
+
+    # Start a transaction on a connection of its own; see Transaction
+    def transaction(self):
+        return Transaction(self.pool)
+
+    # Insert or update many keys atomically; items is a dict or (key, value) pairs
+    def mset(self, table, items):
+        items = items.items() if isinstance(items, dict) else items
+        args = ["mset", table]
+        for key, value in items:
+            args += [key, value]
+        self.execute(*args)
+
+    # Delete many keys atomically
+    def mdel(self, table, keys):
+        self.execute("mdel", table, *keys)
+
+    # Load a JSONL or CSV file, one atomic mset per chunk; returns the number of rows
+    def import_file(self, table, path, fmt=None, chunk_size=importer.DEFAULT_CHUNK_SIZE):
+        count = 0
+        for chunk in importer.read_chunks(path, fmt, chunk_size):
+            self.mset(table, chunk)
+            count += len(chunk)
+        return count
+
+    # Index a field of the table's JSON document values, so find() can use it
+    def create_index(self, table, field):
+        self.execute("create-index", table, field)
+
+    # (key, value) pairs of the documents whose field equals value. Non-string
+    # field values are compared as JSON, e.g. find("users", "age", 30).
+    def find(self, table, field, value):
+        value = value if isinstance(value, str) else json.dumps(value)
+        return [tuple(entry) for entry in json.loads(self.execute("find", table, f"{field}={value}"))]
+
+    # Run a command whose response is streamed, yielding its chunks as they
+    # arrive. The connection is only returned to the pool once fully read.
+    def stream(self, *args):
+        while True:
+            connection, reused = self.pool.acquire()
+            started = finished = False
+            try:
+                for status, text in connection.stream(list(args)):
+                    started = True
+                    if status == protocol.STATUS_ERROR:
+                        finished = True
+                        raise _server_error(text)
+                    if text:
+                        yield text
+                finished = True
+                return
+            except OSError:
+                # A stale pooled connection fails before anything is received
+                if reused and not started:
+                    continue
+                raise
+            finally:
+                self.pool.release(connection, broken=not finished)
+
+    # Yield the changes to a table's keys starting with prefix as they are
+    # applied, as dicts {"seq", "op": "set" or "delete", "key", "value"}
+    # (see replication.changes), each with the "position" to resume after it.
+    # A broken connection is resumed from the last position received; when
+    # the server cannot resume (it restarted, or the subscriber fell too far
+    # behind) ServerError is raised and the table must be read again. The
+    # subscription holds a pooled connection until the generator is closed.
+    def subscribe(self, table, prefix='', position=None):
+        epoch = None
+        while True:
+            args = ["subscribe", table, prefix] + ([position] if position is not None else [])
+            try:
+                for chunk in self.stream(*args):
+                    for line in chunk.splitlines():
+                        change = json.loads(line)
+                        epoch = change.get('epoch', epoch)
+                        position = f"{epoch}:{change['seq']}"
+                        if 'op' in change:
+                            change['position'] = position
+                            yield change
+            except OSError:
+                if position is None:
+                    raise
+                time.sleep(RESUBSCRIBE_DELAY)
+                continue
+            return
+
+    # Lazily iterate over the (key, value) pairs of a table in key order, one page
+    # per request. start is inclusive and end exclusive; both may be combined with prefix.
+    def scan(self, table, prefix=None, start=None, end=None, page_size=1000):
+        args = ["scan", table, f"limit={page_size}"]
+        for name, value in (("prefix", prefix), ("start", start), ("end", end)):
+            if value is not None:
+                args.append(f"{name}={value}")
+        cursor = None
+        while True:
+            page = json.loads(self.execute(*(args if cursor is None else args + [f"cursor={cursor}"])))
+            for key, value in page["entries"]:
+                yield key, value
+            cursor = page["cursor"]
+            if cursor is None:
+                return
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Points each shard gets on the hash ring; more spread keys more evenly
+RING_POINTS = 160
+# Entries per scan page and list-entries chunk, as on the server
+SCAN_PAGE_SIZE = 1000
+
+# Commands a sharded client sends to the shard owning their key (the
+# argument after the table), and ones it runs on every shard
+KEY_COMMANDS = ('insert-data', 'update-data', 'delete-data', 'get', 'get-versioned', 'cas')
+BROADCAST_COMMANDS = ('create-db', 'create-table', 'convert-table', 'create-index')
+
+
+def _ring_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+# Consistent hash ring over shard addresses ("host:port"). Each shard owns the
+# keys hashing up to each of its points, so adding a shard only moves keys
+# onto the new one (about 1/N of them) and leaves the rest where they are.
+class HashRing:
+    def __init__(self, shards, points=RING_POINTS):
+        ring = sorted((_ring_hash(f"{shard}#{i}"), shard) for shard in shards for i in range(points))
+        self.shards = list(shards)
+        self.hashes = [h for h, shard in ring]
+        self.owners = [shard for h, shard in ring]
+
+    def shard_for(self, key):
+        return self.owners[bisect(self.hashes, _ring_hash(key)) % len(self.hashes)]
+
+
+# "host:port" to (host, port)
+def parse_shard(shard):
+    host, sep, port = shard.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError(f"Shard '{shard}' must look like HOST:PORT")
+    return host, int(port)
+
+
+# Client for tables split by key over several servers, each running its own
+# db_server.py. Keys are routed with a HashRing; commands without a key are
+# run on every shard at once and their results merged (scan pages are merged
+# in key order, so paging works as with one server). Each shard applies its
+# part of an mset or mdel atomically, but not all shards together.
+class ShardedClient(Client):
+    def __init__(self, shards, pool_size=8, db=None):
+        self.ring = HashRing(shards)
+        self.clients = {}
+        for shard in self.ring.shards:
+            host, port = parse_shard(shard)
+            self.clients[shard] = Client(host, port, pool_size, db)
+        self.executor = ThreadPoolExecutor(max_workers=len(self.clients))
+
+    def client_for(self, key):
+        return self.clients[self.ring.shard_for(key)]
+
+    # Run fn(client) on every shard in parallel; returns the results in shard order
+    def _each(self, fn, shards=None):
+        shards = self.ring.shards if shards is None else shards
+        futures = [self.executor.submit(fn, self.clients[shard]) for shard in shards]
+        return [future.result() for future in futures]
+
+    def execute(self, *args):
+        command = args[0] if args else None
+        if command in KEY_COMMANDS and len(args) >= 3:
+            return self.client_for(args[2]).execute(*args)
+        if command in BROADCAST_COMMANDS:
+            return self._each(lambda client: client.execute(*args))[0]
+        if command == 'mset' and len(args) >= 4:
+            return self._split(args, 2, f"Set {(len(args) - 2) // 2} keys in table '{args[1]}'.")
+        if command == 'mdel' and len(args) >= 3:
+            return self._split(args, 1, f"Deleted {len(args) - 2} keys from table '{args[1]}'.")
+        if command == 'switch-db' and len(args) == 2:
+            return self.switch_db(args[1])
+        if command == 'scan':
+            return self._scan_page(args)
+        if command == 'list-entries' and len(args) == 2:
+            return ''.join(self.stream(*args))
+        if command == 'find':
+            entries = [entry for text in self._each(lambda client: client.execute(*args)) for entry in json.loads(text)]
+            return json.dumps(sorted(entries))
+        if command == 'stats':
+            return json.dumps({shard: json.loads(text)
+                               for shard, text in zip(self.ring.shards, self._each(lambda client: client.execute(*args)))})
+        # Everything else (list-db, list-tables, table-format, ...) is the same on every shard
+        return self.clients[self.ring.shards[0]].execute(*args)
+
+    # Send each shard its share of the keys (each step long) of an mset or mdel
+    def _split(self, args, step, text):
+        parts = {}
+        for i in range(2, len(args), step):
+            parts.setdefault(self.ring.shard_for(args[i]), []).extend(args[i:i + step])
+        futures = [self.executor.submit(self.clients[shard].execute, args[0], args[1], *part)
+                   for shard, part in parts.items()]
+        for future in futures:
+            future.result()
+        return text
+
+    # One scan page from every shard, merged: the first 'limit' entries in key
+    # order, with a cursor if any shard may have more
+    def _scan_page(self, args):
+        limit = SCAN_PAGE_SIZE
+        for arg in args[2:]:
+            name, sep, value = arg.partition('=')
+            if name == 'limit' and value.isdigit():
+                limit = int(value)
+        pages = [json.loads(text) for text in self._each(lambda client: client.execute(*args))]
+        entries = list(heapq.merge(*[page['entries'] for page in pages]))
+        more = len(entries) > limit or any(page['cursor'] is not None for page in pages)
+        entries = entries[:limit]
+        return json.dumps({"entries": entries, "cursor": entries[-1][0] if more and entries else None})
+
+    # Commands are grouped by shard and pipelined to each; the responses come
+    # back in command order. Commands without a key go to the first shard.
+    def pipeline(self, commands):
+        groups = {}
+        for i, args in enumerate(commands):
+            shard = self.ring.shard_for(args[2]) if args and args[0] in KEY_COMMANDS and len(args) >= 3 \
+                else self.ring.shards[0]
+            groups.setdefault(shard, []).append(i)
+        futures = {shard: self.executor.submit(self.clients[shard].pipeline, [commands[i] for i in indexes])
+                   for shard, indexes in groups.items()}
+        responses = [None] * len(commands)
+        for shard, indexes in groups.items():
+            for i, response in zip(indexes, futures[shard].result()):
+                responses[i] = response
+        return responses
+
+    def switch_db(self, name):
+        return self._each(lambda client: client.switch_db(name))[0]
+
+    # Each shard commits on its own, so a transaction cannot span them
+    def transaction(self):
+        raise ServerError("Error: Transactions are not supported across shards.")
+
+    # list-entries is gathered from every shard in key order; nothing else streams
+    def stream(self, *args):
+        if not args or args[0] != 'list-entries' or len(args) != 2:
+            raise ServerError(f"Error: '{' '.join(args[:1])}' cannot be streamed from a sharded cluster.")
+        table = args[1]
+        page = []
+        first = True
+        for entry in self.scan(table):
+            page.append(entry)
+            if len(page) == SCAN_PAGE_SIZE:
+                yield self._entries_chunk(table, page, first)
+                page = []
+                first = False
+        if page or first:
+            yield self._entries_chunk(table, page, first)
+
+    def _entries_chunk(self, table, page, first):
+        if first and not page:
+            return f"No entries found in table '{table}'."
+        entries = "\n".join([f"- {key}: {value}" for key, value in page])
+        return f"Entries in table '{table}':\n{entries}" if first else f"\n{entries}"
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+        self.executor.shutdown()
+
+
+# A transaction holding one pooled connection from begin until commit or
+# abort. Its reads are checked again at commit, which raises ConflictError
+# if any key read has changed since; the caller can then run it again.
+# As a context manager it commits at the end of the block, or aborts if
+# the block raises. Only get, put, update, delete and cas can be used in it,
+# and not on tables stored as hash, which have no versions.
+class Transaction:
+    def __init__(self, pool):
+        self.pool = pool
+        while True:
+            self.connection, reused = pool.acquire()
+            try:
+                status, text = self.connection.request(["begin"])
+            except OSError:
+                pool.release(self.connection, broken=True)
+                if reused:
+                    continue
+                raise
+            break
+        if status == protocol.STATUS_ERROR:
+            self._end()
+            raise ServerError(text)
+
+    def execute(self, *args):
+        if self.connection is None:
+            raise ServerError("Error: The transaction has already ended.")
+        try:
+            status, text = self.connection.request(list(args))
+        except OSError:
+            self._end(broken=True)
+            raise
+        if status == protocol.STATUS_ERROR:
+            raise _server_error(text)
+        return text
+
+    def get(self, table, key):
+        return self.execute("get", table, key)
+
+    # The version is None for a key this transaction has written
+    def get_versioned(self, table, key):
+        value, version = json.loads(self.execute("get-versioned", table, key))
+        return value, version
+
+    def put(self, table, key, value, ttl=None):
+        self.execute("insert-data", table, key, value, *_ttl_args(ttl))
+
+    # Replaces the key's TTL with ttl; without one, the key no longer expires
+    def update(self, table, key, value, ttl=None):
+        self.execute("update-data", table, key, value, *_ttl_args(ttl))
+
+    def delete(self, table, key):
+        self.execute("delete-data", table, key)
+
+    # Checked now against the version this transaction read, and again at commit
+    def cas(self, table, key, expected_version, value):
+        self.execute("cas", table, key, str(expected_version), value)
+
+    def commit(self):
+        try:
+            self.execute("commit")
+        finally:
+            self._end()
+
+    def abort(self):
+        try:
+            self.execute("abort")
+        finally:
+            self._end()
+
+    def _end(self, broken=False):
+        if self.connection is not None:
+            self.pool.release(self.connection, broken)
+            self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if self.connection is None:
+            return
+        if exc_type is None:
+            self.commit()
+            return
+        try:
+            self.abort()
+        except (OSError, ServerError):
+            pass
+
+
+# Names in a "- name" listing from list-db or list-tables
+def _listed(text):
+    return [line[2:] for line in text.splitlines() if line.startswith('- ')]
+
+
+# Move every key whose owner changes from the old shard list to the new one
+# (e.g. after adding a shard), creating missing databases and tables there
+# first. Each page of moved keys is written to its new shard before being
+# deleted from the old one, so an interrupted run loses nothing and can be
+# rerun. Keys keep the time they have left to live; ones that expire during
+# the move are just deleted. Versions are not carried over: a moved key
+# starts again from its new table's clock, so get-versioned results taken
+# before the move must not be passed to cas after it. Writes should be
+# paused meanwhile. Returns {(db, table): keys moved}.
+def rebalance(old_shards, new_shards, page_size=1000, pool_size=1):
+    ring = HashRing(new_shards)
+    clients = {}
+    for shard in dict.fromkeys(list(old_shards) + list(new_shards)):
+        host, port = parse_shard(shard)
+        clients[shard] = Client(host, port, pool_size)
+    moved = {}
+    try:
+        for db in _listed(clients[old_shards[0]].execute("list-db")):
+            for client in clients.values():
+                try:
+                    client.execute("create-db", db)
+                except ServerError:
+                    pass  # already there
+                client.switch_db(db)
+            for table in _listed(clients[old_shards[0]].execute("list-tables")):
+                # New shards get the table in the same storage format
+                fmt = clients[old_shards[0]].execute("table-format", table)
+                for client in clients.values():
+                    try:
+                        client.execute("create-table", table, fmt)
+                    except ServerError:
+                        pass  # already there
+                count = 0
+                for shard in old_shards:
+                    source = clients[shard]
+                    cursor = None
+                    while True:
+                        args = ["scan", table, f"limit={page_size}", "ttl=1"] + \
+                            ([f"cursor={cursor}"] if cursor is not None else [])
+                        page = json.loads(source.execute(*args))
+                        targets = {}
+                        for key, value, ttl in page["entries"]:
+                            owner = ring.shard_for(key)
+                            if owner != shard:
+                                targets.setdefault(owner, []).append((key, value, ttl))
+                        for owner, items in targets.items():
+                            live = [(key, value, ttl) for key, value, ttl in items if ttl is None or ttl > 0]
+                            if live:
+                                clients[owner].mset(table, [(key, value) for key, value, ttl in live])
+                            # mset cannot set a TTL, so it is set again one key at a time
+                            for key, value, ttl in live:
+                                if ttl is not None:
+                                    clients[owner].update(table, key, value, ttl)
+                            source.mdel(table, [key for key, value, ttl in items])
+                            count += len(items)
+                        cursor = page["cursor"]
+                        if cursor is None:
+                            break
+                moved[(db, table)] = count
+    finally:
+        for client in clients.values():
+            client.close()
+    return moved
 
 # Function to send command to the server
-def send_command(command):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-        client_socket.connect(('localhost', 5555))  # Connect to the server
-        client_socket.send(command.encode('utf-8'))  # Send the command to the server
-        response = client_socket.recv(1024).decode('utf-8')  # Receive response
-        print(response)  # Print the server's response
+def send_command(client, *args):
+    try:
+        print(client.execute(*args))  # Print the server's response
+    except ServerError as e:
+        print(e)
+
+# Function to print a streamed response as it arrives
+def stream_command(client, *args):
+    try:
+        for chunk in client.stream(*args):
+            print(chunk, end='', flush=True)
+        print()
+    except ServerError as e:
+        print(e)
+
+# Print changes as JSON lines until interrupted
+def subscribe(client, table, prefix, position):
+    try:
+        for change in client.subscribe(table, prefix, position):
+            print(json.dumps(change), flush=True)
+    except ServerError as e:
+        print(e)
+    except KeyboardInterrupt:
+        pass
+
+# Function to print the entries of a table page by page
+def scan(client, table, prefix, start, end, page_size):
+    try:
+        for key, value in client.scan(table, prefix, start, end, page_size):
+            print(f"- {key}: {value}")
+    except ServerError as e:
+        print(e)
+
+# Function to print the documents matching field=value
+def find(client, table, condition):
+    try:
+        entries = json.loads(client.execute("find", table, condition))
+    except ServerError as e:
+        print(e)
+        return
+    if not entries:
+        print(f"No entries match '{condition}' in table '{table}'.")
+    for key, value in entries:
+        print(f"- {key}: {value}")
+
+# Each connection selects its own database, so the command-line client
+# remembers the selection and sends it on its next run
+def switch_db(client, name):
+    try:
+        client.switch_db(name)
+    except ServerError as e:
+        print(e)
+        return
+    with open(CLIENT_DB_FILE, 'w') as f:
+        f.write(name)
+    print(f"Switched to database: {name}")
+
+# Function to import a file into a table
+def import_file(client, table, path, fmt, chunk_size):
+    try:
+        count = client.import_file(table, path, fmt, chunk_size)
+    except (OSError, ValueError, ServerError) as e:
+        print(f"Import failed: {e}")
+        return
+    print(f"Imported {count} rows into table '{table}'.")
+
+# Function to load the database the command-line client last switched to
+def load_client_db():
+    if os.path.exists(CLIENT_DB_FILE):
+        with open(CLIENT_DB_FILE, 'r') as f:
+            return f.read().strip() or None
+    return None
 
 # Main function to handle user input
 def main():
@@ -30,6 +747,13 @@ def main():
     # Command for 'create-table'
     create_table_parser = subparsers.add_parser('create-table', help="Create a new table in the current database")
     create_table_parser.add_argument('name', type=str, help="Name of the table to create")
+    # Checked by the server, which knows the formats it supports
+    create_table_parser.add_argument('--format', help="Storage format of the table's log (default: the server's)")
+
+    # Command for 'convert-table'
+    convert_table_parser = subparsers.add_parser('convert-table', help="Rewrite a table in another storage format")
+    convert_table_parser.add_argument('table', type=str, help="Table name")
+    convert_table_parser.add_argument('format', type=str, help="New storage format")
     
     # Command for 'list-tables'
     subparsers.add_parser('list-tables', help="List all tables in the current database")
@@ -39,46 +763,195 @@ def main():
     insert_data_parser.add_argument('table', type=str, help="Table name")
     insert_data_parser.add_argument('key', type=str, help="Key of the entry")
     insert_data_parser.add_argument('value', type=str, help="Value of the entry")
+    insert_data_parser.add_argument('--ttl', type=float, metavar='SECONDS',
+                                    help="Delete the entry after this many seconds")
     
     # Command for 'update-data'
     update_data_parser = subparsers.add_parser('update-data', help="Update an entry in a table")
     update_data_parser.add_argument('table', type=str, help="Table name")
     update_data_parser.add_argument('key', type=str, help="Key of the entry")
     update_data_parser.add_argument('value', type=str, help="New value of the entry")
+    update_data_parser.add_argument('--ttl', type=float, metavar='SECONDS',
+                                    help="Delete the entry after this many seconds (without it, it never expires)")
     
     # Command for 'delete-data'
     delete_data_parser = subparsers.add_parser('delete-data', help="Delete an entry from a table")
     delete_data_parser.add_argument('table', type=str, help="Table name")
     delete_data_parser.add_argument('key', type=str, help="Key of the entry")
     
+    # Command for 'mset'
+    mset_parser = subparsers.add_parser('mset', help="Insert or update many entries at once")
+    mset_parser.add_argument('table', type=str, help="Table name")
+    mset_parser.add_argument('pairs', type=str, nargs='+', help="Keys and values: key1 value1 key2 value2 ...")
+
+    # Command for 'mdel'
+    mdel_parser = subparsers.add_parser('mdel', help="Delete many entries at once")
+    mdel_parser.add_argument('table', type=str, help="Table name")
+    mdel_parser.add_argument('keys', type=str, nargs='+', help="Keys of the entries")
+
+    # Command for 'import'
+    import_parser = subparsers.add_parser('import', help="Load a JSONL or CSV file into a table")
+    import_parser.add_argument('table', type=str, help="Table name")
+    import_parser.add_argument('file', type=str, help="File to import")
+    import_parser.add_argument('--format', choices=importer.FORMATS, help="File format (default: from the extension)")
+    import_parser.add_argument('--chunk-size', type=int, default=importer.DEFAULT_CHUNK_SIZE,
+                               help="Rows sent per request")
+
+    # Command for 'get'
+    get_parser = subparsers.add_parser('get', help="Get the value of a key")
+    get_parser.add_argument('table', type=str, help="Table name")
+    get_parser.add_argument('key', type=str, help="Key of the entry")
+
+    # Command for 'get-versioned'
+    get_versioned_parser = subparsers.add_parser('get-versioned', help="Get the value and version of a key")
+    get_versioned_parser.add_argument('table', type=str, help="Table name")
+    get_versioned_parser.add_argument('key', type=str, help="Key of the entry")
+
+    # Command for 'cas'
+    cas_parser = subparsers.add_parser('cas', help="Set a key only if it is still at the given version")
+    cas_parser.add_argument('table', type=str, help="Table name")
+    cas_parser.add_argument('key', type=str, help="Key of the entry")
+    cas_parser.add_argument('expected_version', type=str, help="Version the key must be at (0: absent)")
+    cas_parser.add_argument('value', type=str, help="New value of the entry")
+
+    # Command for 'scan'
+    scan_parser = subparsers.add_parser('scan', help="List entries in key order, optionally by prefix or range")
+    scan_parser.add_argument('table', type=str, help="Table name")
+    scan_parser.add_argument('--prefix', help="Only keys starting with this")
+    scan_parser.add_argument('--start', help="Only keys from this one on")
+    scan_parser.add_argument('--end', help="Only keys before this one")
+    scan_parser.add_argument('--page-size', type=int, default=1000, help="Entries fetched per request")
+
+    # Command for 'create-index'
+    create_index_parser = subparsers.add_parser('create-index', help="Index a field of JSON document values")
+    create_index_parser.add_argument('table', type=str, help="Table name")
+    create_index_parser.add_argument('field', type=str, help="Field to index (use dots for nested fields)")
+
+    # Command for 'find'
+    find_parser = subparsers.add_parser('find', help="Find documents by an indexed field")
+    find_parser.add_argument('table', type=str, help="Table name")
+    find_parser.add_argument('condition', type=str, help="field=value")
+
     # Command for 'list-entries'
     list_entries_parser = subparsers.add_parser('list-entries', help="List all entries in a table")
     list_entries_parser.add_argument('table', type=str, help="Table name")
 
+    # Command for 'subscribe'
+    subscribe_parser = subparsers.add_parser('subscribe', help="Print changes to a table as they happen")
+    subscribe_parser.add_argument('table', type=str, help="Table name")
+    subscribe_parser.add_argument('--prefix', default='', help="Only keys starting with this")
+    subscribe_parser.add_argument('--position', help="Resume after this position of an earlier subscription")
+
+    # Command for 'snapshot'
+    snapshot_parser = subparsers.add_parser('snapshot', help="Save a consistent copy of a database on the server")
+    snapshot_parser.add_argument('db', type=str, help="Database to save")
+
+    # Command for 'restore'
+    restore_parser = subparsers.add_parser('restore', help="Replace a database's tables with a snapshot's")
+    restore_parser.add_argument('db', type=str, help="Database to restore into (created if missing)")
+    restore_parser.add_argument('snapshot', type=str, help="Snapshot name")
+
+    # Command for 'list-snapshots'
+    list_snapshots_parser = subparsers.add_parser('list-snapshots', help="List the server's snapshots")
+    list_snapshots_parser.add_argument('db', type=str, nargs='?', help="Only the snapshots of this database")
+
+    # Command for 'prune-snapshots'
+    prune_snapshots_parser = subparsers.add_parser('prune-snapshots',
+                                                   help="Delete all but the newest snapshots of a database")
+    prune_snapshots_parser.add_argument('db', type=str, help="Database whose snapshots to prune")
+    prune_snapshots_parser.add_argument('keep', type=int, help="Number of snapshots to keep")
+
+    # Command for 'rebalance'
+    rebalance_parser = subparsers.add_parser('rebalance',
+                                             help="Move keys from the --shards servers to match a new shard list")
+    rebalance_parser.add_argument('new_shards', type=str, help="New shard list: HOST:PORT,HOST:PORT,...")
+
+    parser.add_argument('--host', default=HOST, help="Server host")
+    parser.add_argument('--port', type=int, default=PORT, help="Server port")
+    parser.add_argument('--shards', help="Split keys over these servers instead: HOST:PORT,HOST:PORT,...")
+    parser.add_argument('--db', help="Database to use (defaults to the last one switched to)")
+
     # Parse the arguments
     args = parser.parse_args()
+    shards = args.shards.split(',') if args.shards else None
+    try:
+        for shard in shards or []:
+            parse_shard(shard)
+        if args.command == 'rebalance':
+            if not shards:
+                parser.error("rebalance needs the current shards in --shards")
+            new_shards = args.new_shards.split(',')
+            for shard in new_shards:
+                parse_shard(shard)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.command == 'rebalance':
+        try:
+            moved = rebalance(shards, new_shards)
+        except (OSError, ServerError) as e:
+            print(f"Rebalance failed: {e}")
+            return
+        for (db, table), count in moved.items():
+            print(f"Moved {count} keys of table '{table}' in database '{db}'.")
+        return
+    db = args.db if args.db is not None else load_client_db()
+    if shards:
+        client = ShardedClient(shards, pool_size=1, db=db)
+    else:
+        client = Client(args.host, args.port, pool_size=1, db=db)
 
     # Send the corresponding command to the server based on the input
     if args.command == 'list-db':
-        send_command("list-db")
+        send_command(client, "list-db")
     elif args.command == 'create-db':
-        send_command(f"create-db {args.name}")
+        send_command(client, "create-db", args.name)
     elif args.command == 'switch-db':
-        send_command(f"switch-db {args.name}")
+        switch_db(client, args.name)
     elif args.command == 'create-table':
-        send_command(f"create-table {args.name}")
+        send_command(client, "create-table", args.name, *([args.format] if args.format else []))
+    elif args.command == 'convert-table':
+        send_command(client, "convert-table", args.table, args.format)
     elif args.command == 'list-tables':
-        send_command("list-tables")
+        send_command(client, "list-tables")
     elif args.command == 'insert-data':
-        send_command(f"insert-data {args.table} {args.key} {args.value}")
+        send_command(client, "insert-data", args.table, args.key, args.value, *_ttl_args(args.ttl))
     elif args.command == 'update-data':
-        send_command(f"update-data {args.table} {args.key} {args.value}")
+        send_command(client, "update-data", args.table, args.key, args.value, *_ttl_args(args.ttl))
     elif args.command == 'delete-data':
-        send_command(f"delete-data {args.table} {args.key}")
+        send_command(client, "delete-data", args.table, args.key)
+    elif args.command == 'mset':
+        send_command(client, "mset", args.table, *args.pairs)
+    elif args.command == 'mdel':
+        send_command(client, "mdel", args.table, *args.keys)
+    elif args.command == 'import':
+        import_file(client, args.table, args.file, args.format, args.chunk_size)
+    elif args.command == 'get':
+        send_command(client, "get", args.table, args.key)
+    elif args.command == 'get-versioned':
+        send_command(client, "get-versioned", args.table, args.key)
+    elif args.command == 'cas':
+        send_command(client, "cas", args.table, args.key, args.expected_version, args.value)
+    elif args.command == 'scan':
+        scan(client, args.table, args.prefix, args.start, args.end, args.page_size)
+    elif args.command == 'create-index':
+        send_command(client, "create-index", args.table, args.field)
+    elif args.command == 'find':
+        find(client, args.table, args.condition)
     elif args.command == 'list-entries':
-        send_command(f"list-entries {args.table}")
+        stream_command(client, "list-entries", args.table)
+    elif args.command == 'subscribe':
+        subscribe(client, args.table, args.prefix, args.position)
+    elif args.command == 'snapshot':
+        send_command(client, "snapshot", args.db)
+    elif args.command == 'restore':
+        send_command(client, "restore", args.db, args.snapshot)
+    elif args.command == 'list-snapshots':
+        send_command(client, "list-snapshots", *([args.db] if args.db else []))
+    elif args.command == 'prune-snapshots':
+        send_command(client, "prune-snapshots", args.db, str(args.keep))
     else:
         print("Unknown command")
+    client.close()
 
 if __name__ == "__main__":
     main()
@@ -1,208 +1,1018 @@
 import socket
 import threading
-import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import signal
+import sys
 import os
+import json
+import logging
+import logging.handlers
+import queue
+import time
+from contextlib import ExitStack
+import backup
+import metrics
+import protocol
+import replication
+import storage
+from metrics import server_metrics
+from storage import DatabaseError
 
-# Global variable to store the currently selected database
-current_db = None
+# Database new sessions start in, read from CURRENT_DB_FILE on startup
+default_db = None
 CURRENT_DB_FILE = 'current_db.txt'
 
-# Database class to handle the operations (same as before)
+# "host:port" of the primary when this server is a read-only follower
+replica_of = None
+
+# Set in worker processes of a --workers server; each serves part of the connections
+worker_id = None
+# Seconds before a worker that exited unexpectedly is started again
+WORKER_RESTART_DELAY = 1.0
+
+# Seconds between runs of the reaper deleting expired keys
+DEFAULT_EXPIRE_INTERVAL = 1.0
+
+HOST = 'localhost'
+PORT = 5555
+DEFAULT_BACKLOG = 128
+# Limits for the asyncio server mode
+DEFAULT_MAX_CONNECTIONS = 10000
+DEFAULT_IO_THREADS = 8
+# Subscribe and replicate streams served at once in asyncio mode, each
+# holding a thread of the stream pool for as long as it runs
+DEFAULT_MAX_STREAMS = 64
+
+# Entries per scan page and per streamed list-entries chunk
+SCAN_PAGE_SIZE = 1000
+MAX_SCAN_PAGE_SIZE = 10000
+SCAN_OPTIONS = ('prefix', 'start', 'end', 'cursor', 'limit', 'ttl')
+
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+log = logging.getLogger('db_server')
+
+# Database class to handle the operations. Failures raise DatabaseError,
+# which is sent back to the client as an error response.
 class Database:
     def __init__(self, name):
         self.name = name
         self.path = f"databases/{name}"
 
     def create(self):
-        if not os.path.exists(self.path):
+        # makedirs is atomic, so of several workers creating the same database one wins
+        try:
             os.makedirs(self.path)
-            return f"Database '{self.name}' created successfully."
-        else:
-            return f"Database '{self.name}' already exists."
+        except FileExistsError:
+            raise DatabaseError(f"Database '{self.name}' already exists.")
+        replication.feed.publish(self.name, None, ['create-db'])
+        return f"Database '{self.name}' created successfully."
 
     @staticmethod
     def list_all():
-        if os.path.exists('databases'):
-            databases = [f for f in os.listdir('databases') if os.path.isdir(os.path.join('databases', f))]
-            if databases:
-                print("Available databases:")
-                for db in databases:
-                    print(f"- {db}")
-            else:
-                return "No databases found."
-        else:
-            return "The 'databases' folder does not exist."
+        if not os.path.exists('databases'):
+            raise DatabaseError("The 'databases' folder does not exist.")
+        databases = [f for f in os.listdir('databases') if os.path.isdir(os.path.join('databases', f))]
+        if not databases:
+            return "No databases found."
+        listing = "\n".join([f"- {db}" for db in databases])
+        return f"Available databases:\n{listing}"
 
+    # Select the database for one client session only
     @staticmethod
-    def switch_db(db_name):
-        global current_db
-
+    def switch_db(session, db_name):
         if os.path.exists(f"databases/{db_name}"):
-            current_db = db_name
-            with open(CURRENT_DB_FILE, 'w') as f:
-                f.write(current_db)
-            return f"Switched to database: {current_db}"
+            session.db = db_name
+            return f"Switched to database: {db_name}"
         else:
-            return f"Database '{db_name}' does not exist."
+            raise DatabaseError(f"Database '{db_name}' does not exist.")
 
-    @staticmethod
-    def create_table(table_name):
-        global current_db
-        if current_db is None:
-            return "No database selected. Please switch to a database first."
-        table_path = f"databases/{current_db}/{table_name}.json"
-        if os.path.exists(table_path):
-            return f"Table '{table_name}' already exists in the '{current_db}' database."
-        with open(table_path, 'w') as table_file:
-            json.dump({}, table_file)
-        return f"Table '{table_name}' created successfully in the '{current_db}' database."
+    def _require_db(self):
+        if self.name is None:
+            raise DatabaseError("No database selected. Please switch to a database first.")
 
-    @staticmethod
-    def list_tables():
-        global current_db
-        if current_db is None:
-            return "No database selected. Please switch to a database first."
-        db_path = f"databases/{current_db}"
+    def _require_table(self, table_name):
+        self._require_db()
+        if not storage.table_exists(self.name, table_name):
+            raise DatabaseError(f"Table '{table_name}' does not exist.")
+
+    def create_table(self, table_name, fmt=None):
+        self._require_db()
+        fmt = _check_format(fmt or storage.DEFAULT_FORMAT)
+        # Held until the change is published, so no write to the table can be published before it
+        with storage.lock_table(self.name, table_name):
+            if storage.table_exists(self.name, table_name):
+                raise DatabaseError(f"Table '{table_name}' already exists in the '{self.name}' database.")
+            storage.create_table(self.name, table_name, fmt)
+            replication.feed.publish(self.name, table_name, ['create-table', fmt])
+        return f"Table '{table_name}' created successfully in the '{self.name}' database."
+
+    # Rewrite a table's log in another storage format
+    def convert_table(self, table_name, fmt):
+        self._require_table(table_name)
+        fmt = _check_format(fmt)
+        if not storage.convert_table(self.name, table_name, fmt):
+            return f"Table '{table_name}' is already stored as {fmt}."
+        replication.feed.publish(self.name, table_name, ['convert-table', fmt])
+        return f"Converted table '{table_name}' to {fmt}."
+
+    # The storage format of a table, one of storage.TABLE_FORMATS
+    def table_format(self, table_name):
+        self._require_table(table_name)
+        return storage.table_format(self.name, table_name)
+
+    def list_tables(self):
+        self._require_db()
+        db_path = f"databases/{self.name}"
         if not os.path.exists(db_path):
-            return f"Database '{current_db}' does not exist."
-        tables = [f for f in os.listdir(db_path) if f.endswith('.json')]
+            raise DatabaseError(f"Database '{self.name}' does not exist.")
+        tables = storage.list_tables(self.name)
         if not tables:
-            return f"No tables found in database '{current_db}'."
-        else:
-            print(f"Tables in '{current_db}' database:")
-            for table in tables:
-                # Remove the .json extension to display the table name
-                print(f"- {table[:-5]}")  # Removing the ".json" extension
+            return f"No tables found in database '{self.name}'."
+        listing = "\n".join([f"- {table}" for table in tables])
+        return f"Tables in '{self.name}' database:\n{listing}"
 
-    @staticmethod
-    def insert_data(table_name, key, value):
-        global current_db
-        if current_db is None:
-            return "No database selected. Please switch to a database first."
-        table_path = f"databases/{current_db}/{table_name}.json"
-        if not os.path.exists(table_path):
-            return f"Table '{table_name}' does not exist."
-        with open(table_path, 'r') as table_file:
-            data = json.load(table_file)
-        if key in data:
-            return f"Error: Key '{key}' already exists in table '{table_name}'."
-        data[key] = value
-        with open(table_path, 'w') as table_file:
-            json.dump(data, table_file)
+    # With ttl (seconds) the key is deleted once that time has passed
+    def insert_data(self, table_name, key, value, ttl=None):
+        self._require_table(table_name)
+        expires_at = _expiry_time(ttl)
+        with storage.open_table(self.name, table_name, write=True) as table:
+            if key in table:
+                raise DatabaseError(f"Error: Key '{key}' already exists in table '{table_name}'.")
+            table.set(key, value, expires_at)
         return f"Inserted key '{key}' into table '{table_name}'."
 
-    @staticmethod
-    def update_data(table_name, key, value):
-        global current_db
-        if current_db is None:
-            return "No database selected. Please switch to a database first."
-        table_path = f"databases/{current_db}/{table_name}.json"
-        if not os.path.exists(table_path):
-            return f"Table '{table_name}' does not exist."
-        with open(table_path, 'r') as table_file:
-            data = json.load(table_file)
-        if key not in data:
-            return f"Error: Key '{key}' does not exist in table '{table_name}'."
-        data[key] = value
-        with open(table_path, 'w') as table_file:
-            json.dump(data, table_file)
+    # Replaces the key's TTL: the new ttl, or none without one
+    def update_data(self, table_name, key, value, ttl=None):
+        self._require_table(table_name)
+        expires_at = _expiry_time(ttl)
+        with storage.open_table(self.name, table_name, write=True) as table:
+            if key not in table:
+                raise DatabaseError(f"Error: Key '{key}' does not exist in table '{table_name}'.")
+            table.set(key, value, expires_at)
         return f"Updated key '{key}' in table '{table_name}'."
 
-    @staticmethod
-    def delete_data(table_name, key):
-        global current_db
-        if current_db is None:
-            return "No database selected. Please switch to a database first."
-        table_path = f"databases/{current_db}/{table_name}.json"
-        if not os.path.exists(table_path):
-            return f"Table '{table_name}' does not exist."
-        with open(table_path, 'r') as table_file:
-            data = json.load(table_file)
-        if key not in data:
-            return f"Error: Key '{key}' does not exist in table '{table_name}'."
-        del data[key]
-        with open(table_path, 'w') as table_file:
-            json.dump(data, table_file)
+    def delete_data(self, table_name, key):
+        self._require_table(table_name)
+        with storage.open_table(self.name, table_name, write=True) as table:
+            if key not in table:
+                raise DatabaseError(f"Error: Key '{key}' does not exist in table '{table_name}'.")
+            table.delete(key)
         return f"Deleted key '{key}' from table '{table_name}'."
 
-    @staticmethod
-    def list_entries(table_name):
-        global current_db
-        if current_db is None:
-            return "No database selected. Please switch to a database first."
-        table_path = f"databases/{current_db}/{table_name}.json"
-        if not os.path.exists(table_path):
-            return f"Table '{table_name}' does not exist."
-        with open(table_path, 'r') as table_file:
-            data = json.load(table_file)
-        if not data:
-            return f"No entries found in table '{table_name}'."
-        entries = "\n".join([f"- {key}: {value}" for key, value in data.items()])
-        return f"Entries in table '{table_name}':\n{entries}"
-
-# Function to load the currently selected database from the file
+    # Insert or update many keys in one atomic step; pairs is [(key, value), ...]
+    def mset(self, table_name, pairs):
+        self._require_table(table_name)
+        with storage.open_table(self.name, table_name, write=True) as table:
+            table.apply_batch([['set', key, value] for key, value in pairs])
+        return f"Set {len(pairs)} keys in table '{table_name}'."
+
+    # Delete many keys in one atomic step; nothing is deleted if any key is missing
+    def mdel(self, table_name, keys):
+        self._require_table(table_name)
+        with storage.open_table(self.name, table_name, write=True) as table:
+            missing = [key for key in keys if key not in table]
+            if missing:
+                raise DatabaseError(f"Error: Key '{missing[0]}' does not exist in table '{table_name}'.")
+            table.apply_batch([['del', key] for key in dict.fromkeys(keys)])
+        return f"Deleted {len(keys)} keys from table '{table_name}'."
+
+    def get_data(self, table_name, key):
+        self._require_table(table_name)
+        with storage.open_table(self.name, table_name) as table:
+            value = table.get(key)
+        if value is None:
+            raise DatabaseError(f"Error: Key '{key}' does not exist in table '{table_name}'.")
+        return value
+
+    # A key's value and version as JSON [value, version]; [null, 0] if it is absent
+    def get_versioned(self, table_name, key):
+        self._require_table(table_name)
+        with storage.open_table(self.name, table_name) as table:
+            version = table.version(key)
+            value = table.get(key) if version else None
+        return json.dumps([value, version])
+
+    # Set key only if its version is still expected_version (0: only if the
+    # key is absent); returns the new version. The key keeps its TTL.
+    def cas(self, table_name, key, expected_version, value):
+        self._require_table(table_name)
+        expected = _parse_version(expected_version)
+        with storage.open_table(self.name, table_name, write=True) as table:
+            version = table.version(key)
+            if version != expected:
+                raise DatabaseError(f"{protocol.CONFLICT_ERROR}: Key '{key}' in table '{table_name}' is at version "
+                                    f"{version}, not {expected}.")
+            table.set(key, value, table.expiry(key) if version else None)
+            return str(table.version(key))
+
+    # Maintain a secondary index on a field of the table's JSON document values
+    def create_index(self, table_name, field):
+        self._require_table(table_name)
+        with storage.open_table(self.name, table_name, write=True) as table:
+            if not table.create_index(field):
+                raise DatabaseError(f"Error: Field '{field}' is already indexed in table '{table_name}'.")
+            replication.feed.publish(self.name, table_name, ['create-index', field])
+        return f"Created index on field '{field}' in table '{table_name}'."
+
+    # Documents whose field equals value, as a JSON list of [key, value] pairs
+    def find(self, table_name, condition):
+        self._require_table(table_name)
+        field, sep, value = condition.partition('=')
+        if not sep:
+            raise DatabaseError(f"Usage: {COMMANDS['find']}")
+        with storage.open_table(self.name, table_name) as table:
+            return json.dumps(table.find(field, value))
+
+    # One page of entries in key order, as JSON {"entries": [[key, value], ...], "cursor": ...}.
+    # Pass the returned cursor back to get the next page; it is null after the last one.
+    # With ttl=1 each entry also has the seconds left before it expires (null if it never does).
+    def scan(self, table_name, options):
+        self._require_table(table_name)
+        try:
+            limit = min(int(options.get('limit', SCAN_PAGE_SIZE)), MAX_SCAN_PAGE_SIZE)
+        except ValueError:
+            raise DatabaseError("Error: limit must be a number.")
+        if limit < 1:
+            raise DatabaseError("Error: limit must be at least 1.")
+        if options.get('ttl', '0') not in ('0', '1'):
+            raise DatabaseError("Error: ttl must be 0 or 1.")
+        with storage.open_table(self.name, table_name) as table:
+            entries = table.scan(options.get('prefix', ''), options.get('start'), options.get('end'),
+                                 options.get('cursor'), limit)
+            if options.get('ttl') == '1':
+                now = time.time()
+                entries = [(key, value, _seconds_left(table.expiry(key), now)) for key, value in entries]
+        cursor = entries[-1][0] if len(entries) == limit else None
+        return json.dumps({"entries": entries, "cursor": cursor})
+
+    # Stream the changes to the table's keys starting with prefix as they are
+    # applied (see replication.changes); position ("epoch:seq") resumes after
+    # the last change an earlier subscription received
+    def subscribe(self, table_name, prefix='', position=None):
+        self._require_table(table_name)
+        if worker_id is not None:
+            raise DatabaseError("Error: Servers running several workers cannot stream changes.")
+        if position is not None:
+            epoch, sep, seq = position.rpartition(':')
+            if not sep or not seq.isdigit():
+                raise DatabaseError(f"Error: Invalid position '{position}'. It looks like <epoch>:<seq>.")
+            position = (epoch, int(seq))
+        return replication.changes(replication.feed, self.name, table_name, prefix, position)
+
+    # Streamed in chunks; the table is only locked while each chunk is read
+    def list_entries(self, table_name):
+        self._require_table(table_name)
+        return self._stream_entries(table_name)
+
+    def _stream_entries(self, table_name):
+        after = None
+        while True:
+            with storage.open_table(self.name, table_name) as table:
+                page = table.scan(after=after, limit=SCAN_PAGE_SIZE)
+            if after is None and not page:
+                yield f"No entries found in table '{table_name}'."
+                return
+            entries = "\n".join([f"- {key}: {value}" for key, value in page])
+            yield f"Entries in table '{table_name}':\n{entries}" if after is None else f"\n{entries}"
+            if len(page) < SCAN_PAGE_SIZE:
+                return
+            after = page[-1][0]
+
+# Seconds from now until expires_at, None if it is None
+def _seconds_left(expires_at, now):
+    return None if expires_at is None else round(expires_at - now, 3)
+
+# Expiry time (seconds since the epoch) for a TTL argument in seconds; None without one
+def _expiry_time(ttl):
+    if ttl is None:
+        return None
+    try:
+        seconds = float(ttl)
+    except ValueError:
+        seconds = None
+    if seconds is None or not 0 < seconds < float('inf'):
+        raise DatabaseError("Error: ttl must be a positive number of seconds.")
+    return time.time() + seconds
+
+def _parse_version(text):
+    if not text.isdigit():
+        raise DatabaseError("Error: version must be a whole number (0 for an absent key).")
+    return int(text)
+
+def _check_format(fmt):
+    if fmt not in storage.TABLE_FORMATS:
+        raise DatabaseError(f"Error: Unknown format '{fmt}'. Formats are: {', '.join(storage.TABLE_FORMATS)}")
+    return fmt
+
+# Function to load the default database for new sessions from the file
 def load_current_db():
-    global current_db
+    global default_db
     if os.path.exists(CURRENT_DB_FILE):
         with open(CURRENT_DB_FILE, 'r') as f:
-            current_db = f.read().strip()
-            print(f"current_db is: {current_db}")
+            default_db = f.read().strip() or None
+            log.info("default database is: %s", default_db)
+    else:
+        default_db = None
+
+# State of one client connection. Each session selects its own database,
+# so one client's switch-db never affects another's.
+class Session:
+    def __init__(self, db=None):
+        self.db = db if db is not None else default_db
+        # The open Transaction between begin and commit or abort
+        self.transaction = None
+
+# Commands a session can run while it has a transaction open
+TRANSACTION_COMMANDS = ('get', 'get-versioned', 'insert-data', 'update-data', 'delete-data', 'cas',
+                        'commit', 'abort')
+
+# A session's transaction, from begin to commit. Reads record the version
+# they saw and writes are only buffered. Commit locks every table involved
+# (in name order, so commits cannot deadlock), checks that no key read has
+# changed since, and applies the writes as one batch record per table.
+# Writes needing a key present or absent read it too, so that is checked
+# again at commit. All writes become visible at once, but after a crash
+# those to one table may survive without those to another. Tables stored
+# as hash have no versions, so they cannot take part.
+class Transaction(Database):
+    def __init__(self, name):
+        super().__init__(name)
+        # Version of each key when first read, by (table, key)
+        self.reads = {}
+        # Buffered ['set', ...] or ['del', key] of each key written, by (table, key)
+        self.writes = {}
+
+    # The key's value and version as this transaction sees them. A key it
+    # wrote has its new value and no version (None) until the commit.
+    def _read(self, table_name, key):
+        self._require_table(table_name)
+        op = self.writes.get((table_name, key))
+        if op is not None:
+            return (op[2] if op[0] == 'set' else None), None
+        with storage.open_table(self.name, table_name) as table:
+            if isinstance(table, storage.HashTable):
+                raise DatabaseError(f"Error: Table '{table_name}' is stored as hash, which has no versions, "
+                                    f"so it cannot be used in a transaction.")
+            version = table.version(key)
+            value = table.get(key) if version else None
+        self.reads.setdefault((table_name, key), version)
+        return value, version
+
+    def _write(self, table_name, op):
+        self.writes[(table_name, op[1])] = op
+
+    def get_data(self, table_name, key):
+        value, _ = self._read(table_name, key)
+        if value is None:
+            raise DatabaseError(f"Error: Key '{key}' does not exist in table '{table_name}'.")
+        return value
+
+    def get_versioned(self, table_name, key):
+        return json.dumps(self._read(table_name, key))
+
+    def insert_data(self, table_name, key, value, ttl=None):
+        expires_at = _expiry_time(ttl)
+        if self._read(table_name, key)[0] is not None:
+            raise DatabaseError(f"Error: Key '{key}' already exists in table '{table_name}'.")
+        self._write(table_name, ['set', key, value] if expires_at is None else ['set', key, value, expires_at])
+        return f"Inserted key '{key}' into table '{table_name}' (on commit)."
+
+    def update_data(self, table_name, key, value, ttl=None):
+        expires_at = _expiry_time(ttl)
+        if self._read(table_name, key)[0] is None:
+            raise DatabaseError(f"Error: Key '{key}' does not exist in table '{table_name}'.")
+        self._write(table_name, ['set', key, value] if expires_at is None else ['set', key, value, expires_at])
+        return f"Updated key '{key}' in table '{table_name}' (on commit)."
+
+    def delete_data(self, table_name, key):
+        if self._read(table_name, key)[0] is None:
+            raise DatabaseError(f"Error: Key '{key}' does not exist in table '{table_name}'.")
+        self._write(table_name, ['del', key])
+        return f"Deleted key '{key}' from table '{table_name}' (on commit)."
+
+    def cas(self, table_name, key, expected_version, value):
+        expected = _parse_version(expected_version)
+        _, version = self._read(table_name, key)
+        if version is None:
+            raise DatabaseError(f"Error: Key '{key}' was already written in this transaction.")
+        if version != expected:
+            raise DatabaseError(f"{protocol.CONFLICT_ERROR}: Key '{key}' in table '{table_name}' is at version "
+                                f"{version}, not {expected}.")
+        # The key keeps its TTL; commit checks the key is unchanged, so this is still it then
+        with storage.open_table(self.name, table_name) as table:
+            expires_at = table.expiry(key) if version else None
+        self._write(table_name, ['set', key, value] if expires_at is None else ['set', key, value, expires_at])
+        return f"Set key '{key}' in table '{table_name}' (on commit)."
+
+    # Returns the number of keys written
+    def commit(self):
+        ops = {}
+        for (table_name, key), op in self.writes.items():
+            ops.setdefault(table_name, []).append(op)
+        table_names = sorted({table_name for table_name, _ in self.reads} | set(ops))
+        with ExitStack() as stack:
+            tables = {}
+            for table_name in table_names:
+                self._require_table(table_name)
+                tables[table_name] = stack.enter_context(
+                    storage.open_table(self.name, table_name, write=table_name in ops))
+            for (table_name, key), version in self.reads.items():
+                if tables[table_name].version(key) != version:
+                    raise DatabaseError(f"{protocol.CONFLICT_ERROR}: Key '{key}' in table '{table_name}' changed "
+                                        f"after the transaction read it.")
+            for table_name, table_ops in ops.items():
+                tables[table_name].apply_batch(table_ops)
+        return len(self.writes)
+
+def begin_transaction(session):
+    transaction = Transaction(session.db)
+    transaction._require_db()
+    session.transaction = transaction
+    return "Transaction started."
+
+# The transaction ends either way; after a conflict the client starts it again
+def commit_transaction(session):
+    transaction = session.transaction
+    if transaction is None:
+        raise DatabaseError("Error: No transaction is open. Start one with begin.")
+    session.transaction = None
+    count = transaction.commit()
+    return f"Committed transaction: {count} keys written."
+
+def abort_transaction(session):
+    if session.transaction is None:
+        raise DatabaseError("Error: No transaction is open. Start one with begin.")
+    session.transaction = None
+    return "Transaction aborted."
+
+# Usage of every command; <arg> is required, [arg] is optional and
+# a trailing ... repeats the arguments before it
+COMMANDS = {
+    "create-db": "create-db <name>",
+    "list-db": "list-db",
+    "switch-db": "switch-db <name>",
+    "create-table": "create-table <name> [format]",
+    "convert-table": "convert-table <table> <format>",
+    "list-tables": "list-tables",
+    "table-format": "table-format <table>",
+    "insert-data": "insert-data <table> <key> <value> [ttl]",
+    "update-data": "update-data <table> <key> <value> [ttl]",
+    "delete-data": "delete-data <table> <key>",
+    "mset": "mset <table> <key> <value> ...",
+    "mdel": "mdel <table> <key> ...",
+    "get": "get <table> <key>",
+    "get-versioned": "get-versioned <table> <key>",
+    "cas": "cas <table> <key> <expected_version> <value>",
+    "begin": "begin",
+    "commit": "commit",
+    "abort": "abort",
+    "scan": "scan <table> [option=value] ...",
+    "create-index": "create-index <table> <field>",
+    "find": "find <table> <field=value>",
+    "list-entries": "list-entries <table>",
+    "subscribe": "subscribe <table> [prefix] [position]",
+    "stats": "stats",
+    "replicate": "replicate <epoch> <position>",
+    "snapshot": "snapshot <db>",
+    "restore": "restore <db> <snapshot>",
+    "list-snapshots": "list-snapshots [db]",
+    "prune-snapshots": "prune-snapshots <db> <keep>",
+}
+
+def check_arguments(command_parts):
+    usage = COMMANDS.get(command_parts[0])
+    if usage is None:
+        raise DatabaseError("Unknown command")
+    words = usage.split(' ')[1:]
+    required = len([word for word in words if word.startswith('<')])
+    count = len(command_parts) - 1
+    if words and words[-1] == '...':
+        valid = count >= required
     else:
-        current_db = None
+        valid = required <= count <= len(words)
+    if not valid:
+        raise DatabaseError(f"Usage: {usage}")
 
-# Function to handle each client request
+# Turn ['name=value', ...] arguments into a dict, allowing only the given names
+def parse_options(args, allowed):
+    options = {}
+    for arg in args:
+        name, sep, value = arg.partition('=')
+        if not sep or name not in allowed:
+            raise DatabaseError(f"Error: Unknown option '{arg}'. Options are: {', '.join(allowed)}")
+        options[name] = value
+    return options
+
+# Parse the command and call appropriate method on the Database class
+def execute_command(session, command_parts):
+    check_arguments(command_parts)
+    if replica_of is not None and command_parts[0] in replication.WRITE_COMMANDS:
+        raise DatabaseError(f"Error: This server is a read-only replica of {replica_of}.")
+    if session.transaction is not None and command_parts[0] not in TRANSACTION_COMMANDS:
+        raise DatabaseError(f"Error: '{command_parts[0]}' cannot be used in a transaction. Commit or abort it first.")
+    # Inside a transaction, its reads and writes go through it
+    db = session.transaction if session.transaction is not None else Database(session.db)
+    if command_parts[0] == "create-db":
+        return Database(command_parts[1]).create()
+    elif command_parts[0] == "list-db":
+        return Database.list_all()
+    elif command_parts[0] == "switch-db":
+        return Database.switch_db(session, command_parts[1])
+    elif command_parts[0] == "create-table":
+        return db.create_table(*command_parts[1:])
+    elif command_parts[0] == "convert-table":
+        return db.convert_table(command_parts[1], command_parts[2])
+    elif command_parts[0] == "list-tables":
+        return db.list_tables()
+    elif command_parts[0] == "table-format":
+        return db.table_format(command_parts[1])
+    elif command_parts[0] == "insert-data":
+        return db.insert_data(*command_parts[1:])
+    elif command_parts[0] == "update-data":
+        return db.update_data(*command_parts[1:])
+    elif command_parts[0] == "delete-data":
+        return db.delete_data(command_parts[1], command_parts[2])
+    elif command_parts[0] == "mset":
+        if len(command_parts) % 2:
+            raise DatabaseError(f"Usage: {COMMANDS['mset']}")
+        return db.mset(command_parts[1], list(zip(command_parts[2::2], command_parts[3::2])))
+    elif command_parts[0] == "mdel":
+        return db.mdel(command_parts[1], command_parts[2:])
+    elif command_parts[0] == "get":
+        return db.get_data(command_parts[1], command_parts[2])
+    elif command_parts[0] == "get-versioned":
+        return db.get_versioned(command_parts[1], command_parts[2])
+    elif command_parts[0] == "cas":
+        return db.cas(*command_parts[1:])
+    elif command_parts[0] == "begin":
+        return begin_transaction(session)
+    elif command_parts[0] == "commit":
+        return commit_transaction(session)
+    elif command_parts[0] == "abort":
+        return abort_transaction(session)
+    elif command_parts[0] == "scan":
+        return db.scan(command_parts[1], parse_options(command_parts[2:], SCAN_OPTIONS))
+    elif command_parts[0] == "create-index":
+        return db.create_index(command_parts[1], command_parts[2])
+    elif command_parts[0] == "find":
+        return db.find(command_parts[1], command_parts[2])
+    elif command_parts[0] == "list-entries":
+        return db.list_entries(command_parts[1])
+    elif command_parts[0] == "subscribe":
+        return db.subscribe(*command_parts[1:])
+    elif command_parts[0] == "stats":
+        return server_stats()
+    elif command_parts[0] == "replicate":
+        # Streams changes to a follower server for as long as it stays connected
+        if worker_id is not None:
+            raise DatabaseError("Error: Servers running several workers cannot be replicated from.")
+        try:
+            position = int(command_parts[2])
+        except ValueError:
+            raise DatabaseError(f"Usage: {COMMANDS['replicate']}")
+        return replication.stream(replication.feed, command_parts[1], position)
+    elif command_parts[0] == "snapshot":
+        return snapshot_database(command_parts[1])
+    elif command_parts[0] == "restore":
+        return restore_database(command_parts[1], command_parts[2])
+    elif command_parts[0] == "list-snapshots":
+        return list_snapshots(*command_parts[1:])
+    elif command_parts[0] == "prune-snapshots":
+        try:
+            keep = int(command_parts[2])
+        except ValueError:
+            raise DatabaseError(f"Usage: {COMMANDS['prune-snapshots']}")
+        return prune_snapshots(command_parts[1], keep)
+
+def snapshot_database(db_name):
+    manifest, copied = backup.create_snapshot(db_name)
+    text = f"Created snapshot '{manifest['name']}' of database '{db_name}': " \
+           f"{len(manifest['tables'])} tables, {copied} bytes copied"
+    if manifest['base'] is not None:
+        text += f" (incremental from '{manifest['base']}')"
+    return text + "."
+
+def restore_database(db_name, snapshot):
+    manifest = backup.restore_snapshot(db_name, snapshot)
+    # Followers cannot replay a restore; they copy the whole primary again
+    replication.feed.publish(db_name, None, ['resync'])
+    return f"Restored snapshot '{snapshot}' into database '{db_name}' ({len(manifest['tables'])} tables)."
+
+def list_snapshots(db_name=None):
+    manifests = backup.list_snapshots(db_name)
+    if not manifests:
+        return "No snapshots found."
+    lines = ["Snapshots:"]
+    for manifest in manifests:
+        based = f", based on '{manifest['base']}'" if manifest['base'] is not None else ""
+        lines.append(f"- {manifest['name']} (database '{manifest['db']}', {len(manifest['tables'])} tables{based})")
+    return "\n".join(lines)
+
+def prune_snapshots(db_name, keep):
+    deleted = backup.prune_snapshots(db_name, keep)
+    if not deleted:
+        return f"No snapshots of database '{db_name}' to delete."
+    return f"Deleted {len(deleted)} snapshots of database '{db_name}': {', '.join(deleted)}."
+
+# Server metrics and resident cache statistics as JSON
+def server_stats():
+    stats = server_metrics.snapshot()
+    stats['cache'] = metrics.cache_stats(storage.cache)
+    return json.dumps(stats)
+
+def prometheus_metrics():
+    return server_metrics.prometheus(metrics.cache_stats(storage.cache))
+
+# Delete expired keys in the background, in batches. Reads skip them even
+# before, so this only keeps them from using memory and disk.
+def start_reaper(interval):
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                count = storage.cache.expire_all()
+            except Exception:
+                log.exception("Deleting expired keys failed")
+                continue
+            if count:
+                log.debug("Deleted %d expired keys", count)
+
+    threading.Thread(target=run, daemon=True).start()
+
+# Log records are queued by the calling thread and written to stderr by a
+# background listener, so logging never blocks a request on the terminal
+def setup_logging(level):
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    root = logging.getLogger()
+    # Replaces any handler inherited from a --workers parent process
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+    listener.start()
+    return listener
+
+# Yielded after each streamed chunk so it is sent at once, instead of
+# waiting for SEND_SIZE bytes (a live stream may not produce more for a while)
+FLUSH = b''
+
+# Run one request frame and yield its response frames. Commands returning
+# a generator are streamed: one partial frame per chunk, then an empty OK frame.
+# Each command's latency (until its last frame is produced) goes to server_metrics.
+def process_request(session, request_id, payload):
+    started = time.perf_counter()
+    ok = False
+    # Unknown names and malformed requests are counted together, so clients cannot create metrics at will
+    name = 'unknown'
+    command_parts = None
+    try:
+        command_parts = protocol.decode_request(payload)
+        log.debug("Received command: %s", command_parts)
+        if command_parts[0] in COMMANDS:
+            name = command_parts[0]
+        response = execute_command(session, command_parts)
+        if isinstance(response, str):
+            ok = True
+            yield protocol.encode_response(request_id, response)
+            return
+        for chunk in response:
+            yield protocol.encode_response(request_id, chunk, protocol.STATUS_PARTIAL)
+            yield FLUSH
+        ok = True
+        yield protocol.encode_response(request_id, "")
+    except DatabaseError as e:
+        yield protocol.encode_response(request_id, str(e), protocol.STATUS_ERROR)
+    except protocol.ProtocolError as e:
+        # Only this request is refused; the others in the batch still run
+        yield protocol.encode_response(request_id, f"Error: {e}.", protocol.STATUS_ERROR)
+    except Exception as e:
+        log.exception("Command %s failed", command_parts)
+        yield protocol.encode_response(request_id, f"Internal error: {e}", protocol.STATUS_ERROR)
+    finally:
+        server_metrics.record_command(name, time.perf_counter() - started, ok)
+
+# Response frames for every request that arrived in one read
+def process_batch(session, frames):
+    for request_id, _, payload in frames:
+        yield from process_request(session, request_id, payload)
+
+# Commands whose response streams until the client goes away, waiting on the
+# change feed for up to HEARTBEAT_INTERVAL between chunks
+LONG_STREAMS = ('subscribe', 'replicate')
+
+# True if the request payload (a JSON list) starts with a LONG_STREAMS command.
+# Only its first bytes are looked at, so this is cheap on large requests.
+def is_long_stream(payload):
+    head = bytes(payload[:32]).lstrip(b'[ \t\r\n')
+    return any(head.startswith(f'"{name}"'.encode('ascii')) for name in LONG_STREAMS)
+
+# Response frames for a batch from a connection that may not start a stream,
+# as the server is running as many as it allows; other requests still run
+def refuse_streams(session, frames):
+    for request_id, _, payload in frames:
+        if is_long_stream(payload):
+            yield protocol.encode_response(request_id, "Error: The server is streaming to as many clients as it "
+                                                       "allows. Try again later.", protocol.STATUS_ERROR)
+        else:
+            yield from process_request(session, request_id, payload)
+
+# Pull response frames until about SEND_SIZE bytes are ready or a stream
+# asks for a FLUSH; b'' once done
+def next_output(responses):
+    out = []
+    size = 0
+    for frame in responses:
+        if frame is FLUSH:
+            if out:
+                break
+            continue
+        out.append(frame)
+        size += len(frame)
+        if size >= protocol.SEND_SIZE:
+            break
+    return b''.join(out)
+
+# Function to handle each client connection. A client may pipeline many
+# requests; their responses are sent together in as few writes as possible.
 def handle_client(client_socket):
+    session = Session()
+    reader = protocol.FrameReader()
+    server_metrics.connection_opened()
     try:
         while True:
-            command = client_socket.recv(1024).decode('utf-8')
-            if not command:
+            data = client_socket.recv(protocol.RECV_SIZE)
+            if not data:
                 break
-            print(f"Received command: {command}")
-            command_parts = command.split(' ')
-            # Parse the command and call appropriate method on the Database class
-            if command_parts[0] == "create-db":
-                db = Database(command_parts[1])
-                response = db.create()
-            elif command_parts[0] == "list-db":
-                response = Database.list_all()
-            elif command_parts[0] == "switch-db":
-                response = Database.switch_db(command_parts[1])
-            elif command_parts[0] == "create-table":
-                response = Database.create_table(command_parts[1])
-            elif command_parts[0] == "list-tables":
-                response = Database.list_tables()
-            elif command_parts[0] == "insert-data":
-                response = Database.insert_data(command_parts[1], command_parts[2], command_parts[3])
-            elif command_parts[0] == "update-data":
-                response = Database.update_data(command_parts[1], command_parts[2], command_parts[3])
-            elif command_parts[0] == "delete-data":
-                response = Database.delete_data(command_parts[1], command_parts[2])
-            elif command_parts[0] == "list-entries":
-                response = Database.list_entries(command_parts[1])
-            else:
-                response = "Unknown command"
-            # Send the response to the client
-            client_socket.send(response.encode('utf-8'))
+            server_metrics.received(len(data))
+            reader.feed(data)
+            responses = process_batch(session, reader.frames())
+            output = next_output(responses)
+            while output:
+                client_socket.sendall(output)
+                server_metrics.sent(len(output))
+                output = next_output(responses)
     except Exception as e:
-        print(f"Error: {e}")
+        log.warning("Connection error: %s", e)
     finally:
+        server_metrics.connection_closed()
         client_socket.close()
 
-# Start the server to listen for connections
-def start_server():
+# Start the server to listen for connections, one thread per connection.
+# With reuse_port, other processes can listen on the same port and the
+# kernel spreads new connections over all of them.
+def start_server(host=HOST, port=PORT, backlog=DEFAULT_BACKLOG, reuse_port=False):
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind(('localhost', 5555))
-    server.listen(5)
-    print("Server listening on port 5555...")
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.bind((host, port))
+    server.listen(backlog)
+    log.info("Server listening on port %d...", port)
 
     while True:
         client_socket, addr = server.accept()
-        print(f"New connection from {addr}")
-        client_handler = threading.Thread(target=handle_client, args=(client_socket,))
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        log.debug("New connection from %s", addr)
+        client_handler = threading.Thread(target=handle_client, args=(client_socket,), daemon=True)
         client_handler.start()
 
-# Run the server
-if __name__ == "__main__":
+# Event-loop version of handle_client. Commands still run as blocking
+# Database calls, but on the bounded executor instead of the event loop.
+# A connection that starts a subscribe or replicate stream takes one of the
+# stream_slots and runs on stream_executor from then on, so waiting for
+# changes never ties up the executor; with no slot left, streams are refused.
+async def handle_client_async(reader, writer, executor, stream_executor, stream_slots):
+    loop = asyncio.get_running_loop()
+    session = Session()
+    frame_reader = protocol.FrameReader()
+    streaming = False
+    try:
+        while True:
+            data = await reader.read(protocol.RECV_SIZE)
+            if not data:
+                break
+            server_metrics.received(len(data))
+            frame_reader.feed(data)
+            frames = frame_reader.frames()
+            responses = None
+            if not streaming and any(is_long_stream(payload) for _, _, payload in frames):
+                if stream_slots.locked():
+                    responses = refuse_streams(session, frames)
+                else:
+                    await stream_slots.acquire()
+                    streaming = True
+            if responses is None:
+                responses = process_batch(session, frames)
+            run_on = stream_executor if streaming else executor
+            output = await loop.run_in_executor(run_on, next_output, responses)
+            while output:
+                writer.write(output)
+                server_metrics.sent(len(output))
+                # Backpressure: don't produce more for a client that isn't reading its responses
+                await writer.drain()
+                output = await loop.run_in_executor(run_on, next_output, responses)
+    except Exception as e:
+        log.warning("Connection error: %s", e)
+    finally:
+        writer.close()
+        if streaming:
+            stream_slots.release()
+
+async def serve_async(host, port, backlog, max_connections, io_threads, max_streams=DEFAULT_MAX_STREAMS,
+                      reuse_port=False):
+    executor = ThreadPoolExecutor(max_workers=io_threads)
+    stream_executor = ThreadPoolExecutor(max_workers=max_streams)
+    stream_slots = asyncio.Semaphore(max_streams)
+    active = 0
+
+    async def on_connect(reader, writer):
+        nonlocal active
+        if active >= max_connections:
+            writer.write(protocol.encode_response(protocol.CONNECTION_ID, "Server is at its connection limit", protocol.STATUS_ERROR))
+            writer.close()
+            return
+        active += 1
+        server_metrics.connection_opened()
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            await handle_client_async(reader, writer, executor, stream_executor, stream_slots)
+        finally:
+            active -= 1
+            server_metrics.connection_closed()
+
+    server = await asyncio.start_server(on_connect, host, port, backlog=backlog, reuse_port=reuse_port or None)
+    log.info("Server (asyncio) listening on port %d...", port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        executor.shutdown(wait=True)
+        # Streams never end by themselves; their threads finish their current wait
+        stream_executor.shutdown(wait=False)
+
+# Start the asyncio server: one event loop for all connections
+def start_async_server(host=HOST, port=PORT, backlog=DEFAULT_BACKLOG, max_connections=DEFAULT_MAX_CONNECTIONS,
+                       io_threads=DEFAULT_IO_THREADS, max_streams=DEFAULT_MAX_STREAMS, reuse_port=False):
+    asyncio.run(serve_async(host, port, backlog, max_connections, io_threads, max_streams, reuse_port))
+
+def main():
+    parser = argparse.ArgumentParser(description="Key-Value Database Server")
+    parser.add_argument('--cache-mb', type=int, default=storage.DEFAULT_MEMORY_BUDGET // (1024 * 1024),
+                        help="Memory budget for resident tables, in MB")
+    parser.add_argument('--flush-interval', type=float, default=storage.DEFAULT_FLUSH_INTERVAL,
+                        help="Seconds between write-behind flushes of dirty tables")
+    parser.add_argument('--flush-batch', type=int, default=storage.DEFAULT_FLUSH_BATCH,
+                        help="Flush a table as soon as this many writes are pending")
+    parser.add_argument('--fsync', choices=storage.FSYNC_POLICIES, default=storage.DEFAULT_FSYNC,
+                        help="Fsync the log before acknowledging each write (always), periodically (interval) "
+                             "or leave it to the OS (never)")
+    parser.add_argument('--fsync-interval-ms', type=int, default=int(storage.DEFAULT_FSYNC_INTERVAL * 1000),
+                        help="Milliseconds between fsyncs with --fsync interval")
+    parser.add_argument('--host', default=HOST, help="Address to listen on")
+    parser.add_argument('--port', type=int, default=PORT, help="Port to listen on")
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG, help="Listen backlog")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="Serve all connections from one asyncio event loop instead of a thread each")
+    parser.add_argument('--max-connections', type=int, default=DEFAULT_MAX_CONNECTIONS,
+                        help="Connections above this are refused (asyncio mode)")
+    parser.add_argument('--io-threads', type=int, default=DEFAULT_IO_THREADS,
+                        help="Threads running commands and disk I/O (asyncio mode)")
+    parser.add_argument('--max-streams', type=int, default=DEFAULT_MAX_STREAMS,
+                        help="Subscribe and replicate streams served at once, each on a thread of its own; "
+                             "more are refused (asyncio mode)")
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='INFO',
+                        help="Least severe log messages shown; DEBUG logs every command")
+    parser.add_argument('--metrics-port', type=int,
+                        help="Serve Prometheus metrics over HTTP on this port at /metrics")
+    parser.add_argument('--feed-mb', type=int, default=replication.DEFAULT_BACKLOG_BYTES // (1024 * 1024),
+                        help="Megabytes of recent changes kept while followers or subscribers are connected, "
+                             "so they can catch up without a full copy")
+    parser.add_argument('--replica-of', metavar='HOST:PORT',
+                        help="Run as a read-only follower of the primary server at HOST:PORT")
+    parser.add_argument('--expire-interval', type=float, default=DEFAULT_EXPIRE_INTERVAL,
+                        help="Seconds between deletions of keys whose TTL has passed")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Server processes sharing the port and the tables; with --metrics-port, "
+                             "worker N serves metrics on that port + N")
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.max_streams < 1:
+        parser.error("--max-streams must be at least 1")
+    if args.workers > 1 and args.replica_of:
+        parser.error("--workers cannot be combined with --replica-of")
+    if args.replica_of:
+        primary_host, sep, primary_port = args.replica_of.rpartition(':')
+        if not sep or not primary_port.isdigit():
+            parser.error("--replica-of must look like HOST:PORT")
+    # Workers inherit the shared claim across fork
+    try:
+        storage.claim_databases(shared=args.workers > 1)
+    except DatabaseError as e:
+        parser.exit(1, f"{e}\n")
+    if args.workers > 1:
+        run_workers(args)
+    else:
+        serve(args)
+
+# Fork the worker processes, each a whole server listening on the same port
+# with its own threads and interpreter, and start again any that exits while
+# the server is running. Workers see each other's writes through the shared
+# storage mode (file locks and log catch-up), so any worker can serve any
+# command. Ctrl+C reaches every worker; SIGTERM is passed on to them.
+def run_workers(args):
+    logging.basicConfig(level=args.log_level, format=LOG_FORMAT)
+    workers = {}
+    stopping = False
+
+    def start_worker(number):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                # Undo the parent's handlers, inherited by workers it restarts
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                serve(args, number)
+                code = 0
+            except (KeyboardInterrupt, SystemExit):
+                code = 0
+            except BaseException:
+                log.exception("Worker %d failed", number)
+            finally:
+                os._exit(code)
+        workers[pid] = number
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        if signum == signal.SIGTERM:
+            for pid in workers:
+                os.kill(pid, signal.SIGTERM)
+
+    for number in range(args.workers):
+        start_worker(number)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    log.info("Started %d workers on port %d", args.workers, args.port)
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        number = workers.pop(pid, None)
+        if number is not None and not stopping:
+            log.warning("Worker %d exited with status %d; starting it again",
+                        number, os.waitstatus_to_exitcode(status))
+            time.sleep(WORKER_RESTART_DELAY)
+            start_worker(number)
+
+# Run one server process; worker is its number when started by run_workers
+def serve(args, worker=None):
+    global replica_of, worker_id
+    worker_id = worker
+    listener = setup_logging(args.log_level)
+
+    # Keep tables resident between requests and flush writes in the background
+    storage.cache = storage.TableCache(args.cache_mb * 1024 * 1024, args.flush_interval, args.flush_batch,
+                                       args.fsync, args.fsync_interval_ms / 1000, shared=worker is not None)
+    storage.cache.start_flusher()
+
+    # Every applied mutation goes to the change feed that followers stream from
+    replication.feed.backlog_bytes = args.feed_mb * 1024 * 1024
+    storage.change_hooks.append(replication.feed.publish)
+    if args.replica_of:
+        replica_of = args.replica_of
+        primary_host, _, primary_port = args.replica_of.rpartition(':')
+        replication.Follower(primary_host, int(primary_port), replication.feed).start()
+    else:
+        # A follower gets the primary's deletions of expired keys instead
+        start_reaper(args.expire_interval)
+
+    # Treat SIGTERM like Ctrl+C so dirty tables still get flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if args.metrics_port is not None:
+        metrics_port = args.metrics_port + (worker or 0)
+        metrics.start_http_server(args.host, metrics_port, prometheus_metrics)
+        log.info("Metrics available at http://%s:%d/metrics", args.host, metrics_port)
+
     load_current_db()  # Load the current database on server startup
-    start_server()
+    try:
+        if args.use_async:
+            start_async_server(args.host, args.port, args.backlog, args.max_connections, args.io_threads,
+                               args.max_streams, worker is not None)
+        else:
+            start_server(args.host, args.port, args.backlog, worker is not None)
+    finally:
+        storage.close_all()  # Flush dirty tables on shutdown
+        listener.stop()
 
+# Run the server
+if __name__ == "__main__":
+    main()
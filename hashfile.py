@@ -0,0 +1,228 @@
+import hashlib
+import mmap
+import os
+import struct
+
+# A hash table kept in one file: a header, an open-addressing slot array,
+# then key/value records appended in write order. Only the header and slots
+# are memory-mapped and nothing is read up front; a lookup probes a few
+# slots and reads one record, whatever the size of the table.
+MAGIC = b'KVH1'
+# magic, slot count, live keys, used slots (live or deleted), garbage record bytes
+HEADER = struct.Struct('<4sQQQQ')
+HEADER_SIZE = 64
+# Key hash and record offset; offsets 0 and 1 mark empty and deleted slots
+SLOT = struct.Struct('<QQ')
+EMPTY = 0
+DELETED = 1
+# Key and value lengths in bytes, followed by the key and the value
+RECORD = struct.Struct('<II')
+# Bytes read per record lookup; longer records take a second read
+READ_AHEAD = 512
+
+INITIAL_CAPACITY = 1024
+# The file is rebuilt once this share of slots is used (so probes stay
+# short), or once replaced and deleted records are this share of the data
+MAX_LOAD = 0.7
+MAX_GARBAGE = 0.5
+MIN_GARBAGE_BYTES = 1024 * 1024
+
+
+# Stable across processes, unlike hash()
+def key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+# Smallest power of two that holds count keys at half the maximum load
+def capacity_for(count):
+    capacity = INITIAL_CAPACITY
+    while count > capacity * MAX_LOAD / 2:
+        capacity *= 2
+    return capacity
+
+
+def _fsync_dir(path):
+    fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Write a new file holding the (key, value) byte pairs, which must have
+# distinct keys, and swap it in atomically
+def write_file(path, items, capacity=INITIAL_CAPACITY):
+    tmp_path = path + '.tmp'
+    slots_end = HEADER_SIZE + capacity * SLOT.size
+    mask = capacity - 1
+    count = 0
+    with open(tmp_path, 'w+b') as f:
+        f.truncate(slots_end)
+        slots = mmap.mmap(f.fileno(), slots_end)
+        f.seek(slots_end)
+        offset = slots_end
+        for key, value in items:
+            h = key_hash(key)
+            i = h & mask
+            while SLOT.unpack_from(slots, HEADER_SIZE + i * SLOT.size)[1] != EMPTY:
+                i = (i + 1) & mask
+            SLOT.pack_into(slots, HEADER_SIZE + i * SLOT.size, h, offset)
+            record = RECORD.pack(len(key), len(value)) + key + value
+            f.write(record)
+            offset += len(record)
+            count += 1
+        HEADER.pack_into(slots, 0, MAGIC, capacity, count, count, 0)
+        slots.flush()
+        slots.close()
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(path)
+
+
+# Keys and values are bytes here; the caller encodes them and does the locking.
+# A write appends its record before pointing a slot at it, so a crash can lose
+# recent writes but a lookup never returns a torn record.
+class HashFile:
+    def __init__(self, path):
+        self.path = path
+        self._open()
+
+    def _open(self):
+        self.fd = os.open(self.path, os.O_RDWR)
+        magic, self.capacity, self.count, self.used, self.garbage = \
+            HEADER.unpack(os.pread(self.fd, HEADER.size, 0))
+        if magic != MAGIC:
+            os.close(self.fd)
+            raise ValueError(f"'{self.path}' is not a hash table file")
+        self.slots_end = HEADER_SIZE + self.capacity * SLOT.size
+        self.slots = mmap.mmap(self.fd, self.slots_end)
+        self.end = os.fstat(self.fd).st_size
+
+    def __len__(self):
+        return self.count
+
+    def _read(self, offset, ahead=READ_AHEAD):
+        chunk = os.pread(self.fd, ahead, offset)
+        if len(chunk) < RECORD.size:
+            return None, None
+        key_length, value_length = RECORD.unpack_from(chunk)
+        size = RECORD.size + key_length + value_length
+        if len(chunk) < size:
+            chunk = os.pread(self.fd, size, offset)
+            if len(chunk) < size:
+                return None, None
+        return chunk[RECORD.size:RECORD.size + key_length], chunk[RECORD.size + key_length:size]
+
+    def _key_matches(self, offset, key):
+        chunk = os.pread(self.fd, RECORD.size + len(key), offset)
+        if len(chunk) < RECORD.size:
+            return False
+        return RECORD.unpack_from(chunk)[0] == len(key) and chunk[RECORD.size:] == key
+
+    # Probe for key. Returns the slot position holding it (or the one to
+    # insert it at), the offset of its record (None if absent) and whether
+    # that insert position is a never-used slot.
+    def _probe(self, key, h):
+        mask = self.capacity - 1
+        i = h & mask
+        free = None
+        while True:
+            pos = HEADER_SIZE + i * SLOT.size
+            slot_hash, offset = SLOT.unpack_from(self.slots, pos)
+            if offset == EMPTY:
+                return (pos, None, True) if free is None else (free, None, False)
+            if offset == DELETED:
+                if free is None:
+                    free = pos
+            elif slot_hash == h and self._key_matches(offset, key):
+                return pos, offset, False
+            i = (i + 1) & mask
+
+    def get(self, key):
+        pos, offset, _ = self._probe(key, key_hash(key))
+        if offset is None:
+            return None
+        return self._read(offset)[1]
+
+    def _record_size(self, offset):
+        key_length, value_length = RECORD.unpack(os.pread(self.fd, RECORD.size, offset))
+        return RECORD.size + key_length + value_length
+
+    # Insert or replace key; returns True if it was new
+    def put(self, key, value):
+        h = key_hash(key)
+        pos, old, empty = self._probe(key, h)
+        record = RECORD.pack(len(key), len(value)) + key + value
+        os.pwrite(self.fd, record, self.end)
+        SLOT.pack_into(self.slots, pos, h, self.end)
+        self.end += len(record)
+        if old is None:
+            self.count += 1
+            self.used += empty
+        else:
+            self.garbage += self._record_size(old)
+        self._write_header()
+        self._maybe_rebuild()
+        return old is None
+
+    # Delete key; returns False if it was not there
+    def remove(self, key):
+        pos, old, _ = self._probe(key, key_hash(key))
+        if old is None:
+            return False
+        SLOT.pack_into(self.slots, pos, 0, DELETED)
+        self.count -= 1
+        self.garbage += self._record_size(old)
+        self._write_header()
+        self._maybe_rebuild()
+        return True
+
+    def _write_header(self):
+        HEADER.pack_into(self.slots, 0, MAGIC, self.capacity, self.count, self.used, self.garbage)
+
+    # Live (key, value) pairs in slot order
+    def items(self):
+        for pos in range(HEADER_SIZE, self.slots_end, SLOT.size):
+            offset = SLOT.unpack_from(self.slots, pos)[1]
+            if offset > DELETED:
+                key, value = self._read(offset)
+                if key is not None:
+                    yield key, value
+
+    def _maybe_rebuild(self):
+        if self.used > self.capacity * MAX_LOAD or \
+                (self.garbage > MIN_GARBAGE_BYTES and self.garbage > (self.end - self.slots_end) * MAX_GARBAGE):
+            self.rebuild()
+
+    # Rewrite the file with only live records, dropping deleted slots and
+    # resizing the slot array for the current number of keys
+    def rebuild(self):
+        write_file(self.path, self.items(), capacity_for(self.count))
+        self.close()
+        self._open()
+
+    # Pick up writes made through another HashFile on the same path, such as
+    # one in another process; returns False if the file has been removed
+    def refresh(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        if stat.st_ino != os.fstat(self.fd).st_ino:
+            # Rebuilt elsewhere: map the new file
+            self.close()
+            self._open()
+            return True
+        # The slots are a shared mapping, so only the header fields need rereading
+        magic, self.capacity, self.count, self.used, self.garbage = HEADER.unpack_from(self.slots, 0)
+        self.end = stat.st_size
+        return True
+
+    def sync(self):
+        self.slots.flush()
+        os.fsync(self.fd)
+
+    def close(self):
+        self.slots.close()
+        os.close(self.fd)
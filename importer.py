@@ -0,0 +1,62 @@
+import csv
+import json
+import os
+
+DEFAULT_CHUNK_SIZE = 10000
+FORMATS = ('jsonl', 'csv')
+
+
+def detect_format(path):
+    ext = os.path.splitext(path)[1].lower().lstrip('.')
+    if ext in ('jsonl', 'ndjson'):
+        return 'jsonl'
+    if ext == 'csv':
+        return 'csv'
+    raise ValueError(f"Cannot tell the format of '{path}'; pass jsonl or csv explicitly")
+
+
+# Values are stored as text; anything else in a JSONL file is kept as JSON
+def _as_text(value):
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+# Each line is {"key": ..., "value": ...} or [key, value]
+def _read_jsonl(f):
+    for number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        row = json.loads(line)
+        if isinstance(row, dict) and 'key' in row and 'value' in row:
+            yield str(row['key']), _as_text(row['value'])
+        elif isinstance(row, list) and len(row) == 2:
+            yield str(row[0]), _as_text(row[1])
+        else:
+            raise ValueError(f"Line {number}: expected {{\"key\": ..., \"value\": ...}} or [key, value]")
+
+
+# Each row is key,value; a leading key,value header row is skipped
+def _read_csv(f):
+    for number, row in enumerate(csv.reader(f), 1):
+        if not row:
+            continue
+        if len(row) != 2:
+            raise ValueError(f"Row {number}: expected 2 columns, got {len(row)}")
+        if number == 1 and row == ['key', 'value']:
+            continue
+        yield row[0], row[1]
+
+
+# Stream (key, value) pairs from a JSONL or CSV file in lists of chunk_size
+def read_chunks(path, fmt=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    fmt = fmt or detect_format(path)
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        rows = _read_jsonl(f) if fmt == 'jsonl' else _read_csv(f)
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
@@ -0,0 +1,115 @@
+import json
+from bisect import bisect_left, bisect_right, insort
+
+# Keys per bucket; buckets split at twice this size
+BUCKET_SIZE = 1000
+
+
+# Sorted set of keys kept as a list of sorted buckets, like a two-level
+# B-tree: finding a key is a bisect over the bucket maxima then one inside
+# a bucket, and an insert or delete only shifts one small bucket.
+class SortedKeyIndex:
+    def __init__(self, sorted_keys=()):
+        keys = list(sorted_keys)
+        self.buckets = [keys[i:i + BUCKET_SIZE] for i in range(0, len(keys), BUCKET_SIZE)]
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+        self.count = len(keys)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for bucket in self.buckets:
+            yield from bucket
+
+    def _bucket_for(self, key):
+        return min(bisect_left(self.maxes, key), len(self.buckets) - 1)
+
+    def add(self, key):
+        if not self.buckets:
+            self.buckets.append([key])
+            self.maxes.append(key)
+            self.count = 1
+            return
+        i = self._bucket_for(key)
+        bucket = self.buckets[i]
+        insort(bucket, key)
+        self.maxes[i] = bucket[-1]
+        self.count += 1
+        if len(bucket) > 2 * BUCKET_SIZE:
+            self.buckets[i:i + 1] = [bucket[:BUCKET_SIZE], bucket[BUCKET_SIZE:]]
+            self.maxes[i:i + 1] = [bucket[BUCKET_SIZE - 1], bucket[-1]]
+
+    def remove(self, key):
+        i = self._bucket_for(key)
+        bucket = self.buckets[i]
+        del bucket[bisect_left(bucket, key)]
+        self.count -= 1
+        if bucket:
+            self.maxes[i] = bucket[-1]
+        else:
+            del self.buckets[i]
+            del self.maxes[i]
+
+    # Keys in order starting at lo (just after it if inclusive is false)
+    def iter_from(self, lo=None, inclusive=True):
+        if lo is None:
+            yield from self
+            return
+        i = bisect_left(self.maxes, lo) if inclusive else bisect_right(self.maxes, lo)
+        if i == len(self.buckets):
+            return
+        bucket = self.buckets[i]
+        start = bisect_left(bucket, lo) if inclusive else bisect_right(bucket, lo)
+        yield from bucket[start:]
+        for bucket in self.buckets[i + 1:]:
+            yield from bucket
+
+
+# Parse a value as a JSON document; plain text values are not documents
+def parse_document(value):
+    if not value.startswith('{'):
+        return None
+    try:
+        document = json.loads(value)
+    except ValueError:
+        return None
+    return document if isinstance(document, dict) else None
+
+
+# Field values are matched as text: strings as they are, anything else as JSON
+def field_text(value):
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+# Secondary index on one field of JSON document values, mapping each field
+# value to the set of keys holding it. Dotted fields reach into nested objects.
+class FieldIndex:
+    def __init__(self, field):
+        self.field = field
+        self.path = field.split('.')
+        self.keys = {}
+
+    def _field_value(self, value):
+        document = parse_document(value)
+        for name in self.path:
+            if not isinstance(document, dict) or name not in document:
+                return None
+            document = document[name]
+        return field_text(document)
+
+    def add(self, key, value):
+        field_value = self._field_value(value)
+        if field_value is not None:
+            self.keys.setdefault(field_value, set()).add(key)
+
+    def remove(self, key, value):
+        field_value = self._field_value(value)
+        keys = self.keys.get(field_value)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys[field_value]
+
+    def find(self, field_value):
+        return sorted(self.keys.get(field_value, ()))
@@ -0,0 +1,121 @@
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+
+
+# Many readers or one writer. Waiting writers block new readers, so a
+# steady stream of reads cannot starve a write.
+class ReadWriteLock:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writer or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if not self.readers:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+
+# One ReadWriteLock per (database, table). Reads of a table share its lock,
+# writes hold it exclusively, and different tables never block each other.
+class LockManager:
+    def __init__(self):
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def _get(self, db_name, table_name):
+        with self.lock:
+            lock = self.locks.get((db_name, table_name))
+            if lock is None:
+                lock = self.locks[(db_name, table_name)] = ReadWriteLock()
+            return lock
+
+    @contextmanager
+    def read(self, db_name, table_name):
+        lock = self._get(db_name, table_name)
+        lock.acquire_read()
+        try:
+            yield
+        finally:
+            lock.release_read()
+
+    @contextmanager
+    def write(self, db_name, table_name):
+        lock = self._get(db_name, table_name)
+        lock.acquire_write()
+        try:
+            yield
+        finally:
+            lock.release_write()
+
+
+# Lock shared with other processes through flock() on a lock file, held
+# shared or exclusive. Threads of this process taking it shared share one
+# flock; the caller keeps them from mixing modes (table_locks does that).
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.holders = 0
+        self.lock = threading.Lock()
+
+    # Without blocking, returns False at once if another process holds it
+    # in a conflicting mode
+    def acquire(self, exclusive=False, blocking=True):
+        with self.lock:
+            if not self.holders:
+                if self.fd is None:
+                    self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(self.fd, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) |
+                                (0 if blocking else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    return False
+            self.holders += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.holders -= 1
+            if not self.holders:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def hold(self, exclusive=False):
+        self.acquire(exclusive)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None and not self.holders:
+                os.close(self.fd)
+                self.fd = None
+
+
+table_locks = LockManager()
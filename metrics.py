@@ -0,0 +1,178 @@
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+PERCENTILES = (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+# Fixed-bucket histogram; the caller holds the lock guarding it
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # One count per bound plus the +Inf bucket
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Estimate of the q-quantile: the upper bound of the bucket holding it,
+    # or None if that is the unbounded last bucket
+    def quantile(self, q):
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return self.bounds[i] if i < len(self.bounds) else None
+        return None
+
+
+class CommandStats:
+    def __init__(self):
+        self.errors = 0
+        self.latency = Histogram()
+
+
+# Counters for the whole server: commands with their latencies, bytes
+# received and sent, and connections. Updates take one short lock.
+class ServerMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.active_connections = 0
+        self.total_connections = 0
+
+    def record_command(self, command, seconds, ok=True):
+        with self.lock:
+            stats = self.commands.get(command)
+            if stats is None:
+                stats = self.commands[command] = CommandStats()
+            stats.latency.observe(seconds)
+            if not ok:
+                stats.errors += 1
+
+    def received(self, size):
+        with self.lock:
+            self.bytes_in += size
+
+    def sent(self, size):
+        with self.lock:
+            self.bytes_out += size
+
+    def connection_opened(self):
+        with self.lock:
+            self.active_connections += 1
+            self.total_connections += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.active_connections -= 1
+
+    # Everything as plain data, for the stats command
+    def snapshot(self):
+        with self.lock:
+            commands = {}
+            for command, stats in sorted(self.commands.items()):
+                latency = stats.latency
+                latency_ms = {'mean': round(latency.sum / latency.count * 1000, 3)}
+                for name, q in PERCENTILES:
+                    bound = latency.quantile(q)
+                    latency_ms[name] = None if bound is None else bound * 1000
+                commands[command] = {'count': latency.count, 'errors': stats.errors, 'latency_ms': latency_ms}
+            return {'commands': commands, 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                    'active_connections': self.active_connections, 'total_connections': self.total_connections}
+
+    # Prometheus text exposition of the server metrics and the given cache stats
+    def prometheus(self, cache_stats):
+        lines = []
+
+        # samples are (labels, value) or, for histograms, (suffix, labels, value)
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample in samples:
+                suffix, labels, value = sample if len(sample) == 3 else ('',) + sample
+                label_text = ','.join(f'{key}="{_escape(val)}"' for key, val in labels)
+                lines.append(f"{name}{suffix}{{{label_text}}} {value}" if labels else f"{name}{suffix} {value}")
+
+        with self.lock:
+            commands = sorted(self.commands.items())
+            metric('kv_commands_total', 'counter', "Commands run",
+                   [((('command', command),), stats.latency.count) for command, stats in commands])
+            metric('kv_command_errors_total', 'counter', "Commands that returned an error",
+                   [((('command', command),), stats.errors) for command, stats in commands])
+            samples = []
+            for command, stats in commands:
+                latency = stats.latency
+                cumulative = 0
+                for bound, bucket_count in zip(latency.bounds + ('+Inf',), latency.counts):
+                    cumulative += bucket_count
+                    samples.append(('_bucket', (('command', command), ('le', str(bound))), cumulative))
+                samples.append(('_sum', (('command', command),), latency.sum))
+                samples.append(('_count', (('command', command),), latency.count))
+            metric('kv_command_duration_seconds', 'histogram', "Command latency", samples)
+            metric('kv_received_bytes_total', 'counter', "Bytes received from clients", [((), self.bytes_in)])
+            metric('kv_sent_bytes_total', 'counter', "Bytes sent to clients", [((), self.bytes_out)])
+            metric('kv_active_connections', 'gauge', "Open client connections", [((), self.active_connections)])
+            metric('kv_connections_total', 'counter', "Client connections accepted", [((), self.total_connections)])
+        metric('kv_cache_hits_total', 'counter', "Table opens served by the resident cache",
+               [((), cache_stats['hits'])])
+        metric('kv_cache_misses_total', 'counter', "Table opens that loaded the table", [((), cache_stats['misses'])])
+        metric('kv_storage_background_errors_total', 'counter', "Failed background flush and fsync passes",
+               [((), cache_stats['background_errors'])])
+        tables = cache_stats['tables']
+        metric('kv_table_keys', 'gauge', "Keys in a resident table",
+               [((('db', t['db']), ('table', t['table'])), t['keys']) for t in tables])
+        metric('kv_table_bytes', 'gauge', "Estimated memory of a resident table",
+               [((('db', t['db']), ('table', t['table'])), t['bytes']) for t in tables])
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Serve render() as Prometheus text on GET /metrics from a background thread
+def start_http_server(host, port, render):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Scrapes are not worth a log line each
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Resident cache numbers for stats and /metrics, from a storage.TableCache
+def cache_stats(cache):
+    hits, misses, errors, tables = cache.stats()
+    return {'hits': hits, 'misses': misses, 'background_errors': errors,
+            'hit_rate': round(hits / (hits + misses), 4) if hits + misses else None,
+            'tables': [{'db': db, 'table': table, 'keys': keys, 'bytes': size}
+                       for db, table, keys, size in tables]}
+
+
+server_metrics = ServerMetrics()
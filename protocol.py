@@ -0,0 +1,99 @@
+import json
+import struct
+
+# Every message is a frame: payload length, request id and status, then the payload.
+# Requests carry a JSON list of command arguments, responses carry UTF-8 text.
+HEADER = struct.Struct('!IIB')
+MAX_PAYLOAD = 64 * 1024 * 1024
+RECV_SIZE = 65536
+# Responses are sent once this many bytes are ready
+SEND_SIZE = 65536
+
+# Response statuses (requests are always sent with STATUS_OK). A streamed
+# response is any number of STATUS_PARTIAL frames, then an OK or ERROR frame.
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_PARTIAL = 2
+
+# Request id 0 is never used by clients; the server sends it for connection-level errors
+CONNECTION_ID = 0
+
+# Start of the error text of a cas or commit that lost to a concurrent write;
+# reading the keys again and retrying can succeed
+CONFLICT_ERROR = "Error: Conflict"
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(request_id, payload, status=STATUS_OK):
+    return HEADER.pack(len(payload), request_id, status) + payload
+
+
+def encode_request(request_id, args):
+    return encode_frame(request_id, json.dumps(args).encode('utf-8'))
+
+
+def decode_request(payload):
+    try:
+        args = json.loads(payload)
+    except ValueError:
+        raise ProtocolError("Malformed request")
+    if not isinstance(args, list) or not args or not all(isinstance(arg, str) for arg in args):
+        raise ProtocolError("A request must be a non-empty list of strings")
+    # JSON escapes can spell lone surrogates, which no table can store
+    for arg in args:
+        if not arg.isascii():
+            try:
+                arg.encode('utf-8')
+            except UnicodeEncodeError:
+                raise ProtocolError("Request strings must be valid UTF-8 text")
+    return args
+
+
+def encode_response(request_id, text, status=STATUS_OK):
+    return encode_frame(request_id, text.encode('utf-8'), status)
+
+
+# Splits a byte stream into frames; a single recv may hold many frames or part of one
+class FrameReader:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_frame(self):
+        if len(self.buffer) < HEADER.size:
+            return None
+        length, request_id, status = HEADER.unpack_from(self.buffer)
+        if length > MAX_PAYLOAD:
+            raise ProtocolError(f"Frame of {length} bytes exceeds the {MAX_PAYLOAD} byte limit")
+        end = HEADER.size + length
+        if len(self.buffer) < end:
+            return None
+        payload = bytes(self.buffer[HEADER.size:end])
+        del self.buffer[:end]
+        return request_id, status, payload
+
+    # All complete frames currently buffered
+    def frames(self):
+        frames = []
+        frame = self.next_frame()
+        while frame is not None:
+            frames.append(frame)
+            frame = self.next_frame()
+        return frames
+
+
+# Block until a whole frame is read from the socket; None once the peer closes
+def recv_frame(sock, reader):
+    frame = reader.next_frame()
+    while frame is None:
+        data = sock.recv(RECV_SIZE)
+        if not data:
+            return None
+        reader.feed(data)
+        frame = reader.next_frame()
+    return frame
@@ -0,0 +1,359 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import deque
+import protocol
+import storage
+from db_client import Connection, ServerError
+from storage import DatabaseError
+
+# Bytes of events kept for followers and subscribers that fall behind or
+# reconnect; one further behind gets a full copy (or must read the table again)
+DEFAULT_BACKLOG_BYTES = 64 * 1024 * 1024
+# Rough memory cost of an event on top of its keys and values
+EVENT_OVERHEAD = 100
+# Seconds events are still kept after the last reader left, so it can resume
+READER_LINGER = 10.0
+# Most events and bytes of events sent in one streamed chunk
+CHUNK_EVENTS = 1000
+CHUNK_BYTES = 1024 * 1024
+# An idle stream sends an empty chunk this often, so both ends notice a dead peer
+HEARTBEAT_INTERVAL = 1.0
+# A follower reconnects when the primary has been silent this long
+FOLLOWER_TIMEOUT = 10.0
+RETRY_DELAY = 1.0
+
+# Commands changing data or schema; a follower refuses them
+WRITE_COMMANDS = ('create-db', 'create-table', 'convert-table', 'insert-data', 'update-data', 'delete-data',
+                  'mset', 'mdel', 'create-index', 'restore', 'cas', 'begin', 'commit')
+
+log = logging.getLogger('replication')
+
+
+class FeedGap(DatabaseError):
+    pass
+
+
+# Ordered feed of every change on this server. Storage mutation records
+# arrive through storage.change_hooks; schema changes are published by the
+# commands making them. Events are (seq, db, table, record); the latest
+# ones, up to backlog_bytes of them, are kept in memory for readers
+# (followers and subscribers). With no reader for READER_LINGER seconds
+# nothing is kept, so writes cost no memory when nobody streams them.
+class ChangeFeed:
+    def __init__(self, backlog_bytes=DEFAULT_BACKLOG_BYTES):
+        self.events = deque()
+        # Estimated size of each held event, and their total
+        self.sizes = deque()
+        self.size = 0
+        self.backlog_bytes = backlog_bytes
+        self.readers = 0
+        self.last_reader_left = float('-inf')
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.new_epoch()
+
+    # A reader registers before reading its start position, so every event
+    # after it is kept (within backlog_bytes) until it leaves
+    def add_reader(self):
+        with self.cond:
+            self.readers += 1
+
+    def remove_reader(self):
+        with self.cond:
+            self.readers -= 1
+            if not self.readers:
+                self.last_reader_left = time.monotonic()
+
+    # Sequence numbers only mean something within one epoch; a new one makes followers resync
+    def new_epoch(self):
+        with self.cond:
+            self.epoch = uuid.uuid4().hex
+
+    def publish(self, db_name, table_name, record):
+        with self.cond:
+            self.seq += 1
+            if not self.readers and time.monotonic() - self.last_reader_left > READER_LINGER:
+                if self.events:
+                    self.events.clear()
+                    self.sizes.clear()
+                    self.size = 0
+                return
+            size = _event_size(record)
+            self.events.append((self.seq, db_name, table_name, record))
+            self.sizes.append(size)
+            self.size += size
+            while self.size > self.backlog_bytes and len(self.events) > 1:
+                self.events.popleft()
+                self.size -= self.sizes.popleft()
+            self.cond.notify_all()
+
+    # True if every event after seq in this epoch is still held
+    def covers(self, epoch, seq):
+        with self.cond:
+            first = self.events[0][0] if self.events else self.seq + 1
+            return epoch == self.epoch and first <= seq + 1 and seq <= self.seq
+
+    # Up to limit events after seq, waiting up to timeout for the first one
+    def read_after(self, seq, limit=CHUNK_EVENTS, timeout=HEARTBEAT_INTERVAL):
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq > seq, timeout)
+            newer = self.seq - seq
+            if newer > len(self.events):
+                raise FeedGap("Error: The follower fell too far behind and must resync.")
+            # The newest events are at the right end, where deque indexing is cheap
+            return [self.events[-i] for i in range(newer, max(newer - limit, 0), -1)]
+
+
+def _event_size(record):
+    if record[0] == 'batch':
+        return sum(_event_size(op) for op in record[1])
+    return EVENT_OVERHEAD + sum(len(field) for field in record[1:] if isinstance(field, str))
+
+
+# A full copy of every table for a new or lagging follower: a reset listing
+# all tables, then each table as a load event and batches of its entries.
+# Each table is read under its lock together with the feed position it
+# matches, so the follower skips streamed events for it up to there.
+def snapshot_events(feed):
+    listing = {db_name: storage.list_tables(db_name) for db_name in storage.list_databases()}
+    yield 0, None, None, ['reset', listing]
+    for db_name, table_names in listing.items():
+        for table_name in table_names:
+            with storage.open_table(db_name, table_name) as table:
+                with feed.cond:
+                    seq = feed.seq
+                fmt = storage.table_format(db_name, table_name)
+                indexes = list(table.meta['indexes']) if isinstance(table, storage.Table) else []
+                records = table.set_records()
+            yield seq, db_name, table_name, ['load', fmt, indexes]
+            for i in range(0, len(records), CHUNK_EVENTS):
+                yield seq, db_name, table_name, ['batch', records[i:i + CHUNK_EVENTS]]
+
+
+# A chunk as JSON: {"epoch", "snapshot", "position", "events"}; position is
+# the feed sequence number a follower resumes after once the chunk is applied
+def _encode_chunk(epoch, snapshot, position, encoded_events):
+    return (f'{{"epoch": {json.dumps(epoch)}, "snapshot": {json.dumps(snapshot)}, "position": {position}, '
+            f'"events": [{", ".join(encoded_events)}]}}')
+
+
+# The response stream of 'replicate <epoch> <position>': events after
+# position, or a full copy first if they are no longer all in the feed.
+# It never ends by itself; an idle stream carries heartbeats.
+def stream(feed, epoch, position):
+    feed.add_reader()
+    try:
+        with feed.cond:
+            epoch_now = feed.epoch
+        if not feed.covers(epoch, position):
+            with feed.cond:
+                position = feed.seq
+            for event in snapshot_events(feed):
+                yield _encode_chunk(epoch_now, True, position, [json.dumps(event)])
+        while True:
+            events = feed.read_after(position)
+            encoded = []
+            size = 0
+            for event in events:
+                encoded.append(json.dumps(event))
+                size += len(encoded[-1])
+                if size >= CHUNK_BYTES:
+                    yield _encode_chunk(epoch_now, False, event[0], encoded)
+                    encoded = []
+                    size = 0
+            if events:
+                position = events[-1][0]
+            if encoded or not events:
+                yield _encode_chunk(epoch_now, False, position, encoded)
+    finally:
+        feed.remove_reader()
+
+
+# One change as sent to subscribers, or None for records that change no key
+def _change(seq, op):
+    if op[0] == 'set':
+        change = {'seq': seq, 'op': 'set', 'key': op[1], 'value': op[2]}
+        if len(op) > 3 and op[3] is not None:
+            change['expires_at'] = op[3]
+        return change
+    if op[0] == 'del':
+        return {'seq': seq, 'op': 'delete', 'key': op[1]}
+    return None
+
+
+# The response stream of 'subscribe': the changes to one table's keys
+# starting with prefix, as lines of JSON, from now or after position
+# (epoch, seq) of an earlier subscription. The first line is the position
+# {"epoch", "seq"} it starts after. Then each change is {"seq", "op":
+# "set" or "delete", "key", "value" and, for a key with a TTL, "expires_at"};
+# the changes of one atomic write share a seq. Chunks hold whole lines, up to
+# about CHUNK_BYTES, so a large write may take several. While no
+# change matches, {"seq"} is sent every HEARTBEAT_INTERVAL, so a client can
+# resume from there. Subscribers read the shared feed at their own position
+# and only a chunk at a time is queued for them, so one that stops reading
+# holds up nobody; one that falls behind what the feed keeps is cut off.
+def changes(feed, db_name, table_name, prefix='', position=None):
+    feed.add_reader()
+    try:
+        if position is None:
+            with feed.cond:
+                epoch, seq = feed.epoch, feed.seq
+        else:
+            epoch, seq = position
+            if not feed.covers(epoch, seq):
+                raise DatabaseError(f"Error: Cannot resume after {epoch}:{seq}, those changes are no longer kept. "
+                                    f"Read the table again and subscribe from now.")
+        yield json.dumps({'epoch': epoch, 'seq': seq}) + '\n'
+        last_sent = time.monotonic()
+        while True:
+            try:
+                events = feed.read_after(seq)
+            except FeedGap:
+                raise DatabaseError("Error: The subscriber fell too far behind. Read the table again and subscribe from now.")
+            if feed.epoch != epoch:
+                raise DatabaseError("Error: This server copied its primary again. Read the table again and subscribe from now.")
+            lines = []
+            size = 0
+            for event_seq, event_db, event_table, record in events:
+                if event_db != db_name:
+                    continue
+                if record[0] == 'resync':
+                    raise DatabaseError(f"Error: Database '{db_name}' was restored. "
+                                        f"Read the table again and subscribe from now.")
+                if event_table != table_name:
+                    continue
+                for op in (record[1] if record[0] == 'batch' else [record]):
+                    change = _change(event_seq, op)
+                    if change is not None and change['key'].startswith(prefix):
+                        lines.append(json.dumps(change))
+                        size += len(lines[-1])
+                        if size >= CHUNK_BYTES:
+                            yield '\n'.join(lines) + '\n'
+                            last_sent = time.monotonic()
+                            lines = []
+                            size = 0
+            if events:
+                seq = events[-1][0]
+            if lines:
+                yield '\n'.join(lines) + '\n'
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent >= HEARTBEAT_INTERVAL:
+                yield json.dumps({'seq': seq}) + '\n'
+                last_sent = time.monotonic()
+    finally:
+        feed.remove_reader()
+
+
+# Remove local databases and tables the primary does not have
+def _reset(listing):
+    for db_name in storage.list_databases():
+        tables = listing.get(db_name)
+        for table_name in storage.list_tables(db_name):
+            if tables is None or table_name not in tables:
+                storage.drop_table(db_name, table_name)
+        if tables is None:
+            shutil.rmtree(os.path.join(storage.DATABASES_DIR, db_name), ignore_errors=True)
+    for db_name in listing:
+        os.makedirs(os.path.join(storage.DATABASES_DIR, db_name), exist_ok=True)
+
+
+# Apply one event received from the primary. Schema changes are published
+# to this server's own feed too, so followers can be chained.
+def apply_event(feed, db_name, table_name, record):
+    op = record[0]
+    if op == 'create-db':
+        os.makedirs(os.path.join(storage.DATABASES_DIR, db_name), exist_ok=True)
+    elif op == 'create-table':
+        if not storage.table_exists(db_name, table_name):
+            storage.create_table(db_name, table_name, record[1])
+    elif op == 'create-index':
+        with storage.open_table(db_name, table_name, write=True) as table:
+            table.create_index(record[1])
+    elif op == 'convert-table':
+        storage.convert_table(db_name, table_name, record[1])
+    elif op == 'resync':
+        # The primary changed in a way that is not replayed, such as a restore
+        raise FeedGap(f"The primary replaced database '{db_name}'.")
+    elif op == 'reset':
+        _reset(record[1])
+        feed.new_epoch()
+        return
+    elif op == 'load':
+        if storage.table_exists(db_name, table_name):
+            storage.drop_table(db_name, table_name)
+        storage.create_table(db_name, table_name, record[1])
+        for field in record[2]:
+            with storage.open_table(db_name, table_name, write=True) as table:
+                table.create_index(field)
+        return
+    else:
+        with storage.open_table(db_name, table_name, write=True) as table:
+            table.apply_record(record)
+        return
+    feed.publish(db_name, table_name, record)
+
+
+# Keeps this server a copy of a primary: streams its changes and applies
+# them in order, reconnecting (and resyncing if needed) whenever the stream breaks
+class Follower:
+    def __init__(self, host, port, feed):
+        self.host = host
+        self.port = port
+        self.feed = feed
+        # Primary epoch and position applied so far; '' until a full copy has arrived
+        self.epoch = ''
+        self.position = 0
+        # Streamed events up to these positions are already in the copied tables
+        self.copied_at = {}
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            connection = None
+            try:
+                connection = Connection(self.host, self.port)
+                connection.sock.settimeout(FOLLOWER_TIMEOUT)
+                log.info("Replicating from %s:%d", self.host, self.port)
+                for status, text in connection.stream(['replicate', self.epoch, str(self.position)]):
+                    if status == protocol.STATUS_ERROR:
+                        raise ServerError(text)
+                    if text:
+                        self._apply_chunk(json.loads(text))
+            except (OSError, ValueError, ServerError) as e:
+                log.warning("Replication from %s:%d interrupted: %s", self.host, self.port, e)
+            except FeedGap as e:
+                log.info("Copying the primary again: %s", e)
+                self.epoch = ''
+            except DatabaseError as e:
+                # Local state may no longer match the primary; start over from a full copy
+                log.error("Could not apply a replicated change, resyncing: %s", e)
+                self.epoch = ''
+            finally:
+                if connection is not None:
+                    connection.close()
+            time.sleep(RETRY_DELAY)
+
+    def _apply_chunk(self, chunk):
+        if chunk['snapshot']:
+            for seq, db_name, table_name, record in chunk['events']:
+                if record[0] == 'reset':
+                    self.copied_at = {}
+                elif record[0] == 'load':
+                    self.copied_at[(db_name, table_name)] = seq
+                apply_event(self.feed, db_name, table_name, record)
+        else:
+            for seq, db_name, table_name, record in chunk['events']:
+                if seq > self.copied_at.get((db_name, table_name), 0):
+                    apply_event(self.feed, db_name, table_name, record)
+            self.epoch = chunk['epoch']
+        self.position = chunk['position']
+
+
+feed = ChangeFeed()
@@ -0,0 +1,1278 @@
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import tablecodec
+from hashfile import HashFile, capacity_for, write_file
+from keyindex import FieldIndex, SortedKeyIndex
+from locks import FileLock, table_locks
+
+# Folder holding one sub-folder per database
+DATABASES_DIR = 'databases'
+
+log = logging.getLogger('storage')
+
+# Tables are append-only logs of mutations; '.json' is the old whole-file format
+LOG_EXT = '.log'
+# Encoding of new logs; see tablecodec.FORMATS. Existing logs keep theirs until converted.
+DEFAULT_FORMAT = 'json'
+# Tables in the 'hash' format are a memory-mapped hash file instead of a log
+HASH_FORMAT = 'hash'
+HASH_EXT = '.hash'
+TABLE_FORMATS = tablecodec.FORMATS + (HASH_FORMAT,)
+LEGACY_EXT = '.json'
+# Sorted keys saved next to the log on close, so reopening skips the sort
+INDEX_EXT = '.idx'
+# Table settings, such as the fields with a secondary index
+META_EXT = '.meta'
+# Every file a table may have
+TABLE_EXTS = (LOG_EXT, HASH_EXT, LEGACY_EXT, INDEX_EXT, META_EXT)
+# Held by every process using the databases folder (see claim_databases)
+DATABASES_LOCK = '.lock'
+# Locked by processes sharing the databases folder (see TableCache's shared
+# mode). Kept when the table is dropped, as others may still hold it open.
+LOCK_EXT = '.lock'
+
+# Compact a log once it holds this many records and at least half are stale
+COMPACT_MIN_RECORDS = 1000
+COMPACT_STALE_RATIO = 0.5
+
+# Rough per-entry memory cost on top of the key and value characters
+# (dict slots, the sorted index and the key's version)
+ENTRY_OVERHEAD = 180
+# The same for a key in a hash table's sorted key index
+KEY_OVERHEAD = 60
+
+# Most expired keys deleted per log record by TableCache.expire_all
+DEFAULT_EXPIRE_BATCH = 1000
+
+# Defaults for the resident table cache
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_FLUSH_BATCH = 1000
+
+# When appended records are fsynced: before each write is acknowledged
+# (batched across concurrent writers by group commit), every
+# DEFAULT_FSYNC_INTERVAL seconds, or never (left to the OS)
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+DEFAULT_FSYNC = FSYNC_INTERVAL
+DEFAULT_FSYNC_INTERVAL = 1.0
+
+
+class DatabaseError(Exception):
+    pass
+
+
+# Called as hook(db_name, table_name, record) for every mutation record,
+# under the table's lock and in the order the records are applied
+change_hooks = []
+
+
+def table_path(db_name, table_name, ext=''):
+    return os.path.join(DATABASES_DIR, db_name, table_name + ext)
+
+
+# (db_name, table_name) of a path made by table_path
+def split_table_path(path):
+    return os.path.split(os.path.relpath(path, DATABASES_DIR))
+
+
+def table_exists(db_name, table_name):
+    if cache.contains(db_name, table_name):
+        return True
+    return any(os.path.exists(table_path(db_name, table_name, ext)) for ext in (LOG_EXT, HASH_EXT, LEGACY_EXT))
+
+
+def list_databases():
+    if not os.path.exists(DATABASES_DIR):
+        return []
+    return sorted(f for f in os.listdir(DATABASES_DIR) if os.path.isdir(os.path.join(DATABASES_DIR, f)))
+
+
+# List table names in a database, including legacy tables not yet migrated
+def list_tables(db_name):
+    names = set()
+    for f in os.listdir(os.path.join(DATABASES_DIR, db_name)):
+        name, ext = os.path.splitext(f)
+        if ext in (LOG_EXT, HASH_EXT, LEGACY_EXT):
+            names.add(name)
+    return sorted(names)
+
+
+def create_table(db_name, table_name, fmt=DEFAULT_FORMAT):
+    if fmt == HASH_FORMAT:
+        write_file(table_path(db_name, table_name, HASH_EXT), ())
+        return
+    codec = tablecodec.CODECS[fmt]
+    atomic_write(table_path(db_name, table_name, LOG_EXT), lambda f: f.write(codec.header), 'wb')
+
+
+# Format of a table, or None for a legacy table not yet migrated
+def table_format(db_name, table_name):
+    if os.path.exists(table_path(db_name, table_name, HASH_EXT)):
+        return HASH_FORMAT
+    try:
+        with open(table_path(db_name, table_name, LOG_EXT), 'rb') as f:
+            return tablecodec.detect(f).name
+    except FileNotFoundError:
+        # A legacy table becomes a log in DEFAULT_FORMAT when first opened
+        return DEFAULT_FORMAT if os.path.exists(table_path(db_name, table_name, LEGACY_EXT)) else None
+
+
+# Make a rename or new file in path's folder durable
+def fsync_dir(path):
+    fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Replace a whole file crash-safely: write a temp file, fsync it and rename
+# it over path, so readers and crashes see the old or new contents, never a mix.
+# The temp file is per process, as processes sharing tables may write at once.
+def atomic_write(path, write, mode='w'):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, mode, encoding=None if 'b' in mode else 'utf-8') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(path)
+
+
+# Write a whole table as a fresh log in the codec's format; expires holds
+# the expiry times of keys with a TTL. With versions (and the table's clock)
+# the keys keep their versions: a 'clock' record comes first and every set
+# is ['set', key, value, expiry time or None, version].
+def write_snapshot(f, data, codec, expires=None, versions=None, clock=0):
+    f.write(codec.header)
+    block = [] if versions is None else [['clock', clock]]
+    for key, value in data.items():
+        at = expires.get(key) if expires else None
+        if versions is not None:
+            block.append(['set', key, value, at, versions[key]])
+        else:
+            block.append(['set', key, value] if at is None else ['set', key, value, at])
+        if len(block) >= tablecodec.SNAPSHOT_BLOCK_RECORDS:
+            f.write(codec.encode_block(block))
+            block = []
+    if block:
+        f.write(codec.encode_block(block))
+
+
+# The lowest key a scan can return and whether it is included
+def scan_start(prefix, start, after):
+    lo, inclusive = prefix, True
+    if start is not None and start > lo:
+        lo = start
+    if after is not None and after >= lo:
+        lo, inclusive = after, False
+    return lo, inclusive
+
+
+# Number of key operations in a record, used to tell how stale a log is
+def record_size(record):
+    return len(record[1]) if record[0] == 'batch' else 1
+
+
+# Raise DatabaseError if a key or value of the record cannot be written as
+# UTF-8 (a lone surrogate). Checked before a record is applied: once in
+# memory and pending, it would make every later flush of the table fail.
+def check_record(record):
+    if record[0] == 'batch':
+        for op in record[1]:
+            check_record(op)
+        return
+    for field in record[1:3]:
+        if isinstance(field, str) and not field.isascii() and not tablecodec.is_utf8(field):
+            raise DatabaseError("Error: Keys and values must be valid UTF-8 text.")
+
+
+# A single table: an in-memory index rebuilt from the log on open.
+# Every mutation appends one record; stale records are dropped by compaction.
+# Keys are also kept in a SortedKeyIndex for ordered and range scans.
+# With shared, other processes append to the same log too: catch_up()
+# applies their records, and compaction runs in the writer's call instead of
+# a background thread, as it must hold the table's file lock.
+class Table:
+    def __init__(self, path, flush_batch=1, fsync=DEFAULT_FSYNC, shared=False):
+        self.path = path
+        self.db_name, self.table_name = split_table_path(path)
+        self.log_path = path + LOG_EXT
+        self.index_path = path + INDEX_EXT
+        self.meta_path = path + META_EXT
+        self.codec = None
+        self.data = {}
+        self.index = None
+        self.index_changed = False
+        # Secondary indexes by field name
+        self.field_indexes = {}
+        # Expiry time of every key with a TTL, and a min-heap of (time, key)
+        # to find the due ones. Heap entries of keys set again since are stale
+        # and skipped, as their time no longer matches expires.
+        self.expires = {}
+        self.expiry_heap = []
+        # Optimistic concurrency: every set takes the next value of the clock
+        # as its key's version. Rewritten logs keep both (see write_snapshot).
+        self.versions = {}
+        self.clock = 0
+        self.records = 0
+        self.size_bytes = 0
+        # Inode and length of the log this process has read and written
+        self.log_ino = None
+        self.log_end = 0
+        self.shared = shared
+        self.stale = False
+        # Records to write to the log lazily (write-behind), in order
+        self.pending = []
+        self.flush_batch = flush_batch
+        # Group commit: write_seq counts appended records, synced_seq those known
+        # to be on disk; one fsync advances synced_seq for every waiting writer
+        self.fsync = fsync
+        self.write_seq = 0
+        self.synced_seq = 0
+        self.syncing = False
+        self.sync_cond = threading.Condition()
+        # Number of callers currently using the table; pinned tables are never evicted
+        self.users = 0
+        self.lock = threading.RLock()
+        self.compact_thread = None
+        self.compact_tail = None
+        # After a failed compaction, the record count to reach before trying again
+        self.compact_retry_at = 0
+        self._migrate()
+        self._load()
+        self.index = self._load_index()
+        self.meta_stamp = self._meta_stamp()
+        self.meta = self._load_meta()
+        for field in self.meta['indexes']:
+            self._build_field_index(field)
+        self.log_file = open(self.log_path, 'ab')
+
+    # Convert an old '.json' table into a log the first time it is opened
+    def _migrate(self):
+        legacy_path = self.path + LEGACY_EXT
+        if os.path.exists(self.log_path) or not os.path.exists(legacy_path):
+            return
+        with open(legacy_path, 'r') as table_file:
+            data = json.load(table_file)
+        codec = tablecodec.CODECS[DEFAULT_FORMAT]
+        atomic_write(self.log_path, lambda f: write_snapshot(f, data, codec), 'wb')
+        os.remove(legacy_path)
+
+    # Replay the log into memory
+    def _load(self):
+        with open(self.log_path, 'rb') as f:
+            self.codec = tablecodec.detect(f)
+            self.log_ino = os.fstat(f.fileno()).st_ino
+            self.log_end = len(self.codec.header)
+            self._replay(f)
+        if self.log_end != os.path.getsize(self.log_path):
+            # Drop a torn record left behind by a crash mid-append
+            with open(self.log_path, 'r+b') as f:
+                f.truncate(self.log_end)
+
+    # Apply the records of f from its position on, advancing log_end past them
+    def _replay(self, f):
+        for records, size in self.codec.read_blocks(f):
+            for record in records:
+                self._apply(record)
+                self.records += record_size(record)
+            self.log_end += size
+
+    # Bring the table up to date with the log as other processes left it; the
+    # caller holds the table's file lock. New records are applied, and a log
+    # rewritten elsewhere (compacted or converted) is loaded again. When about
+    # to write, a torn tail from a crashed process is cut off first.
+    # Returns False if the table is no longer stored as a log here.
+    def catch_up(self, write=False):
+        with self.lock:
+            if self.stale:
+                return False
+            try:
+                stat = os.stat(self.log_path)
+            except FileNotFoundError:
+                return False
+            if stat.st_ino != self.log_ino or stat.st_size < self.log_end:
+                self._reload()
+            elif stat.st_size > self.log_end:
+                with open(self.log_path, 'rb') as f:
+                    f.seek(self.log_end)
+                    self._replay(f)
+                self.index_changed = True
+                if write and self.log_end != stat.st_size:
+                    os.truncate(self.log_path, self.log_end)
+            meta_stamp = self._meta_stamp()
+            if meta_stamp != self.meta_stamp:
+                self.meta_stamp = meta_stamp
+                self.meta = self._load_meta()
+                for field in self.meta['indexes']:
+                    if field not in self.field_indexes:
+                        self._build_field_index(field)
+            return True
+
+    def _reload(self):
+        self.data = {}
+        self.expires = {}
+        self.expiry_heap = []
+        self.versions = {}
+        self.clock = 0
+        self.records = 0
+        self.size_bytes = 0
+        self.index = None
+        self.field_indexes = {}
+        self._load()
+        self.index = SortedKeyIndex(sorted(self.data))
+        self.index_changed = True
+        self.meta_stamp = self._meta_stamp()
+        self.meta = self._load_meta()
+        for field in self.meta['indexes']:
+            self._build_field_index(field)
+        self.log_file.close()
+        self.log_file = open(self.log_path, 'ab')
+
+    # The saved index is only used if the log has not changed since it was written
+    def _load_index(self):
+        stat = os.stat(self.log_path)
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = None
+        if saved and saved['log_size'] == stat.st_size and saved['log_mtime_ns'] == stat.st_mtime_ns \
+                and len(saved['keys']) == len(self.data):
+            return SortedKeyIndex(saved['keys'])
+        self.index_changed = True
+        return SortedKeyIndex(sorted(self.data))
+
+    def _save_index(self):
+        if not self.index_changed:
+            return
+        try:
+            stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            return
+        # Only valid for the log as this process last read it, not as other processes left it since
+        if stat.st_ino != self.log_ino or stat.st_size != self.log_end:
+            return
+        saved = {'log_size': stat.st_size, 'log_mtime_ns': stat.st_mtime_ns, 'keys': list(self.index)}
+        atomic_write(self.index_path, lambda f: json.dump(saved, f))
+        self.index_changed = False
+
+    def _meta_stamp(self):
+        try:
+            return os.stat(self.meta_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load_meta(self):
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'indexes': []}
+
+    def _save_meta(self):
+        atomic_write(self.meta_path, lambda f: json.dump(self.meta, f))
+        self.meta_stamp = self._meta_stamp()
+
+    def _build_field_index(self, field):
+        field_index = FieldIndex(field)
+        for key, value in self.data.items():
+            field_index.add(key, value)
+        self.field_indexes[field] = field_index
+
+    # Index a field of the table's JSON document values; returns False if it already is
+    def create_index(self, field):
+        with self.lock:
+            if field in self.field_indexes:
+                return False
+            self._build_field_index(field)
+            self.meta['indexes'].append(field)
+            self._save_meta()
+            return True
+
+    # Keys and values of the documents whose field equals value, answered from the index
+    def find(self, field, value):
+        with self.lock:
+            field_index = self.field_indexes.get(field)
+            if field_index is None:
+                raise DatabaseError(f"Error: No index on field '{field}'. Create one with create-index.")
+            now = time.time()
+            return [(key, self.data[key]) for key in field_index.find(value) if self._live(key, now)]
+
+    # While the log is replayed on open, the indexes are not maintained; they are built afterwards
+    def _apply(self, record):
+        if record[0] == 'set':
+            key, value = record[1], record[2]
+            old = self.data.get(key)
+            if old is None:
+                self.size_bytes += len(key) + ENTRY_OVERHEAD
+                if self.index is not None:
+                    self.index.add(key)
+            else:
+                self.size_bytes -= len(old)
+                for field_index in self.field_indexes.values():
+                    field_index.remove(key, old)
+            self.data[key] = value
+            self.size_bytes += len(value)
+            for field_index in self.field_indexes.values():
+                field_index.add(key, value)
+            if len(record) > 4:
+                self.versions[key] = record[4]
+            else:
+                self.clock += 1
+                self.versions[key] = self.clock
+            if len(record) > 3 and record[3] is not None:
+                self.expires[key] = record[3]
+                heapq.heappush(self.expiry_heap, (record[3], key))
+            elif self.expires:
+                self.expires.pop(key, None)
+        elif record[0] == 'del':
+            if self.expires:
+                self.expires.pop(record[1], None)
+            self.versions.pop(record[1], None)
+            old = self.data.pop(record[1], None)
+            if old is not None:
+                self.size_bytes -= len(record[1]) + len(old) + ENTRY_OVERHEAD
+                if self.index is not None:
+                    self.index.remove(record[1])
+                for field_index in self.field_indexes.values():
+                    field_index.remove(record[1], old)
+        elif record[0] == 'batch':
+            for op in record[1]:
+                self._apply(op)
+        elif record[0] == 'clock':
+            self.clock = record[1]
+
+    # Keys past their expiry time are treated as gone until the reaper deletes them
+    def _live(self, key, now=None):
+        at = self.expires.get(key)
+        return at is None or at > (time.time() if now is None else now)
+
+    def __contains__(self, key):
+        return key in self.data and self._live(key)
+
+    # Includes expired keys not deleted yet
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        value = self.data.get(key, default)
+        if value is not default and self.expires and not self._live(key):
+            return default
+        return value
+
+    # When key expires (seconds since the epoch), or None if it has no TTL
+    def expiry(self, key):
+        return self.expires.get(key)
+
+    # Version of key's current value, or 0 if it is absent
+    def version(self, key):
+        with self.lock:
+            return self.versions[key] if key in self else 0
+
+    # Up to limit (key, value) pairs in key order: keys after 'after', within
+    # [start, end) and beginning with prefix. None leaves a bound open.
+    # Walks the sorted index from the lowest possible key, so a page costs
+    # O(log n + limit) no matter how big the table is.
+    def scan(self, prefix='', start=None, end=None, after=None, limit=None):
+        lo, inclusive = scan_start(prefix, start, after)
+        entries = []
+        now = time.time()
+        with self.lock:
+            for key in self.index.iter_from(lo, inclusive):
+                if not key.startswith(prefix) or (end is not None and key >= end):
+                    break
+                if self.expires and not self._live(key, now):
+                    continue
+                entries.append((key, self.data[key]))
+                if limit is not None and len(entries) >= limit:
+                    break
+        return entries
+
+    def items(self):
+        with self.lock:
+            if not self.expires:
+                return list(self.data.items())
+            now = time.time()
+            return [(key, value) for key, value in self.data.items() if self._live(key, now)]
+
+    # The live keys as 'set' records with their expiry times and versions,
+    # after the clock, e.g. to copy the table
+    def set_records(self):
+        with self.lock:
+            return [['clock', self.clock]] + [['set', key, value, self.expires.get(key), self.versions[key]]
+                                              for key, value in self.items()]
+
+    @property
+    def dirty(self):
+        return bool(self.pending)
+
+    # expires_at gives the key a TTL: it is deleted at that time (seconds since the epoch)
+    def set(self, key, value, expires_at=None):
+        with self.lock:
+            record = ['set', key, value] if expires_at is None else ['set', key, value, expires_at]
+            check_record(record)
+            self._apply(record)
+            self._append(record)
+
+    def delete(self, key):
+        with self.lock:
+            if key not in self:
+                raise KeyError(key)
+            record = ['del', key]
+            self._apply(record)
+            self._append(record)
+
+    # Apply many ['set', key, value] / ['del', key] operations as one log
+    # record, so after a crash either all of them are replayed or none
+    def apply_batch(self, ops):
+        self.apply_record(['batch', ops])
+
+    # Apply a record as it was published to change_hooks, e.g. on a replica
+    def apply_record(self, record):
+        check_record(record)
+        with self.lock:
+            self._apply(record)
+            self._append(record)
+
+    def _append(self, record):
+        for hook in change_hooks:
+            hook(self.db_name, self.table_name, record)
+        self.index_changed = True
+        self.pending.append(record)
+        self.records += record_size(record)
+        self.write_seq += 1
+        if self.compact_tail is not None:
+            self.compact_tail.append(record)
+        if len(self.pending) >= self.flush_batch:
+            self.flush()
+        self._maybe_compact()
+
+    # Write buffered records to the log in one go
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            block = self.codec.encode_block(self.pending)
+            self.log_file.write(block)
+            self.log_file.flush()
+            self.log_end += len(block)
+            self.pending = []
+
+    @property
+    def needs_sync(self):
+        return self.synced_seq < self.write_seq
+
+    # Block until every record up to seq (default: all so far) is on disk.
+    # The first caller fsyncs for everyone; callers arriving meanwhile wait
+    # and are usually covered by the next single fsync.
+    def sync(self, seq=None):
+        seq = self.write_seq if seq is None else seq
+        with self.sync_cond:
+            while self.synced_seq < seq:
+                if self.syncing:
+                    self.sync_cond.wait()
+                    continue
+                self.syncing = True
+                self.sync_cond.release()
+                try:
+                    with self.lock:
+                        target = self.write_seq
+                        # A closed table was already synced by close()
+                        fd = None if self.log_file.closed else os.dup(self.log_file.fileno())
+                        self.flush()
+                    if fd is not None:
+                        try:
+                            os.fsync(fd)
+                        finally:
+                            os.close(fd)
+                finally:
+                    self.sync_cond.acquire()
+                    self.syncing = False
+                    self.sync_cond.notify_all()
+                self.synced_seq = max(self.synced_seq, target)
+
+    # Earliest expiry time still in the heap (possibly of a key set again since), or None
+    def next_expiry(self):
+        return self.expiry_heap[0][0] if self.expiry_heap else None
+
+    # Delete up to limit keys whose expiry time is before now, as one log
+    # record; returns how many. Only the due heap entries are looked at.
+    def expire(self, now, limit):
+        with self.lock:
+            keys = {}
+            heap = self.expiry_heap
+            while heap and heap[0][0] <= now and len(keys) < limit:
+                at, key = heapq.heappop(heap)
+                if self.expires.get(key) == at:
+                    keys[key] = True
+            if keys:
+                self.apply_record(['batch', [['del', key] for key in keys]])
+            # Drop stale entries once they outnumber the live ones
+            if len(heap) > 2 * len(self.expires) + 1024:
+                self.expiry_heap = [(at, key) for key, at in self.expires.items()]
+                heapq.heapify(self.expiry_heap)
+            return len(keys)
+
+    def _maybe_compact(self):
+        if self.compact_thread is not None or self.records < max(COMPACT_MIN_RECORDS, self.compact_retry_at):
+            return
+        if self.records - len(self.data) < self.records * COMPACT_STALE_RATIO:
+            return
+        self.compact_tail = []
+        if self.shared:
+            self._compact(self.data, self.expires, self.versions, self.clock, self.records)
+            return
+        self.compact_thread = threading.Thread(target=self._compact,
+                                               args=(dict(self.data), dict(self.expires), dict(self.versions),
+                                                     self.clock, self.records),
+                                               daemon=True)
+        self.compact_thread.start()
+
+    # Rewrite the log with only live keys, without blocking writers meanwhile.
+    # A failure (such as a full disk) is logged and leaves the old log in
+    # place; compaction is tried again once the log has doubled.
+    def _compact(self, snapshot, expires, versions, clock, records_at_start):
+        tmp_path = self.log_path + '.compact'
+        try:
+            with open(tmp_path, 'wb') as f:
+                write_snapshot(f, snapshot, self.codec, expires, versions, clock)
+            with self.lock:
+                self.flush()
+                # Records appended while the snapshot was written go after it
+                with open(tmp_path, 'ab') as f:
+                    if self.compact_tail:
+                        f.write(self.codec.encode_block(self.compact_tail))
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.log_file.close()
+                os.replace(tmp_path, self.log_path)
+                fsync_dir(self.log_path)
+                self.log_file = open(self.log_path, 'ab')
+                self._log_position()
+                self.records = len(snapshot) + 1 + self.records - records_at_start
+        except Exception:
+            log.exception("Compacting %s failed", self.log_path)
+            with self.lock:
+                if self.log_file.closed:
+                    self.log_file = open(self.log_path, 'ab')
+                    self._log_position()
+                self.compact_retry_at = 2 * self.records
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        finally:
+            with self.lock:
+                self.compact_tail = None
+                self.compact_thread = None
+
+    # Rewrite the log in another format; returns False if it already is in it.
+    # The caller must hold the table's write lock, so no writes come in meanwhile.
+    def convert(self, fmt):
+        codec = tablecodec.CODECS[fmt]
+        thread = self.compact_thread
+        if thread is not None:
+            thread.join()
+        with self.lock:
+            if codec is self.codec:
+                return False
+            self.flush()
+            self.log_file.close()
+            atomic_write(self.log_path,
+                         lambda f: write_snapshot(f, self.data, codec, self.expires, self.versions, self.clock), 'wb')
+            self.log_file = open(self.log_path, 'ab')
+            self._log_position()
+            self.codec = codec
+            self.records = len(self.data) + 1
+            self.synced_seq = self.write_seq
+            self.index_changed = True
+            return True
+
+    # The log as it stands, for copying without holding the table's lock: an
+    # open file and the length of its complete records. Appends only add to
+    # the end and compaction replaces the file, so that part never changes.
+    def open_log(self):
+        with self.lock:
+            self.flush()
+            return open(self.log_path, 'rb'), self.log_end
+
+    # After the log was rewritten by this process
+    def _log_position(self):
+        stat = os.fstat(self.log_file.fileno())
+        self.log_ino, self.log_end = stat.st_ino, stat.st_size
+
+    def close(self):
+        thread = self.compact_thread
+        if thread is not None:
+            thread.join()
+        if self.fsync != FSYNC_NEVER:
+            self.sync()
+        with self.lock:
+            self.flush()
+            self.log_file.close()
+            self._save_index()
+
+    # Close without saving anything, once another process has converted or dropped the table
+    def discard(self):
+        with self.lock:
+            self.stale = True
+            self.log_file.close()
+
+
+# A table stored in a HashFile. Nothing is loaded on open and get, insert,
+# update and delete only touch the pages of the key involved, so lookups
+# cost the same on any size of table, including ones larger than memory.
+# The first scan builds a sorted index of the keys (not the values), kept
+# up to date after that, so a page costs O(log n + limit) reads. Secondary
+# indexes are not supported.
+# Writes go straight to the file; the fsync policy decides when it is synced.
+class HashTable:
+    def __init__(self, path, fsync=DEFAULT_FSYNC):
+        self.path = path
+        self.db_name, self.table_name = split_table_path(path)
+        self.file = HashFile(path + HASH_EXT)
+        self.fsync = fsync
+        self.write_seq = 0
+        self.synced_seq = 0
+        # The mapped pages belong to the OS page cache, not the cache budget;
+        # only the key index counts
+        self.size_bytes = 0
+        self.users = 0
+        self.stale = False
+        self.lock = threading.RLock()
+        # SortedKeyIndex of the keys once a scan needed it, and the file's
+        # header as of this process's last write, to spot writes by others
+        self.index = None
+        self.file_state = None
+
+    def _file_state(self):
+        return self.file.capacity, self.file.count, self.file.used, self.file.garbage, self.file.end
+
+    def _build_index(self):
+        keys = sorted(key.decode('utf-8') for key, _ in self.file.items())
+        self.index = SortedKeyIndex(keys)
+        self.size_bytes = sum(len(key) + KEY_OVERHEAD for key in keys)
+        self.file_state = self._file_state()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.file)
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.file.get(key.encode('utf-8'))
+        return default if value is None else value.decode('utf-8')
+
+    def items(self):
+        with self.lock:
+            return [(key.decode('utf-8'), value.decode('utf-8')) for key, value in self.file.items()]
+
+    def set_records(self):
+        return [['set', key, value] for key, value in self.items()]
+
+    # The file as it stands, for copying without holding the table's lock: a
+    # copy of its header and slots, an open file and the end of its records.
+    # Records are only ever appended and a rebuild replaces the file, so the
+    # records before that end never change.
+    def open_file(self):
+        with self.lock:
+            return self.file.slots[:], open(self.path + HASH_EXT, 'rb'), self.file.end
+
+    def expiry(self, key):
+        return None
+
+    def version(self, key):
+        raise DatabaseError("Error: Tables stored as hash do not support versions.")
+
+    def next_expiry(self):
+        return None
+
+    def expire(self, now, limit):
+        return 0
+
+    # Same arguments as Table.scan; values are read from the file per entry
+    def scan(self, prefix='', start=None, end=None, after=None, limit=None):
+        lo, inclusive = scan_start(prefix, start, after)
+        entries = []
+        with self.lock:
+            if self.index is None:
+                self._build_index()
+            for key in self.index.iter_from(lo, inclusive):
+                if not key.startswith(prefix) or (end is not None and key >= end):
+                    break
+                value = self.file.get(key.encode('utf-8'))
+                if value is not None:
+                    entries.append((key, value.decode('utf-8')))
+                if limit is not None and len(entries) >= limit:
+                    break
+        return entries
+
+    def create_index(self, field):
+        raise DatabaseError("Error: Tables stored as hash do not support secondary indexes.")
+
+    def find(self, field, value):
+        raise DatabaseError(f"Error: No index on field '{field}'. Tables stored as hash cannot have one.")
+
+    @property
+    def dirty(self):
+        return False
+
+    def flush(self):
+        pass
+
+    def set(self, key, value, expires_at=None):
+        if expires_at is not None:
+            raise DatabaseError("Error: Tables stored as hash do not support TTLs.")
+        self.apply_record(['set', key, value])
+
+    def delete(self, key):
+        with self.lock:
+            if key not in self:
+                raise KeyError(key)
+            self.apply_record(['del', key])
+
+    # Same operations as Table.apply_batch; they are applied one by one, so
+    # unlike a log record a crash part way through can keep some of them
+    def apply_batch(self, ops):
+        self.apply_record(['batch', ops])
+
+    # The file is changed first and only what was applied is published, as
+    # Table.apply_record does; if an operation fails, the ones before it are
+    # published as a batch
+    def apply_record(self, record):
+        check_record(record)
+        ops = record[1] if record[0] == 'batch' else [record]
+        with self.lock:
+            done = 0
+            try:
+                for op in ops:
+                    if op[0] == 'set':
+                        if self.file.put(op[1].encode('utf-8'), op[2].encode('utf-8')) and self.index is not None:
+                            self.index.add(op[1])
+                            self.size_bytes += len(op[1]) + KEY_OVERHEAD
+                    elif self.file.remove(op[1].encode('utf-8')) and self.index is not None:
+                        self.index.remove(op[1])
+                        self.size_bytes -= len(op[1]) + KEY_OVERHEAD
+                    done += 1
+            finally:
+                if done:
+                    applied = record if done == len(ops) else ['batch', ops[:done]]
+                    for hook in change_hooks:
+                        hook(self.db_name, self.table_name, applied)
+                    if self.index is not None:
+                        self.file_state = self._file_state()
+                    self.write_seq += 1
+
+    @property
+    def needs_sync(self):
+        return self.synced_seq < self.write_seq
+
+    def sync(self, seq=None):
+        with self.lock:
+            if self.needs_sync:
+                self.file.sync()
+                self.synced_seq = self.write_seq
+
+    # Same as Table.catch_up; the slots are shared, so only the header is
+    # reread. Keys written by others are not in the key index, so it is
+    # dropped and built again by the next scan.
+    def catch_up(self, write=False):
+        with self.lock:
+            if self.stale or not self.file.refresh():
+                return False
+            if self.index is not None and self._file_state() != self.file_state:
+                self.index = None
+                self.size_bytes = 0
+            return True
+
+    def close(self):
+        with self.lock:
+            if self.fsync != FSYNC_NEVER:
+                self.sync()
+            self.file.close()
+
+    def discard(self):
+        with self.lock:
+            self.stale = True
+            self.file.close()
+
+
+def load_table(path, flush_batch=1, fsync=DEFAULT_FSYNC, shared=False):
+    if os.path.exists(path + HASH_EXT):
+        return HashTable(path, fsync)
+    return Table(path, flush_batch, fsync, shared)
+
+
+# Keeps opened tables resident in memory, evicting the least recently used
+# ones once their estimated size exceeds the memory budget. Dirty tables are
+# flushed by a background thread every flush_interval seconds, as soon as
+# flush_batch records are pending, on eviction and on close. With the
+# 'interval' fsync policy another thread fsyncs them every fsync_interval.
+# With shared, several processes use the same tables at once: each use also
+# takes the table's file lock and catches up with what the others wrote, and
+# every write reaches the log before the lock is released (no write-behind).
+class TableCache:
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 flush_batch=DEFAULT_FLUSH_BATCH, fsync=DEFAULT_FSYNC, fsync_interval=DEFAULT_FSYNC_INTERVAL,
+                 shared=False):
+        self.memory_budget = memory_budget
+        self.flush_interval = flush_interval
+        self.flush_batch = 1 if shared else flush_batch
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.shared = shared
+        self.file_locks = {}
+        self.tables = OrderedDict()
+        self.lock = threading.Lock()
+        # Tables are loaded and closed outside self.lock, so one big table
+        # does not hold up the others; their paths are busy meanwhile and
+        # anyone else wanting them waits on busy_cond
+        self.busy = set()
+        self.busy_cond = threading.Condition(self.lock)
+        self.stop_event = threading.Event()
+        self.threads = []
+        # Opens served from memory and opens that had to load the table
+        self.hits = 0
+        self.misses = 0
+        # Failed background flush and fsync passes, and the error of each
+        # kind of pass that has not succeeded since (by function name)
+        self.background_errors = 0
+        self.failing = {}
+
+    def contains(self, db_name, table_name):
+        return table_path(db_name, table_name) in self.tables
+
+    def _acquire(self, path, write=False):
+        if write and self.failing:
+            raise DatabaseError(f"Error: Writes are refused until the server can write to disk again: "
+                                f"{next(iter(self.failing.values()))}")
+        with self.lock:
+            self._wait_idle(path)
+            table = self.tables.get(path)
+            if table is not None:
+                self.hits += 1
+                self.tables.move_to_end(path)
+                table.users += 1
+            else:
+                self.misses += 1
+                self.busy.add(path)
+        if table is None:
+            try:
+                table = load_table(path, self.flush_batch, self.fsync, self.shared)
+            finally:
+                with self.lock:
+                    self.busy.discard(path)
+                    self.busy_cond.notify_all()
+                    if table is not None:
+                        self.tables[path] = table
+                        table.users += 1
+        if self.shared and not table.catch_up(write):
+            # Converted to the other engine or dropped by another process
+            with self.lock:
+                if self.tables.get(path) is table:
+                    del self.tables[path]
+                table.users -= 1
+            table.discard()
+            return self._acquire(path, write)
+        return table
+
+    def _release(self, table):
+        with self.lock:
+            table.users -= 1
+            evicted = self._evict()
+        for path, table in evicted:
+            try:
+                table.close()
+            finally:
+                with self.lock:
+                    self.busy.discard(path)
+                    self.busy_cond.notify_all()
+
+    # Called with self.lock held
+    def _wait_idle(self, path):
+        while path in self.busy:
+            self.busy_cond.wait()
+
+    # The cross-process lock of a table in shared mode, else None
+    def file_lock(self, path):
+        if not self.shared:
+            return None
+        with self.lock:
+            file_lock = self.file_locks.get(path)
+            if file_lock is None:
+                file_lock = self.file_locks[path] = FileLock(path + LOCK_EXT)
+            return file_lock
+
+    # Drop least recently used tables until the cache fits its budget; returns
+    # the (path, table) pairs dropped, now busy, for the caller to close
+    # outside self.lock (which it holds)
+    def _evict(self):
+        evicted = []
+        total = sum(table.size_bytes for table in self.tables.values())
+        for path, table in list(self.tables.items()):
+            if total <= self.memory_budget:
+                break
+            if table.users:
+                continue
+            del self.tables[path]
+            self.busy.add(path)
+            evicted.append((path, table))
+            total -= table.size_bytes
+        return evicted
+
+    # Use as 'with cache.open(db, table) as table:'. The table stays pinned in
+    # the block, under a shared lock for reads or an exclusive one for writes.
+    def open(self, db_name, table_name, write=False):
+        if write:
+            lock = table_locks.write(db_name, table_name)
+        else:
+            lock = table_locks.read(db_name, table_name)
+        path = table_path(db_name, table_name)
+        return _PinnedTable(self, path, lock, self.file_lock(path), write)
+
+    # Use as 'with cache.locked(db, table):' to create or remove a table's files
+    # with no one else using it, in this process or (in shared mode) another
+    @contextmanager
+    def locked(self, db_name, table_name):
+        file_lock = self.file_lock(table_path(db_name, table_name))
+        with table_locks.write(db_name, table_name):
+            if file_lock is None:
+                yield
+                return
+            with file_lock.hold(exclusive=True):
+                yield
+
+    # Rewrite a table in another format, switching between a log and a hash
+    # file when needed; returns False if it already is in that format
+    def convert(self, db_name, table_name, fmt):
+        path = table_path(db_name, table_name)
+        with self.open(db_name, table_name, write=True) as table:
+            if isinstance(table, Table) and fmt != HASH_FORMAT:
+                return table.convert(fmt)
+            if isinstance(table, HashTable) and fmt == HASH_FORMAT:
+                return False
+            if isinstance(table, Table) and table.meta['indexes']:
+                raise DatabaseError("Error: Tables with secondary indexes cannot be stored as hash.")
+            if isinstance(table, Table) and table.expires:
+                raise DatabaseError("Error: Tables with keys that have a TTL cannot be stored as hash.")
+            items = table.items()
+            if fmt == HASH_FORMAT:
+                write_file(path + HASH_EXT, [(key.encode('utf-8'), value.encode('utf-8')) for key, value in items],
+                           capacity_for(len(items)))
+                old_exts = (LOG_EXT, INDEX_EXT, META_EXT)
+            else:
+                codec = tablecodec.CODECS[fmt]
+                atomic_write(path + LOG_EXT, lambda f: write_snapshot(f, dict(items), codec), 'wb')
+                old_exts = (HASH_EXT,)
+            # The write lock is still held, so no one reopens the table before the old files are gone
+            self._forget(path, table)
+            _remove_files(path, old_exts)
+        return True
+
+    # Delete a table and all its files
+    def drop(self, db_name, table_name):
+        self.replace(db_name, table_name, lambda path: None)
+
+    # Delete a table's files and call write_files(path) to write new ones
+    # (e.g. from a backup), with no one using the table meanwhile
+    def replace(self, db_name, table_name, write_files):
+        path = table_path(db_name, table_name)
+        with self.locked(db_name, table_name):
+            with self.lock:
+                self._wait_idle(path)
+                table = self.tables.get(path)
+            if table is not None:
+                self._forget(path, table)
+            _remove_files(path, TABLE_EXTS)
+            write_files(path)
+
+    # Close a table and drop it from the cache; the caller holds its write lock
+    def _forget(self, path, table):
+        with self.lock:
+            self.tables.pop(path, None)
+        table.close()
+
+    # Hit and miss counts, failed background passes and (db, table, keys,
+    # estimated bytes) of every resident table
+    def stats(self):
+        with self.lock:
+            tables = list(self.tables.items())
+            hits, misses, errors = self.hits, self.misses, self.background_errors
+        resident = []
+        for path, table in tables:
+            resident.append((table.db_name, table.table_name, len(table), table.size_bytes))
+        return hits, misses, errors, resident
+
+    # Delete the expired keys of resident tables, at most batch per log record;
+    # returns how many. Tables not resident are dealt with once loaded again.
+    def expire_all(self, batch=DEFAULT_EXPIRE_BATCH):
+        now = time.time()
+        with self.lock:
+            due = [table for table in self.tables.values()
+                   if table.next_expiry() is not None and table.next_expiry() <= now]
+        count = 0
+        for table in due:
+            while True:
+                with self.open(table.db_name, table.table_name, write=True) as current:
+                    expired = current.expire(now, batch)
+                count += expired
+                if expired < batch:
+                    break
+        return count
+
+    def flush_all(self):
+        with self.lock:
+            tables = list(self.tables.values())
+        for table in tables:
+            if table.dirty:
+                table.flush()
+
+    def sync_all(self):
+        with self.lock:
+            tables = list(self.tables.values())
+        for table in tables:
+            if table.needs_sync:
+                table.sync()
+
+    def start_flusher(self):
+        loops = [(self.flush_all, self.flush_interval)]
+        if self.fsync == FSYNC_INTERVAL:
+            loops.append((self.sync_all, self.fsync_interval))
+        for fn, interval in loops:
+            thread = threading.Thread(target=self._run_every, args=(fn, interval), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # A failing pass (a full disk, an I/O error) is logged and tried again
+    # next time. Until one succeeds, writes are refused rather than
+    # acknowledged without reaching the disk.
+    def _run_every(self, fn, interval):
+        while not self.stop_event.wait(interval):
+            try:
+                fn()
+            except Exception as e:
+                log.exception("Background %s failed", fn.__name__)
+                with self.lock:
+                    self.background_errors += 1
+                    self.failing[fn.__name__] = e
+                continue
+            if fn.__name__ in self.failing:
+                with self.lock:
+                    self.failing.pop(fn.__name__, None)
+                log.info("Background %s succeeded again", fn.__name__)
+
+    def close(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        with self.lock:
+            for table in self.tables.values():
+                table.close()
+            self.tables.clear()
+            for file_lock in self.file_locks.values():
+                file_lock.close()
+            self.file_locks.clear()
+        self.stop_event.clear()
+
+
+class _PinnedTable:
+    def __init__(self, cache, path, lock, file_lock, write):
+        self.cache = cache
+        self.path = path
+        self.lock = lock
+        self.file_lock = file_lock
+        self.write = write
+
+    def __enter__(self):
+        self.lock.__enter__()
+        try:
+            if self.file_lock is not None:
+                self.file_lock.acquire(exclusive=self.write)
+            try:
+                self.table = self.cache._acquire(self.path, self.write)
+            except BaseException:
+                if self.file_lock is not None:
+                    self.file_lock.release()
+                raise
+        except BaseException:
+            self.lock.__exit__(None, None, None)
+            raise
+        return self.table
+
+    def __exit__(self, *exc_info):
+        seq = self.table.write_seq
+        try:
+            if self.file_lock is not None:
+                self.file_lock.release()
+            self.lock.__exit__(None, None, None)
+            # Wait for durability outside the table lock, so concurrent writers share one fsync
+            if self.write and self.table.fsync == FSYNC_ALWAYS and self.table.needs_sync:
+                self.table.sync(seq)
+        finally:
+            self.cache._release(self.table)
+
+
+def _remove_files(path, exts):
+    for ext in exts:
+        if os.path.exists(path + ext):
+            os.remove(path + ext)
+    fsync_dir(path)
+
+
+# Tables opened by this process
+cache = TableCache()
+databases_lock = None
+
+
+def open_table(db_name, table_name, write=False):
+    return cache.open(db_name, table_name, write)
+
+
+def convert_table(db_name, table_name, fmt):
+    return cache.convert(db_name, table_name, fmt)
+
+
+def drop_table(db_name, table_name):
+    cache.drop(db_name, table_name)
+
+
+def replace_table(db_name, table_name, write_files):
+    cache.replace(db_name, table_name, write_files)
+
+
+def lock_table(db_name, table_name):
+    return cache.locked(db_name, table_name)
+
+
+# Take the databases folder for this process: shared by processes whose
+# cache is in shared mode (server workers, db_cli), which see each other's
+# writes, or exclusive for a single server process, which keeps tables
+# resident without reading appends made by others. Raises DatabaseError if
+# the folder is taken in the other mode; the lock is held until exit.
+def claim_databases(shared):
+    global databases_lock
+    os.makedirs(DATABASES_DIR, exist_ok=True)
+    lock = FileLock(os.path.join(DATABASES_DIR, DATABASES_LOCK))
+    if not lock.acquire(exclusive=not shared, blocking=False):
+        raise DatabaseError("Error: A server is using the databases folder. Send commands to it with "
+                            "db_client.py, or stop it first." if shared else
+                            "Error: Another server or db_cli is using the databases folder.")
+    databases_lock = lock
+
+
+def close_all():
+    cache.close()
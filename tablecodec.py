@@ -0,0 +1,186 @@
+import json
+import struct
+import sys
+import zlib
+from array import array
+from itertools import accumulate
+
+# Binary logs start with MAGIC and a format byte; JSON logs have no header
+MAGIC = b'KVL'
+# Every binary block: payload length, CRC32 of the payload, flags
+BLOCK = struct.Struct('<IIB')
+FLAG_ZLIB = 1
+# Blocks smaller than this are not worth compressing
+COMPRESS_MIN_BYTES = 256
+# Records per block when a whole table is written out
+SNAPSHOT_BLOCK_RECORDS = 1000
+
+# One operation code per record; a batch is framed by BEGIN and END.
+# SET_TTL is a set with an expiry time, stored as a third string.
+# SET_VERSION has an expiry time ('' for none) and a version, and CLOCK a
+# table clock; both only appear in rewritten logs.
+OP_SET = b'S'[0]
+OP_SET_TTL = b'T'[0]
+OP_SET_VERSION = b'V'[0]
+OP_CLOCK = b'C'[0]
+OP_DEL = b'D'[0]
+OP_BEGIN = b'B'[0]
+OP_END = b'E'[0]
+
+# String lengths are stored little-endian whatever the machine's byte order
+_SWAP_LENGTHS = sys.byteorder == 'big'
+
+
+# False for text holding a lone surrogate, which UTF-8 cannot encode
+def is_utf8(text):
+    try:
+        text.encode('utf-8')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+# Mutation log as JSON lines, one record per line. Readable with any text
+# tool, but every value is escaped and quoted and every read parses it back.
+class JsonCodec:
+    name = 'json'
+    header = b''
+
+    def encode_block(self, records):
+        return ''.join([json.dumps(record) + '\n' for record in records]).encode('utf-8')
+
+    # Yield (records, size in bytes) per block, stopping at a torn or corrupt tail
+    def read_blocks(self, f):
+        for line in f:
+            if not line.endswith(b'\n'):
+                return
+            try:
+                record = json.loads(line)
+            except ValueError:
+                return
+            yield [record], len(line)
+
+
+def _encode_ops(record, ops, strings):
+    if record[0] == 'set' and len(record) > 4:
+        ops.append(OP_SET_VERSION)
+        strings.append(record[1])
+        strings.append(record[2])
+        strings.append('' if record[3] is None else repr(record[3]))
+        strings.append(str(record[4]))
+    elif record[0] == 'set' and len(record) > 3:
+        ops.append(OP_SET_TTL)
+        strings.append(record[1])
+        strings.append(record[2])
+        strings.append(repr(record[3]))
+    elif record[0] == 'set':
+        ops.append(OP_SET)
+        strings.append(record[1])
+        strings.append(record[2])
+    elif record[0] == 'del':
+        ops.append(OP_DEL)
+        strings.append(record[1])
+    elif record[0] == 'clock':
+        ops.append(OP_CLOCK)
+        strings.append(str(record[1]))
+    elif record[0] == 'batch':
+        ops.append(OP_BEGIN)
+        for op in record[1]:
+            _encode_ops(op, ops, strings)
+        ops.append(OP_END)
+
+
+# Mutation log as length-prefixed binary blocks of many records. A block
+# holds the op codes, the string lengths as a uint32 array and all strings
+# as one UTF-8 text, so decoding is a few C-level calls plus slicing.
+# With compress, blocks are zlib-compressed as a whole.
+class BinaryCodec:
+    def __init__(self, name, format_id, compress=False):
+        self.name = name
+        self.header = MAGIC + bytes([format_id])
+        self.compress = compress
+
+    def encode_block(self, records):
+        ops = bytearray()
+        strings = []
+        for record in records:
+            _encode_ops(record, ops, strings)
+        lengths = array('I', [len(s) for s in strings])
+        if _SWAP_LENGTHS:
+            lengths.byteswap()
+        payload = struct.pack('<II', len(ops), len(strings)) + bytes(ops) + lengths.tobytes() \
+            + ''.join(strings).encode('utf-8')
+        flags = 0
+        if self.compress and len(payload) >= COMPRESS_MIN_BYTES:
+            payload = zlib.compress(payload)
+            flags = FLAG_ZLIB
+        return BLOCK.pack(len(payload), zlib.crc32(payload), flags) + payload
+
+    def read_blocks(self, f):
+        while True:
+            head = f.read(BLOCK.size)
+            if len(head) < BLOCK.size:
+                return
+            length, crc, flags = BLOCK.unpack(head)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            if flags & FLAG_ZLIB:
+                payload = zlib.decompress(payload)
+            yield self._decode(payload), BLOCK.size + length
+
+    def _decode(self, payload):
+        op_count, string_count = struct.unpack_from('<II', payload)
+        pos = 8
+        ops = payload[pos:pos + op_count]
+        pos += op_count
+        lengths = array('I')
+        lengths.frombytes(payload[pos:pos + 4 * string_count])
+        if _SWAP_LENGTHS:
+            lengths.byteswap()
+        text = payload[pos + 4 * string_count:].decode('utf-8')
+        ends = list(accumulate(lengths))
+        strings = [text[end - length:end] for end, length in zip(ends, lengths)]
+        records = []
+        batch = None
+        i = 0
+        for op in ops:
+            if op == OP_SET:
+                record = ['set', strings[i], strings[i + 1]]
+                i += 2
+            elif op == OP_SET_TTL:
+                record = ['set', strings[i], strings[i + 1], float(strings[i + 2])]
+                i += 3
+            elif op == OP_SET_VERSION:
+                at = strings[i + 2]
+                record = ['set', strings[i], strings[i + 1], float(at) if at else None, int(strings[i + 3])]
+                i += 4
+            elif op == OP_CLOCK:
+                record = ['clock', int(strings[i])]
+                i += 1
+            elif op == OP_DEL:
+                record = ['del', strings[i]]
+                i += 1
+            elif op == OP_BEGIN:
+                batch = []
+                continue
+            else:
+                record, batch = ['batch', batch], None
+            if batch is None:
+                records.append(record)
+            else:
+                batch.append(record)
+        return records
+
+
+JSON = JsonCodec()
+CODECS = {codec.name: codec for codec in (JSON, BinaryCodec('binary', 1), BinaryCodec('zlib', 2, compress=True))}
+FORMATS = tuple(CODECS)
+_BY_HEADER = {codec.header: codec for codec in CODECS.values() if codec.header}
+
+
+# The codec a log was written with, told from its first bytes
+def detect(f):
+    codec = _BY_HEADER.get(f.read(len(MAGIC) + 1), JSON)
+    f.seek(len(codec.header))
+    return codec
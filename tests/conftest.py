@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage
+
+
+# Run in an empty folder holding one database 'db', as the server would
+@pytest.fixture
+def db_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join(storage.DATABASES_DIR, 'db'))
+    return tmp_path
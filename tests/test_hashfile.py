@@ -0,0 +1,75 @@
+import hashfile
+
+
+def open_file(tmp_path):
+    path = str(tmp_path / 't.hash')
+    hashfile.write_file(path, ())
+    return hashfile.HashFile(path)
+
+
+def test_put_get_remove(tmp_path):
+    f = open_file(tmp_path)
+    assert f.put(b'a', b'1')
+    assert f.put(b'', b'')
+    assert not f.put(b'a', b'2')
+    assert f.get(b'a') == b'2'
+    assert f.get(b'') == b''
+    assert f.get(b'missing') is None
+    assert len(f) == 2
+    assert f.remove(b'a')
+    assert not f.remove(b'a')
+    assert f.get(b'a') is None
+    assert len(f) == 1
+    f.close()
+
+
+def test_reopen(tmp_path):
+    f = open_file(tmp_path)
+    expected = {}
+    for i in range(500):
+        key = f'key {i}'.encode('utf-8')
+        f.put(key, b'x' * i)
+        expected[key] = b'x' * i
+    for i in range(0, 500, 3):
+        key = f'key {i}'.encode('utf-8')
+        f.remove(key)
+        del expected[key]
+    f.put('😀'.encode('utf-8'), 'é'.encode('utf-8'))
+    expected['😀'.encode('utf-8')] = 'é'.encode('utf-8')
+    f.sync()
+    f.close()
+    f = hashfile.HashFile(f.path)
+    assert len(f) == len(expected)
+    assert dict(f.items()) == expected
+    for key, value in expected.items():
+        assert f.get(key) == value
+    f.close()
+
+
+# Growing past the maximum load rebuilds the file with more slots
+def test_rebuild_keeps_keys(tmp_path):
+    f = open_file(tmp_path)
+    count = hashfile.INITIAL_CAPACITY * 2
+    for i in range(count):
+        f.put(str(i).encode('utf-8'), str(i * i).encode('utf-8'))
+    assert f.capacity > hashfile.INITIAL_CAPACITY
+    f.close()
+    f = hashfile.HashFile(f.path)
+    assert len(f) == count
+    assert all(f.get(str(i).encode('utf-8')) == str(i * i).encode('utf-8') for i in range(count))
+    f.close()
+
+
+# A second HashFile on the same path sees the first one's writes after refresh
+def test_refresh(tmp_path):
+    writer = open_file(tmp_path)
+    reader = hashfile.HashFile(writer.path)
+    writer.put(b'a', b'1')
+    assert reader.refresh()
+    assert reader.get(b'a') == b'1'
+    writer.rebuild()
+    writer.put(b'b', b'2')
+    assert reader.refresh()
+    assert dict(reader.items()) == {b'a': b'1', b'b': b'2'}
+    reader.close()
+    writer.close()
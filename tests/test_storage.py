@@ -0,0 +1,147 @@
+import os
+import threading
+
+import pytest
+
+import storage
+import tablecodec
+
+
+def open_table(fmt=storage.DEFAULT_FORMAT, name='t'):
+    if not os.path.exists(storage.table_path('db', name, storage.LOG_EXT)):
+        storage.create_table('db', name, fmt)
+    return storage.Table(storage.table_path('db', name))
+
+
+@pytest.mark.parametrize('fmt', tablecodec.FORMATS)
+def test_reopen_replays_log(db_dir, fmt):
+    table = open_table(fmt)
+    table.set('a', '1')
+    table.set('😀', 'é\n', expires_at=4102444800.0)
+    table.set('b', '2')
+    table.delete('b')
+    table.apply_batch([['set', 'c', '3'], ['del', 'a']])
+    version = table.version('c')
+    table.close()
+    table = open_table()
+    assert dict(table.items()) == {'😀': 'é\n', 'c': '3'}
+    assert table.expiry('😀') == 4102444800.0
+    assert table.version('c') == version
+    table.close()
+
+
+# A crash mid-append leaves part of a record at the end of the log: it is
+# dropped on open and the log cut back, so new records follow the good ones
+@pytest.mark.parametrize('fmt', tablecodec.FORMATS)
+def test_torn_tail_is_dropped(db_dir, fmt):
+    table = open_table(fmt)
+    table.set('a', '1')
+    table.apply_batch([['set', 'b', '2'], ['set', 'c', '3']])
+    table.close()
+    log_path = storage.table_path('db', 't', storage.LOG_EXT)
+    good_size = os.path.getsize(log_path)
+    block = tablecodec.CODECS[fmt].encode_block([['batch', [['set', 'd', '4'], ['del', 'a']]]])
+    with open(log_path, 'ab') as f:
+        f.write(block[:-3])
+    table = open_table()
+    assert dict(table.items()) == {'a': '1', 'b': '2', 'c': '3'}
+    assert os.path.getsize(log_path) == good_size
+    table.set('e', '5')
+    table.close()
+    table = open_table()
+    assert dict(table.items()) == {'a': '1', 'b': '2', 'c': '3', 'e': '5'}
+    table.close()
+
+
+def test_rejects_invalid_utf8(db_dir):
+    table = open_table(tablecodec.FORMATS[1])
+    with pytest.raises(storage.DatabaseError):
+        table.set('a\udc80', '1')
+    with pytest.raises(storage.DatabaseError):
+        table.apply_batch([['set', 'b', '2'], ['set', 'c', '\ud800']])
+    table.set('d', '4')
+    table.close()
+    table = open_table()
+    assert dict(table.items()) == {'d': '4'}
+    table.close()
+
+
+# Writes made while the compacted log is being written must survive it
+@pytest.mark.parametrize('fmt', tablecodec.FORMATS)
+def test_compaction_keeps_concurrent_writes(db_dir, monkeypatch, fmt):
+    started = threading.Event()
+    resume = threading.Event()
+    write_snapshot = storage.write_snapshot
+
+    def slow_write_snapshot(*args, **kwargs):
+        started.set()
+        assert resume.wait(10)
+        write_snapshot(*args, **kwargs)
+
+    monkeypatch.setattr(storage, 'write_snapshot', slow_write_snapshot)
+    table = open_table(fmt)
+    expected = {}
+    i = 0
+    while not started.is_set():
+        key = f'key {i % 50}'
+        table.set(key, str(i))
+        expected[key] = str(i)
+        i += 1
+    assert table.compact_thread is not None
+
+    def writer(n):
+        for j in range(200):
+            key = f'thread {n} key {j % 20}'
+            table.set(key, str(j))
+            if j % 7 == 0:
+                table.delete(key)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    table.delete('key 0')
+    del expected['key 0']
+    table.set('key 1', 'after')
+    expected['key 1'] = 'after'
+    for n in range(4):
+        for j in range(200):
+            key = f'thread {n} key {j % 20}'
+            if j % 7 == 0:
+                expected.pop(key, None)
+            else:
+                expected[key] = str(j)
+    log_path = storage.table_path('db', 't', storage.LOG_EXT)
+    old_ino = os.stat(log_path).st_ino
+    thread = table.compact_thread
+    resume.set()
+    thread.join()
+    assert table.compact_tail is None
+    assert os.stat(log_path).st_ino != old_ino
+    assert dict(table.items()) == expected
+    table.close()
+    table = open_table()
+    assert dict(table.items()) == expected
+    table.close()
+
+
+def test_failed_compaction_keeps_log(db_dir, monkeypatch):
+    def failing_write_snapshot(*args, **kwargs):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(storage, 'write_snapshot', failing_write_snapshot)
+    table = open_table()
+    for i in range(storage.COMPACT_MIN_RECORDS):
+        table.set('a', str(i))
+    thread = table.compact_thread
+    if thread is not None:
+        thread.join()
+    assert table.compact_thread is None and table.compact_tail is None
+    assert table.compact_retry_at == 2 * storage.COMPACT_MIN_RECORDS
+    assert not os.path.exists(storage.table_path('db', 't', storage.LOG_EXT) + '.compact')
+    table.set('b', 'after')
+    table.close()
+    table = open_table()
+    assert dict(table.items()) == {'a': str(storage.COMPACT_MIN_RECORDS - 1), 'b': 'after'}
+    table.close()
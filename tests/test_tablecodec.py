@@ -0,0 +1,58 @@
+import io
+
+import pytest
+
+import tablecodec
+
+# Strings a codec must carry unchanged: empty, separators and escapes,
+# characters outside the BMP, and text that looks like a number
+ODD_STRINGS = ['', ' ', '\n', '\r\n', '\t', '"', '\\', '\\n', '\x00', '\x7f', 'é', 'ß' * 300, '日本語',
+               '😀', 'a😀b', '\u00a0', '\u2028', '\ufeff', '1e5', 'None', '{"a": [1]}']
+
+
+def records():
+    result = [['set', key, value] for key in ODD_STRINGS for value in ODD_STRINGS[:5]]
+    result.append(['set', '😀', 'ttl', 1234567890.125])
+    result.append(['set', 'versioned', '\n', None, 7])
+    result.append(['set', 'versioned ttl', '', 99.5, 8])
+    result.append(['clock', 42])
+    result.append(['del', '\x00'])
+    result.append(['batch', [['set', '', '😀'], ['del', 'é'], ['set', '\\', '"']]])
+    result.append(['batch', []])
+    return result
+
+
+def read_all(codec, data):
+    f = io.BytesIO(data)
+    assert tablecodec.detect(f) is codec
+    return [record for block, size in codec.read_blocks(f) for record in block]
+
+
+@pytest.mark.parametrize('fmt', tablecodec.FORMATS)
+def test_round_trip(fmt):
+    codec = tablecodec.CODECS[fmt]
+    expected = records()
+    data = codec.header + codec.encode_block(expected[:10]) + codec.encode_block(expected[10:])
+    assert read_all(codec, data) == expected
+
+
+@pytest.mark.parametrize('fmt', tablecodec.FORMATS)
+def test_one_record_per_block(fmt):
+    codec = tablecodec.CODECS[fmt]
+    expected = records()
+    data = codec.header + b''.join(codec.encode_block([record]) for record in expected)
+    assert read_all(codec, data) == expected
+
+
+@pytest.mark.parametrize('fmt', tablecodec.FORMATS)
+def test_torn_tail_is_ignored(fmt):
+    codec = tablecodec.CODECS[fmt]
+    first = codec.encode_block([['set', 'a', '1']])
+    second = codec.encode_block([['set', 'b', 'é' * 200]])
+    for cut in range(1, len(second)):
+        assert read_all(codec, codec.header + first + second[:-cut]) == [['set', 'a', '1']]
+
+
+def test_is_utf8():
+    assert tablecodec.is_utf8('a😀é')
+    assert not tablecodec.is_utf8('a\udc80')